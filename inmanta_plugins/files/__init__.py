@@ -17,46 +17,96 @@ Contact: edvgui@gmail.com
 """
 
 import base64
+import concurrent.futures
 import contextlib
 import contextvars
+import dataclasses
 import functools
 import logging
+import os
 import pathlib
+import re
+import sys
 import typing
 import uuid
-from collections.abc import Mapping
+from collections.abc import Collection, Mapping, MutableMapping, Sequence
 
 import jinja2
 from inmanta_plugins.config import resolve_path
 from inmanta_plugins.std import FactReference, JinjaDynamicProxy
 
 import inmanta.ast
+import inmanta.compiler
+import inmanta_plugins.files.analysis
+import inmanta_plugins.files.cache
+import inmanta_plugins.files.resolution
 import inmanta_plugins.files.upload
+import inmanta_plugins.files.workers
 from inmanta.agent.handler import LoggerABC, PythonLogger
-from inmanta.plugins import CheckedArgs, Context, Plugin, plugin
+from inmanta.execute.proxy import DynamicProxy
+from inmanta.plugins import CheckedArgs, Context, plugin
 from inmanta.protocol.endpoints import SyncClient
 from inmanta.references import ArgumentTypes, Reference, reference
+from inmanta_plugins.files.cache import CacheStats
+from inmanta_plugins.files.filters import deterministic, get_direct_call
 from inmanta_plugins.files.monkeypatch import (
-    allow_references_in_templates,
-    collect_unset_values,
+    JINJA_RENDER_HOOKS,
+    RenderHooks,
+    install_patches,
+    patch_reference_str,
 )
 
 JINJA_DEFERRED_CONTEXT: contextvars.ContextVar[dict[str, Reference[str]]] = (
     contextvars.ContextVar("JINJA_DEFERRED_CONTEXT")
 )
 JINJA_FILE: contextvars.ContextVar[str] = contextvars.ContextVar("JINJA_FILE")
+# The context of the jinja plugin call which is currently rendering a template,
+# used by the plugins called as filters in the template.
+JINJA_CONTEXT: contextvars.ContextVar[Context] = contextvars.ContextVar("JINJA_CONTEXT")
 JINJA_ENV: jinja2.Environment | None = None
+# The last environment built by get_jinja_env, and the set of plugins it was
+# built for.  It doesn't depend on any compile, so it is kept across compiles.
+JINJA_REUSABLE_ENV: tuple[frozenset[str], jinja2.Environment] | None = None
 # Compiled jinja templates, keyed by resolved template path.  Compiling a
 # template from source (parse + optimize + bytecode) is expensive and the same
 # handful of templates are rendered thousands of times per compile, so we cache
 # the compiled Template objects.  Cleared in inmanta_reset_state alongside the
-# environment they are bound to.
-JINJA_TEMPLATE_CACHE: dict[str, "jinja2.Template"] = dict()
+# environment they are bound to, the compiled code itself is kept across
+# compiles by inmanta_plugins.files.cache.load_template.
+JINJA_TEMPLATE_CACHE: dict[
+    str, tuple["jinja2.Template", "inmanta_plugins.files.cache.CompiledTemplate"]
+] = dict()
+# The environment rendering the templates in skeleton mode (see
+# skeleton_finalize), and the environment it was derived from.  Their
+# templates are cached separately, the compiled code is different.
+JINJA_SKELETON_ENV: tuple[jinja2.Environment, jinja2.Environment] | None = None
+JINJA_SKELETON_TEMPLATE_CACHE: dict[
+    str, tuple["jinja2.Template", "inmanta_plugins.files.cache.CompiledTemplate"]
+] = dict()
 REFERENCES: list[Reference] = list()
-# Reference classes whose __str__ should be temporarily overwritten during a
-# jinja render so that they register themselves in the current jinja context.
-# Populated by auto_register_reference.
+# Ids of the references registered in jinja templates during this compile.
+# Computing the id of a reference serializes it, which for some references
+# means reading and hashing files, and the same references are printed by many
+# templates.  The ids are memoized by reference object: references define
+# __eq__ without __hash__, they can't be looked up by value.
+REFERENCE_IDS: dict[int, tuple[Reference, str]] = dict()
+REFERENCE_ID_STATS = CacheStats()
+# Output of the files::jinja plugins called as filters by other templates
+# during this compile, keyed by plugin and by the identity of the arguments
+# (see get_nested_render_key).  A sub-template rendered in a loop of another
+# template is then only rendered once per distinct set of arguments.  The
+# arguments are kept along with the output, so that their ids are not reused
+# by other objects during this compile.
+NESTED_RENDER_PLUGINS = frozenset({"files::jinja", "files::jinja_inline"})
+NESTED_RENDERS: dict[tuple[object, ...], tuple[object, object]] = dict()
+NESTED_RENDER_STATS = CacheStats()
+# Reference classes whose __str__ is overwritten so that they register
+# themselves in the current jinja context during a jinja render.  Populated by
+# auto_register_reference.
 REFERENCE_CLASSES: list[type[Reference]] = list()
+# The templates rendered in worker processes during this compile, their output
+# is checked at the end of the compile, see check_parallel_renders.
+PARALLEL_RENDERS: list["RenderedTextReference"] = list()
 LOGGER = logging.getLogger(__name__)
 
 
@@ -74,33 +124,61 @@ LOGGER = logging.getLogger(__name__)
 # whole batch, so the compiler waits for all of them at once and re-invokes us.
 # Only a pass that observes zero misses used real values throughout, so only its
 # output is ever returned -- which keeps the result identical to the old code.
+#
+# The discovery render is only needed for the values read conditionally: the
+# values read by every render of a template are extracted by a static analysis
+# of the template and checked before rendering it at all, along with the values
+# previous renders of the same template were found waiting for (see
+# inmanta_plugins.files.cache.get_unset).
 JINJA_UNSET_COLLECTOR: contextvars.ContextVar[set[object] | None] = (
     contextvars.ContextVar("files_jinja_unset_collector", default=None)
 )
 
 
 def inmanta_reset_state() -> None:
-    global JINJA_ENV
+    global JINJA_ENV, REFERENCE_ID_STATS, NESTED_RENDER_STATS
     JINJA_ENV = None
     JINJA_TEMPLATE_CACHE.clear()
-
-
-def collect_or_raise(exc: inmanta.ast.UnsetException) -> object:
+    JINJA_SKELETON_TEMPLATE_CACHE.clear()
+    LOGGER.debug("Jinja reference id cache usage: %s", REFERENCE_ID_STATS)
+    REFERENCE_IDS.clear()
+    REFERENCE_ID_STATS = CacheStats()
+    LOGGER.debug("Nested jinja render cache usage: %s", NESTED_RENDER_STATS)
+    NESTED_RENDERS.clear()
+    NESTED_RENDER_STATS = CacheStats()
+    PARALLEL_RENDERS.clear()
+    if JINJA_REUSABLE_ENV is not None and JINJA_REUSABLE_ENV[1].cache is not None:
+        # Templates loaded by name are not reloaded during a compile, the next
+        # compile should check their files again
+        JINJA_REUSABLE_ENV[1].cache.clear()
+    if JINJA_SKELETON_ENV is not None and JINJA_SKELETON_ENV[1].cache is not None:
+        JINJA_SKELETON_ENV[1].cache.clear()
+
+
+def collect_or_raise(
+    exc: inmanta.ast.UnsetException | inmanta.ast.MultiUnsetException,
+) -> object:
     """
     During a discovery render, record the unset value and return a
     chaining-undefined so rendering can continue.  Outside a discovery render
     (no active collector) propagate the exception, preserving the original
-    per-miss rescheduling behaviour.
+    per-miss rescheduling behaviour.  The batch of unset values of a nested
+    render (a plugin called as filter) is recorded the same way.
     """
     collector = JINJA_UNSET_COLLECTOR.get()
-    variable = exc.get_result_variable()
-    if collector is None or variable is None:
+    variables: list[object]
+    if isinstance(exc, inmanta.ast.MultiUnsetException):
+        variables = list(exc.result_variables)
+    else:
+        variables = [exc.get_result_variable()]
+    if collector is None or not variables or None in variables:
         raise exc
-    collector.add(variable)
+    collector.update(variables)
     return jinja2.ChainableUndefined(hint=exc.msg)
 
 
 @plugin
+@deterministic
 def path_join(base_path: str, *extra: str) -> str:
     """
     Join together the base_path and all of the extra parts after it.  If any extra
@@ -192,6 +270,67 @@ class TextReference(Reference[str]):
         return False
 
 
+class RenderedTextReference(TextReference):
+    """
+    Reference to the output of a template rendered in a worker process, see
+    inmanta_plugins.files.workers.  The compiler only waits for the output when
+    the text is needed, at the latest at the end of the compile (see
+    check_parallel_renders).  It is exported as a files::TextReference.
+    """
+
+    def __init__(
+        self,
+        render: concurrent.futures.Future[str],
+        *,
+        owner: inmanta.ast.Locatable | None = None,
+        template_name: str = "",
+    ) -> None:
+        """
+        :param render: The future output of the render.
+        :param owner: The plugin call which rendered the template, the errors
+            of the render are reported at its location.
+        :param template_name: The name of the template, used in error messages.
+        """
+        super().__init__(None, None)
+        self._render = render
+        self._owner = owner
+        self._template_name = template_name
+
+    @property
+    def text(self) -> str:
+        try:
+            return self._render.result()
+        except Exception as e:
+            raise inmanta.ast.ExternalException(
+                self._owner,
+                f"Failed to render template {self._template_name} in a worker process",
+                e,
+            ) from e
+
+
+def check_parallel_renders() -> None:
+    """
+    Wait for the templates rendered in worker processes during the compile, so
+    that a failed render fails the compile, at the location of the plugin call
+    which rendered it, instead of failing the export.
+    """
+    renders = list(PARALLEL_RENDERS)
+    PARALLEL_RENDERS.clear()
+    for render in renders:
+        render.text
+
+
+# Attribute set on the inmanta.compiler module once the finalizer checking the
+# parallel renders is registered.  The compiler never forgets a finalizer, so
+# reloading this module must not register a new one.  The registered finalizer
+# looks the check up on the module when it runs, to always use the current
+# instance of this module.
+PARALLEL_RENDERS_FINALIZER = "__files_parallel_renders_finalizer__"
+if not getattr(inmanta.compiler, PARALLEL_RENDERS_FINALIZER, False):
+    inmanta.compiler.finalizer(lambda: sys.modules[__name__].check_parallel_renders())
+    setattr(inmanta.compiler, PARALLEL_RENDERS_FINALIZER, True)
+
+
 @plugin
 def create_text_reference(
     text: str | Reference[str],
@@ -333,6 +472,14 @@ def create_text_file_content_reference(
     return TextFileContentReference(resolve_path(file_path), None)
 
 
+# The text written in the template of a JinjaReference to print one of its
+# references, and the pattern matching it, capturing the name of the reference.
+REFERENCE_PLACEHOLDER = '{{% endraw %}}{{{{ references["{name}"] }}}}{{% raw %}}'
+REFERENCE_PLACEHOLDER_PATTERN = re.compile(
+    re.escape(REFERENCE_PLACEHOLDER.format(name="@")).replace("@", '([^"]*)')
+)
+
+
 @reference("files::JinjaReference")
 class JinjaReference(Reference[str]):
     """
@@ -353,13 +500,87 @@ class JinjaReference(Reference[str]):
     def resolve(self, logger: LoggerABC) -> str:
         env = jinja2.Environment(undefined=jinja2.StrictUndefined)
         tmpl = env.from_string(self.resolve_other(self.template, logger))
-        return tmpl.render(
-            references={
-                k: self.resolve_other(v, logger) for k, v in self.references.items()
-            },
+        return tmpl.render(references=self.resolve_references(logger))
+
+    def resolve_references(self, logger: LoggerABC) -> dict[str, str]:
+        """
+        Resolve all the references of this reference, concurrently, see
+        inmanta_plugins.files.resolution.resolve_all.
+        """
+        return inmanta_plugins.files.resolution.resolve_all(
+            self, self.references, logger
         )
 
 
+@reference("files::SplicedJinjaReference")
+class SplicedJinjaReference(JinjaReference):
+    """
+    JinjaReference whose template is only made of raw text and placeholders of
+    its references, as produced by the jinja plugin.  The offset of each
+    placeholder in the template is recorded when the reference is created, so
+    that it can be resolved by splicing the values of the references into the
+    text, instead of compiling and rendering the template with jinja.
+    """
+
+    def __init__(
+        self,
+        template: str | Reference[str],
+        references: Mapping[str, str | Reference[str]],
+        offsets: list[int],
+    ):
+        super().__init__(template, references)
+        self.offsets = offsets
+
+    def resolve(self, logger: LoggerABC) -> str:
+        template = self.resolve_other(self.template, logger)
+        return splice_references(
+            template, self.offsets, self.resolve_references(logger)
+        )
+
+
+def find_placeholders(text: str, offset: int = 0) -> list[tuple[int, str]]:
+    """
+    Find the placeholders of references in the given text.  Return the offset
+    and the name of the reference of each of them.
+
+    :param text: A part of the template of a JinjaReference.
+    :param offset: The offset of the text in the template.
+    """
+    return [
+        (offset + match.start(), match[1])
+        for match in REFERENCE_PLACEHOLDER_PATTERN.finditer(text)
+    ]
+
+
+def splice_references(
+    template: str, offsets: Sequence[int], references: Mapping[str, str]
+) -> str:
+    """
+    Resolve the template of a SplicedJinjaReference: drop the raw block
+    delimiters and replace each placeholder by the value of its reference.
+
+    :param template: The template, a raw block with placeholders.
+    :param offsets: The offset of each placeholder in the template, in order.
+    :param references: The value of each reference.
+    """
+    start, end = "{% raw %}", "{% endraw %}"
+    prefix, suffix = REFERENCE_PLACEHOLDER.format(name="\0").split("\0")
+    if not template.startswith(start) or not template.endswith(end):
+        raise ValueError("Invalid template, it should be a single raw block")
+
+    parts: list[str] = []
+    position = len(start)
+    for offset in offsets:
+        if offset < position or not template.startswith(prefix, offset):
+            raise ValueError(f"Invalid template, no placeholder at offset {offset}")
+        name_end = template.index(suffix, offset + len(prefix))
+        parts.append(template[position:offset])
+        parts.append(references[template[offset + len(prefix) : name_end]])
+        position = name_end + len(suffix)
+    parts.append(template[position : len(template) - len(end)])
+    return "".join(parts)
+
+
 @contextlib.contextmanager
 def jinja_deferred_context(file: str) -> typing.Iterator[dict[str, Reference[str]]]:
     # Setup a new dict and give away the context
@@ -430,9 +651,30 @@ def register_reference(value: str | Reference[str], *, resolve: bool = False) ->
             return value.resolve(PythonLogger(LOGGER))
 
     context = JINJA_DEFERRED_CONTEXT.get()
-    ref_id, _ = value.serialize_arguments()  # TODO: optimize this
-    context[str(ref_id)] = value
-    return f'{{% endraw %}}{{{{ references["{str(ref_id)}"] }}}}{{% raw %}}'
+    ref_id = get_reference_id(value)
+    context[ref_id] = value
+    return REFERENCE_PLACEHOLDER.format(name=ref_id)
+
+
+def get_reference_id(value: Reference) -> str:
+    """
+    Get the id of the given reference, serializing it only if this reference
+    has not been serialized before during this compile.
+
+    :param value: The reference to get the id of.
+    """
+    cached = REFERENCE_IDS.get(id(value))
+    if cached is not None and cached[0] is value:
+        REFERENCE_ID_STATS.hits += 1
+        return cached[1]
+
+    REFERENCE_ID_STATS.misses += 1
+    ref_id = str(value.serialize_arguments()[0])
+
+    # Keep a reference to the object, so that its id is not reused by another
+    # object during this compile
+    REFERENCE_IDS[id(value)] = (value, ref_id)
+    return ref_id
 
 
 def auto_register_reference[R: Reference](ref_cls: type[R]) -> type[R]:
@@ -441,41 +683,70 @@ def auto_register_reference[R: Reference](ref_cls: type[R]) -> type[R]:
     in a template as a terminal value should automatically register said instance
     in the current jinja reference context.
 
-    The actual __str__ patching is done temporarily, for the duration of a jinja
-    render only, by ``allow_references_in_templates``.  Here we only collect the
-    classes that should be patched.
+    The patched __str__ method only registers the reference for the duration of
+    a jinja render, see ``patch_reference_str``.
     """
     REFERENCE_CLASSES.append(ref_cls)
+    patch_reference_str(ref_cls)
     return ref_cls
 
 
+install_patches()
 auto_register_reference(Reference)
 auto_register_reference(FactReference)
 
 
-def get_jinja_env(ctx: Context) -> jinja2.Environment:
+def plugin_filter(name: str) -> typing.Callable:
     """
-    Helper to construct a jinja environment that can be used with the inmanta
-    dsl.  It loads all the plugins as filters and wraps the dynamic proxy
-    objects into jinja specific proxies.
-    """
-    env = jinja2.Environment(undefined=jinja2.StrictUndefined)
+    Build the jinja filter calling the plugin with the given name.  The plugin
+    is looked up, and called, in the context of the jinja render which uses the
+    filter, so that the filter can be reused by the renders of any compile.
 
-    # Registering all plugins as filters
-    def curywrapper(func: Plugin) -> typing.Callable:
-        def safewrapper(*args, **kwargs) -> typing.Any:
+    :param name: The full name of the plugin, e.g. files::path_join
+    """
 
-            # Make sure that a plugin with a Context argument can be called
-            # inside a template
-            if func._context != -1:
-                new_args = list(args)
-                new_args.insert(func._context, ctx)
-                args = tuple(new_args)
+    def safewrapper(*args, **kwargs) -> typing.Any:
+        ctx = JINJA_CONTEXT.get()
+        func = ctx.get_compiler().get_plugins()[name]
+
+        # Simple plugins called with primitive values don't need the compiler
+        # to validate their arguments and wrap their result, call them directly
+        direct_call = get_direct_call(func)
+        if direct_call is not None and direct_call.accepts(args, kwargs):
+            return direct_call.call(
+                func,
+                inmanta.ast.Range(JINJA_FILE.get(), 0, 0, 0, 0),
+                args,
+                kwargs,
+            )
 
-            # Execute the plugin
+        # Templates rendered by another template are often rendered with the
+        # same arguments, e.g. in a loop
+        nested_key = (
+            get_nested_render_key(name, args, kwargs)
+            if name in NESTED_RENDER_PLUGINS
+            else None
+        )
+        if nested_key is not None:
+            nested = NESTED_RENDERS.get(nested_key)
+            if nested is not None:
+                NESTED_RENDER_STATS.hits += 1
+                return JinjaDynamicProxy.return_value(nested[1])
+            NESTED_RENDER_STATS.misses += 1
+
+        # Make sure that a plugin with a Context argument can be called
+        # inside a template
+        call_args = list(args)
+        if func._context != -1:
+            call_args.insert(func._context, ctx)
+
+        # Execute the plugin.  The values it is waiting for are added to the
+        # values this render is waiting for, so that the discovery render
+        # keeps going (see collect_or_raise).
+        try:
             value = func.call_in_context(
                 processed_args=CheckedArgs(
-                    args=list(args),
+                    args=call_args,
                     kwargs=kwargs,
                     unknowns=False,
                 ),
@@ -483,25 +754,309 @@ def get_jinja_env(ctx: Context) -> jinja2.Environment:
                 queue=ctx.queue,
                 location=inmanta.ast.Range(JINJA_FILE.get(), 0, 0, 0, 0),
             )
+        except (inmanta.ast.UnsetException, inmanta.ast.MultiUnsetException) as e:
+            return collect_or_raise(e)
+
+        if nested_key is not None:
+            NESTED_RENDERS[nested_key] = ((args, kwargs), value)
+
+        # If we get a dynamic proxy, make sure to wrap it in case it
+        # contains unset attributes.
+        return JinjaDynamicProxy.return_value(value)
+
+    return safewrapper
+
+
+def get_nested_render_key(
+    name: str, args: Sequence[object], kwargs: Mapping[str, object]
+) -> tuple[object, ...] | None:
+    """
+    Get the key of a call of the given plugin as filter in the nested render
+    cache.  Entities (and the other values of the model) are identified by
+    the instance behind their proxy, other values by their value.  Return None
+    if some argument can't be identified.
+    """
+
+    def identity(value: object) -> object:
+        if isinstance(value, DynamicProxy):
+            return ("instance", id(value._get_instance()))
+        hash(value)
+        return (type(value), value)
+
+    try:
+        return (
+            name,
+            tuple(identity(arg) for arg in args),
+            tuple(sorted((k, identity(v)) for k, v in kwargs.items())),
+        )
+    except TypeError:
+        # Not hashable
+        return None
+
 
-            # If we get a dynamic proxy, make sure to wrap it in case it
-            # contains unset attributes.
-            return JinjaDynamicProxy.return_value(value)
+class PluginFilters(MutableMapping[str, typing.Callable]):
+    """
+    The filters of a jinja environment, where all the plugins of the compile are
+    available as filters (e.g. files.path_join for files::path_join).  Most
+    plugins are never used in a template, so the filter of a plugin is only
+    built the first time it is looked up.
+    """
 
-        return safewrapper
+    def __init__(
+        self,
+        filters: Mapping[str, typing.Callable],
+        plugins: Collection[str],
+    ) -> None:
+        """
+        :param filters: The filters of the environment which are not plugins.
+        :param plugins: The full names of all the plugins of the compile.
+        """
+        self._plugins = {name.replace("::", "."): name for name in plugins}
+        self._filters = {k: v for k, v in filters.items() if k not in self._plugins}
 
-    for name, cls in ctx.get_compiler().get_plugins().items():
-        env.filters[name.replace("::", ".")] = curywrapper(cls)
+    def __getitem__(self, key: str) -> typing.Callable:
+        if key in self._filters:
+            return self._filters[key]
+
+        # Raises KeyError if there is no such plugin
+        self._filters[key] = plugin_filter(self._plugins[key])
+        return self._filters[key]
+
+    def __setitem__(self, key: str, value: typing.Callable) -> None:
+        self._plugins.pop(key, None)
+        self._filters[key] = value
+
+    def __delitem__(self, key: str) -> None:
+        if key not in self._filters and key not in self._plugins:
+            raise KeyError(key)
+        self._filters.pop(key, None)
+        self._plugins.pop(key, None)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._filters or key in self._plugins
+
+    def __iter__(self) -> typing.Iterator[str]:
+        yield from self._filters
+        yield from (k for k in self._plugins if k not in self._filters)
+
+    def __len__(self) -> int:
+        return len(self._filters) + sum(
+            1 for k in self._plugins if k not in self._filters
+        )
+
+
+class TemplateLoader(jinja2.BaseLoader):
+    """
+    Loader for the templates included, imported or extended by other templates.
+    The name of a template is resolved like the path given to the jinja plugin,
+    e.g. template://mymodule/macros.j2.  A name without scheme is the path of a
+    template in the templates folder of a module (mymodule/macros.j2) or of the
+    project (/macros.j2).  The compiled code of the templates is shared with the
+    templates rendered by the jinja plugin (see
+    inmanta_plugins.files.cache.load_template).
+    """
 
+    def resolve(self, template: str) -> str:
+        """
+        Resolve the name of a template into the path of its file.
+        """
+        try:
+            return resolve_path(
+                template if "://" in template else f"template://{template}"
+            )
+        except ValueError:
+            raise jinja2.TemplateNotFound(template)
+
+    def get_source(
+        self, environment: jinja2.Environment, template: str
+    ) -> tuple[str, str, typing.Callable[[], bool]]:
+        path = self.resolve(template)
+        try:
+            source = pathlib.Path(path).read_text()
+        except OSError:
+            raise jinja2.TemplateNotFound(template)
+        mtime = os.path.getmtime(path)
+        return source, path, lambda: os.path.getmtime(path) == mtime
+
+    def load(
+        self,
+        environment: jinja2.Environment,
+        name: str,
+        globals: typing.MutableMapping[str, typing.Any] | None = None,
+    ) -> jinja2.Template:
+        path = self.resolve(name)
+        try:
+            template, _ = inmanta_plugins.files.cache.load_template(
+                environment, path, globals
+            )
+        except OSError:
+            raise jinja2.TemplateNotFound(name)
+        return template
+
+
+def get_jinja_env(ctx: Context) -> jinja2.Environment:
+    """
+    Helper to construct a jinja environment that can be used with the inmanta
+    dsl.  It loads all the plugins as filters and wraps the dynamic proxy
+    objects into jinja specific proxies.  The environment built by a previous
+    compile is reused if the compile has the same set of plugins.
+    """
+    global JINJA_REUSABLE_ENV
+
+    plugins = frozenset(ctx.get_compiler().get_plugins())
+    if JINJA_REUSABLE_ENV is not None and JINJA_REUSABLE_ENV[0] == plugins:
+        return JINJA_REUSABLE_ENV[1]
+
+    # Templates loaded by name are cached by the environment, and are only
+    # reloaded by the next compile, see inmanta_reset_state.
+    env = jinja2.Environment(
+        undefined=jinja2.StrictUndefined,
+        loader=TemplateLoader(),
+        auto_reload=False,
+    )
+
+    # Registering all plugins as filters.  Jinja only uses the mapping interface
+    # of its filters, which PluginFilters implements lazily.
+    env.filters = typing.cast(
+        dict[str, typing.Callable], PluginFilters(env.filters, plugins)
+    )
+
+    JINJA_REUSABLE_ENV = (plugins, env)
     return env
 
 
+# --- Template skeletons ------------------------------------------------------
+#
+# When a template outputs a reference, its whole output is uploaded to the
+# server, to be rendered again by the agent.  The same template rendered for
+# many hosts, which only differ by a password for example, would then upload
+# one nearly identical file per host.  In skeleton mode, every value written by
+# the template, reference or not, is replaced by a placeholder named after its
+# position, and passed to the JinjaReference as one of its references.  The
+# uploaded file only contains the static text of the template, it is identical
+# for all the hosts and only uploaded once.
+
+
+@dataclasses.dataclass(kw_only=True)
+class SkeletonParameters:
+    """
+    The values written by a template rendered in skeleton mode.
+
+    :attr marker: The prefix of the placeholders of this render, unique so that
+        they can't be confused with the text of the template.
+    :attr values: The value of each placeholder, by index.
+    """
+
+    marker: str = dataclasses.field(default_factory=lambda: uuid.uuid4().hex)
+    values: list[str | Reference[str]] = dataclasses.field(default_factory=list)
+
+    def render(self, text: str) -> str:
+        """
+        Replace each placeholder in the given text by its value.  Only valid
+        when none of the values is a reference.
+        """
+        return re.sub(
+            f"\0{self.marker}:([0-9]+)\0",
+            lambda match: str(self.values[int(match[1])]),
+            text,
+        )
+
+    def skeleton(self, text: str) -> str:
+        """
+        Replace each placeholder in the given text by the jinja expression
+        reading its value from the references of the JinjaReference.
+        """
+        return re.sub(
+            f"\0{self.marker}:([0-9]+)\0",
+            lambda match: REFERENCE_PLACEHOLDER.format(name=f"parameter_{match[1]}"),
+            text,
+        )
+
+    def resolve(self, skeleton: str) -> str:
+        """
+        Replace each jinja expression in the given skeleton by the value it
+        reads, without rendering the skeleton.  Only valid when none of the
+        values is a reference.
+        """
+        return REFERENCE_PLACEHOLDER_PATTERN.sub(
+            lambda match: str(self.values[int(match[1].removeprefix("parameter_"))]),
+            skeleton,
+        )
+
+    def references(
+        self, references: Mapping[str, Reference[str]]
+    ) -> dict[str, str | Reference[str]]:
+        """
+        Get the references of the JinjaReference of the skeleton: the value of
+        each placeholder, and the given references which are not printed
+        through a placeholder (e.g. a reference passed to a filter).
+        """
+        result: dict[str, str | Reference[str]] = {
+            f"parameter_{index}": value for index, value in enumerate(self.values)
+        }
+        for name, value in references.items():
+            if not any(value is parameter for parameter in self.values):
+                result[name] = value
+        return result
+
+
+JINJA_SKELETON_PARAMETERS: contextvars.ContextVar[SkeletonParameters | None] = (
+    contextvars.ContextVar("files_jinja_skeleton_parameters", default=None)
+)
+
+
+@jinja2.pass_context
+def skeleton_finalize(context: jinja2.runtime.Context, value: object) -> object:
+    """
+    Finalize function of the skeleton environment: replace each value written
+    by the template by a placeholder.  Passing the context prevents jinja from
+    finalizing the constants of the template at compile time.
+    """
+    parameters = JINJA_SKELETON_PARAMETERS.get()
+    if parameters is None or isinstance(value, jinja2.Undefined):
+        return value
+
+    # References print their placeholder, see auto_register_reference
+    text = str(value)
+    reference = REFERENCE_PLACEHOLDER_PATTERN.fullmatch(text)
+    if reference is not None:
+        # A reference, registered in the deferred context under an id which
+        # depends on the reference, give it a placeholder as well
+        parameters.values.append(JINJA_DEFERRED_CONTEXT.get()[reference[1]])
+    elif parameters.marker in text or "{% endraw %}" in text:
+        # The value already contains placeholders or references, keep it in
+        # the skeleton
+        return text
+    else:
+        parameters.values.append(text)
+
+    return f"\0{parameters.marker}:{len(parameters.values) - 1}\0"
+
+
+def get_skeleton_env(env: jinja2.Environment) -> jinja2.Environment:
+    """
+    Get the environment rendering the templates of the given environment in
+    skeleton mode.  It shares the filters and the loader of the given
+    environment.
+    """
+    global JINJA_SKELETON_ENV
+
+    if JINJA_SKELETON_ENV is None or JINJA_SKELETON_ENV[0] is not env:
+        JINJA_SKELETON_ENV = (env, env.overlay(finalize=skeleton_finalize))
+    return JINJA_SKELETON_ENV[1]
+
+
 @plugin
 def jinja(
     ctx: Context,
     template_path: str,
+    *,
+    stream_output: bool = False,
+    snapshot: bool = False,
+    skeleton: bool = False,
+    parallel: bool = False,
     **kwargs: object,
-) -> JinjaReference | str:
+) -> JinjaReference | TextReference | str:
     """
     Resolve a jinja template located at the given path, with all the keyword arguments
     as input.  If any reference is emitted and not converted to a primitive, the plugin
@@ -509,6 +1064,26 @@ def jinja(
     where the reference is known.
 
     :param template_path: The path to the template in the project
+    :param stream_output: Write the output of the template directly into the snapshot
+        uploaded to the server when a reference is emitted, instead of building it
+        in memory first.  This limits the memory used to render very large files.
+    :param snapshot: Once all the values the template could read from its inputs are
+        set, convert the inputs into plain values and render the template with them,
+        instead of going through the dynamic proxies of the model for each read.
+        This speeds up templates doing a lot of reads, e.g. in loops.  Templates
+        passing entities to filters are always rendered with the proxies.
+    :param skeleton: When a reference is emitted, only upload the static text of the
+        template, and pass all the values it writes to the returned reference
+        alongside the references.  The same template rendered for many hosts is then
+        uploaded once, instead of once per host.  Templates using macros, call
+        blocks, filter blocks, block assignments, imports or includes are always
+        uploaded with their values.
+    :param parallel: Once all the values the template could read from its inputs are
+        set, render the template in a worker process, in parallel of the compiler,
+        and return a reference to its output.  The output is collected at the end of
+        the compile, a failed render fails the compile at the location of this call.
+        Only templates using the builtin filters and tests of jinja, and not loading
+        other templates, are rendered this way.
     :param **kwargs: Input to the template
     """
     # Resolve the full path of the template
@@ -521,38 +1096,235 @@ def jinja(
 
     # Reading the template string and building the template object.  Compiling
     # the template is expensive, so reuse the compiled object across the many
-    # renders of the same template within a single compile.
-    template = JINJA_TEMPLATE_CACHE.get(template_path)
-    if template is None:
-        template_string = pathlib.Path(template_path).read_text()
-        template = JINJA_ENV.from_string(template_string)
-        JINJA_TEMPLATE_CACHE[template_path] = template
-
-    # Wrap kwargs so that optional inmanta relations behave as Jinja Undefined
-    # rather than raising OptionalValueException at attribute access time.
-    wrapped_kwargs = {
-        key: JinjaDynamicProxy.return_value(value) for key, value in kwargs.items()
-    }
+    # renders of the same template within a single compile, and reuse the code
+    # compiled by a previous compile when the template didn't change.
+    cached_template = JINJA_TEMPLATE_CACHE.get(template_path)
+    if cached_template is None:
+        cached_template = inmanta_plugins.files.cache.load_template(
+            JINJA_ENV, template_path
+        )
+        JINJA_TEMPLATE_CACHE[template_path] = cached_template
+    template, compiled = cached_template
+
+    skeleton = skeleton and compiled.get_analysis(JINJA_ENV).parametrizable
+    if skeleton:
+        # Same template, compiled with the skeleton finalize function
+        cached_template = JINJA_SKELETON_TEMPLATE_CACHE.get(template_path)
+        if cached_template is None:
+            cached_template = inmanta_plugins.files.cache.load_template(
+                get_skeleton_env(JINJA_ENV), template_path
+            )
+            JINJA_SKELETON_TEMPLATE_CACHE[template_path] = cached_template
+        template, compiled = cached_template
+
+    return render_template(
+        ctx,
+        JINJA_ENV,
+        template_path,
+        template,
+        compiled,
+        kwargs,
+        stream_output=stream_output,
+        snapshot=snapshot,
+        skeleton=skeleton,
+        parallel=parallel,
+    )
+
+
+@plugin
+def jinja_inline(
+    ctx: Context,
+    template_source: str,
+    *,
+    stream_output: bool = False,
+    snapshot: bool = False,
+    skeleton: bool = False,
+    parallel: bool = False,
+    **kwargs: object,
+) -> JinjaReference | TextReference | str:
+    """
+    Resolve a jinja template given as a string, with all the keyword arguments as
+    input.  This behaves exactly like the jinja plugin, but for small templates
+    which don't deserve their own file.
+
+    :param template_source: The source of the template
+    :param stream_output: See the jinja plugin
+    :param snapshot: See the jinja plugin
+    :param skeleton: See the jinja plugin
+    :param parallel: See the jinja plugin
+    :param **kwargs: Input to the template
+    """
+    # Setting up the jinja2 environment
+    global JINJA_ENV
+    if JINJA_ENV is None:
+        JINJA_ENV = get_jinja_env(ctx)
+
+    # The same snippets are rendered many times, the compiled templates are
+    # cached by source
+    template, compiled = inmanta_plugins.files.cache.load_inline_template(
+        JINJA_ENV, template_source
+    )
+
+    skeleton = skeleton and compiled.get_analysis(JINJA_ENV).parametrizable
+    if skeleton:
+        template, compiled = inmanta_plugins.files.cache.load_inline_template(
+            get_skeleton_env(JINJA_ENV), template_source
+        )
+
+    return render_template(
+        ctx,
+        JINJA_ENV,
+        f"<inline template {compiled.checksum[:12]}>",
+        template,
+        compiled,
+        kwargs,
+        stream_output=stream_output,
+        snapshot=snapshot,
+        skeleton=skeleton,
+        parallel=parallel,
+    )
+
+
+def render_template(
+    ctx: Context,
+    env: jinja2.Environment,
+    template_name: str,
+    template: jinja2.Template,
+    compiled: "inmanta_plugins.files.cache.CompiledTemplate",
+    kwargs: Mapping[str, object],
+    *,
+    stream_output: bool = False,
+    snapshot: bool = False,
+    skeleton: bool = False,
+    parallel: bool = False,
+) -> JinjaReference | TextReference | str:
+    """
+    Render a template for the jinja plugins, see the jinja plugin for more
+    details.
+
+    :param ctx: The context of the plugin call.
+    :param env: The jinja environment of the compile, see get_jinja_env.
+    :param template_name: The name of the template, used in error messages.
+    :param template: The template to render, bound to env, or to the skeleton
+        environment derived from it in skeleton mode.
+    :param compiled: The compiled template the template was built from.
+    :param kwargs: The inputs of the template.
+    :param stream_output: See the jinja plugin.
+    :param snapshot: See the jinja plugin.
+    :param skeleton: Render the template in skeleton mode, only for templates
+        which are parametrizable (see TemplateAnalysis).
+    :param parallel: See the jinja plugin.
+    """
+    # Most of the values a template reads are read by every render of it.  If
+    # any of them is not set yet, the render would be discarded, so wait for all
+    # of them at once without rendering the template at all.  The same goes for
+    # the values previous renders of this template had to wait for.  Other
+    # values read conditionally are still discovered by the render below.
+    unset = inmanta_plugins.files.cache.get_unset(env, compiled, kwargs)
+    if unset:
+        raise inmanta.ast.MultiUnsetException(
+            f"Template {template_name} accessed values that were not set yet",
+            unset,
+        )
+
+    # The same template is often rendered with structurally identical inputs
+    # (e.g. the same unit file on many hosts).  If the values this template
+    # reads from its inputs are the same as in a previous render, reuse its
+    # output.  No key can be computed while some of these values are unset.
+    # The output of templates which only depend on their inputs can also be
+    # reused from a previous compile, see the persistent render cache.
+    analysis = compiled.get_analysis(env)
+    render_key = inmanta_plugins.files.cache.get_render_key(env, compiled, kwargs)
+    if render_key is not None:
+        cached_output = inmanta_plugins.files.cache.get_rendered(
+            render_key, persistent=analysis.standalone
+        )
+        if cached_output is not None:
+            return cached_output
+
+    if parallel and analysis.standalone:
+        # Render with plain copies of the inputs in a worker process, this is
+        # only possible when all the values the template could read are set
+        inputs = inmanta_plugins.files.analysis.snapshot(analysis, kwargs)
+        if inputs is not None and inmanta_plugins.files.workers.is_plain(inputs):
+            render = inmanta_plugins.files.workers.submit(compiled.source, inputs)
+            if render is not None:
+                # The output is not saved in the render cache, the same render
+                # without parallel must get the text itself
+                deferred = RenderedTextReference(
+                    render, owner=ctx.owner, template_name=template_name
+                )
+                PARALLEL_RENDERS.append(deferred)
+                return deferred
+
+    wrapped_kwargs: dict[str, object] | None = None
+    if snapshot:
+        # Convert the inputs into plain values, this is only possible when all
+        # the values the template could read are set.  Otherwise, render with
+        # the proxies, to discover the unset values.
+        wrapped_kwargs = inmanta_plugins.files.analysis.snapshot(analysis, kwargs)
+
+    if wrapped_kwargs is None:
+        # Wrap kwargs so that optional inmanta relations behave as Jinja Undefined
+        # rather than raising OptionalValueException at attribute access time.
+        wrapped_kwargs = {
+            key: JinjaDynamicProxy.return_value(value) for key, value in kwargs.items()
+        }
 
     # Render once in discovery mode: collect every unset model value instead of
     # aborting at the first one (see collect_or_raise).  If any were missing,
     # wait for the whole batch at once rather than rescheduling per miss.
     #
     # In order to use references in templates, we also need to monkeypatch core
-    # and std.  This is done only for the duration of the render, so the patches
-    # never leak to code running outside of a jinja render.
+    # and std.  The patches are installed once, and are only active while the
+    # render hooks are set, so they never leak to code running outside of a
+    # jinja render.
     collector: set[object] = set()
     batch_unset = inmanta.ast.MultiUnsetException(
-        f"Template {template_path} accessed values that were not set yet",
+        f"Template {template_name} accessed values that were not set yet",
         # filled in below once the discovery pass has run
         [],
     )
+    parameters = SkeletonParameters() if skeleton else None
     token = JINJA_UNSET_COLLECTOR.set(collector)
+    ctx_token = JINJA_CONTEXT.set(ctx)
+    parameters_token = JINJA_SKELETON_PARAMETERS.set(parameters)
+    hooks_token = JINJA_RENDER_HOOKS.set(
+        RenderHooks(
+            register_reference=register_reference,
+            collect_or_raise=collect_or_raise,
+        )
+    )
     try:
-        with allow_references_in_templates(REFERENCE_CLASSES, register_reference):
-            with collect_unset_values(collect_or_raise):
-                with jinja_deferred_context(template_path) as context:
-                    rendered = template.render(wrapped_kwargs)
+        with jinja_deferred_context(template_name) as context:
+            if stream_output:
+                # The output is only written into a snapshot once the template
+                # emitted a reference, until then the chunks are kept as is,
+                # they are the output itself if no reference is emitted.
+                output: inmanta_plugins.files.upload.SnapshotWriter | None = None
+                chunks: list[str] = []
+                placeholders: list[tuple[int, str]] = []
+                offset = len("{% raw %}")
+                for chunk in template.generate(wrapped_kwargs):
+                    # Each chunk holds whole placeholders
+                    if parameters is not None:
+                        chunk = parameters.skeleton(chunk)
+                    placeholders.extend(find_placeholders(chunk, offset))
+                    offset += len(chunk)
+                    if output is None and len(context) > 0:
+                        output = inmanta_plugins.files.upload.SnapshotWriter()
+                        output.write("{% raw %}")
+                        for previous in chunks:
+                            output.write(previous)
+                        chunks.clear()
+                    if output is None:
+                        chunks.append(chunk)
+                    else:
+                        output.write(chunk)
+                if output is not None:
+                    output.write("{% endraw %}")
+            else:
+                rendered = template.render(wrapped_kwargs)
     except (inmanta.ast.UnsetException, inmanta.ast.MultiUnsetException):
         # Raised by a nested template/plugin: propagate unchanged.
         raise
@@ -563,23 +1335,67 @@ def jinja(
         # them: wait for the batch and retry.  A genuine error surfaces
         # unchanged on the final pass, where nothing is collected.
         if collector:
+            inmanta_plugins.files.cache.learn_unset(env, compiled, kwargs, collector)
             batch_unset.result_variables = list(collector)
             raise batch_unset from None
         if isinstance(e, jinja2.exceptions.UndefinedError):
             raise inmanta.ast.NotFoundException(ctx.owner, "", e.message)
         raise
     finally:
+        JINJA_RENDER_HOOKS.reset(hooks_token)
+        JINJA_SKELETON_PARAMETERS.reset(parameters_token)
+        JINJA_CONTEXT.reset(ctx_token)
         JINJA_UNSET_COLLECTOR.reset(token)
 
     if collector:
+        # Next renders of this template will check these values first
+        inmanta_plugins.files.cache.learn_unset(env, compiled, kwargs, collector)
         batch_unset.result_variables = list(collector)
         raise batch_unset
 
-    if len(context) == 0:
+    if stream_output:
+        if output is None:
+            # No reference to resolve later on
+            text = "".join(chunks)
+            if parameters is not None:
+                text = parameters.resolve(text)
+            result: JinjaReference | TextReference | str = text
+        else:
+            # The snapshot is already collected, the reference only holds its
+            # hash
+            references: Mapping[str, str | Reference[str]] = (
+                context if parameters is None else parameters.references(context)
+            )
+            result = SplicedJinjaReference(
+                template=TextReference(None, output.collect()),
+                references=references,
+                offsets=[offset for offset, name in placeholders if name in references],
+            )
+    elif len(context) == 0:
         # No reference to resolve later on
-        return rendered
+        result = rendered if parameters is None else parameters.render(rendered)
     else:
-        return JinjaReference(
-            template=create_text_reference("{% raw %}" + rendered + "{% endraw %}"),
-            references=context,
+        if parameters is None:
+            references = context
+        else:
+            # Only the static text of the template is uploaded, the values are
+            # passed along with the references
+            rendered = parameters.skeleton(rendered)
+            references = parameters.references(context)
+
+        text = "{% raw %}" + rendered + "{% endraw %}"
+        result = SplicedJinjaReference(
+            template=create_text_reference(text),
+            references=references,
+            offsets=[
+                offset for offset, name in find_placeholders(text) if name in references
+            ],
         )
+
+    if render_key is not None:
+        # No unset value was collected, this output is final
+        inmanta_plugins.files.cache.save_rendered(
+            render_key, result, persistent=analysis.standalone
+        )
+
+    return result
@@ -0,0 +1,797 @@
+"""
+Copyright 2026 Guillaume Everarts de Velp
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Contact: edvgui@gmail.com
+"""
+
+import contextlib
+import hashlib
+import types
+from collections.abc import Collection, Iterable, Iterator, Mapping, Sequence
+from dataclasses import dataclass, field
+
+import jinja2.filters
+import jinja2.tests
+from jinja2 import nodes
+
+import inmanta.plugins
+from inmanta.ast import NotFoundException, OptionalValueException, UnsetException
+from inmanta.execute.proxy import DynamicProxy, SequenceProxy, UnknownException
+from inmanta.references import Reference
+
+# Step of an attribute path meaning "each item of the collection", used for
+# the values iterated over in a for loop.
+ITEMS = None
+
+# Tests which only look at whether a value is defined or null, not at the
+# value itself.
+PRESENCE_TESTS = {"defined", "undefined", "none"}
+
+# Prefix of the fingerprints which are only valid for the current compile,
+# because they identify some of the values read by the template by identity.
+LOCAL_FINGERPRINT_PREFIX = "local-"
+
+# Statements whose rendered output is consumed by the template itself instead
+# of being written as is, e.g. passed to a filter or returned by a macro.
+CAPTURING_STATEMENTS: tuple[type[nodes.Stmt], ...] = (
+    nodes.Macro,
+    nodes.CallBlock,
+    nodes.FilterBlock,
+    nodes.AssignBlock,
+    nodes.Import,
+    nodes.FromImport,
+    nodes.Include,
+    nodes.Extends,
+)
+
+# Statements loading another template
+LOADING_STATEMENTS: tuple[type[nodes.Stmt], ...] = (
+    nodes.Import,
+    nodes.FromImport,
+    nodes.Include,
+    nodes.Extends,
+)
+
+
+class Uncacheable(Exception):
+    """
+    Raised when the output of a template can not be derived from the values
+    it reads from its inputs.
+    """
+
+
+class _Absent:
+    """
+    Marker for a value that a template would see as undefined.
+    """
+
+    def __repr__(self) -> str:
+        return "<absent>"
+
+
+ABSENT = _Absent()
+
+
+@dataclass(kw_only=True)
+class PathNode:
+    """
+    A node in the tree of attribute paths a template reads from one of its
+    inputs.
+
+    :attr children: The paths read from the value at this node, keyed by the
+        attribute name (or index) leading to them, or ITEMS for the items of
+        an iterated collection.
+    :attr value: Whether the value at this node is used as a whole (printed,
+        passed to a filter, compared, ...).
+    :attr test: Whether the value at this node is tested (is defined, is none,
+        truthiness).
+    :attr required: Whether the value at this node is read by every render of
+        the template, regardless of the values it reads before.
+    """
+
+    children: dict[str | int | None, "PathNode"] = field(default_factory=dict)
+    value: bool = False
+    test: bool = False
+    required: bool = False
+
+    def child(self, step: str | int | None) -> "PathNode":
+        return self.children.setdefault(step, PathNode())
+
+
+@dataclass(kw_only=True)
+class TemplateAnalysis:
+    """
+    The result of the static analysis of a template.
+
+    :attr roots: For each variable read by the template, the tree of the
+        attribute paths it reads from it.
+    :attr cacheable: False when the template does something the analysis can't
+        follow (e.g. include another template with its context), in which case
+        its output can't be derived from the paths in roots alone.
+    :attr parametrizable: False when some of the output of the template is
+        consumed by the template itself (e.g. a macro or a filter block), in
+        which case the values it outputs can't be replaced by placeholders.
+    :attr standalone: False when the template needs more than its inputs and
+        the builtins of jinja to be rendered, e.g. it uses a plugin as filter
+        or it loads another template.
+    """
+
+    roots: dict[str, PathNode] = field(default_factory=dict)
+    cacheable: bool = True
+    parametrizable: bool = True
+    standalone: bool = True
+
+
+type Path = tuple[str, tuple[str | int | None, ...]]
+
+
+class _Visitor:
+    """
+    Walk a template AST and collect the attribute paths it reads from the
+    variables it is rendered with.  Loop variables and assignments of such
+    paths are followed, other local variables are ignored.
+    """
+
+    def __init__(self) -> None:
+        self.analysis = TemplateAnalysis()
+        self.conditional = False
+
+    @contextlib.contextmanager
+    def branch(self) -> Iterator[None]:
+        """
+        Mark all the paths read within this context as conditional: they are
+        only read by some renders, depending on the values read before.
+        """
+        conditional = self.conditional
+        self.conditional = True
+        try:
+            yield None
+        finally:
+            self.conditional = conditional
+
+    def reach(self, path: Path) -> PathNode:
+        """
+        Get the node of the given path, all the values along the path are read
+        by the template to reach it.
+        """
+        root, steps = path
+        node = self.analysis.roots.setdefault(root, PathNode())
+        node.required |= not self.conditional
+        for step in steps:
+            node = node.child(step)
+            node.required |= not self.conditional
+        return node
+
+    def record(self, path: Path, *, test: bool = False) -> PathNode:
+        node = self.reach(path)
+        if test:
+            node.test = True
+        else:
+            node.value = True
+        return node
+
+    def resolve(self, node: nodes.Node, scope: dict[str, Path | None]) -> Path | None:
+        """
+        Resolve an expression into the attribute path it reads, if it is one.
+        """
+        match node:
+            case nodes.Name(name=name):
+                return scope[name] if name in scope else (name, ())
+            case nodes.Getattr(node=base, attr=attr):
+                path = self.resolve(base, scope)
+                return (path[0], path[1] + (attr,)) if path is not None else None
+            case nodes.Getitem(node=base, arg=nodes.Const(value=str() | int() as key)):
+                if isinstance(key, bool):
+                    return None
+                path = self.resolve(base, scope)
+                return (path[0], path[1] + (key,)) if path is not None else None
+            case _:
+                return None
+
+    def expression(
+        self,
+        node: nodes.Node | None,
+        scope: dict[str, Path | None],
+        *,
+        test: bool = False,
+    ) -> None:
+        if node is None:
+            return
+
+        path = self.resolve(node, scope)
+        if path is not None:
+            self.record(path, test=test)
+            return
+
+        match node:
+            case nodes.Test(node=base, name=name):
+                self.expression(base, scope, test=name in PRESENCE_TESTS)
+                self.arguments(node, scope)
+            case nodes.Filter(node=base):
+                self.expression(base, scope)
+                self.arguments(node, scope)
+            case nodes.Call(node=nodes.Getattr(node=base)):
+                # Method call on a value, e.g. dict.items()
+                self.expression(base, scope)
+                self.arguments(node, scope)
+            case nodes.Call(node=base):
+                self.expression(base, scope)
+                self.arguments(node, scope)
+            case nodes.CondExpr(test=condition, expr1=expr1, expr2=expr2):
+                self.expression(condition, scope, test=True)
+                with self.branch():
+                    self.expression(expr1, scope)
+                    self.expression(expr2, scope)
+            case nodes.And() | nodes.Or():
+                self.expression(node.left, scope, test=test)
+                with self.branch():
+                    self.expression(node.right, scope, test=test)
+            case nodes.Not(node=base):
+                self.expression(base, scope, test=True)
+            case nodes.ContextReference() | nodes.DerivedContextReference():
+                # The whole context is used
+                self.analysis.cacheable = False
+            case _:
+                for child in node.iter_child_nodes():
+                    self.expression(child, scope)
+
+    def arguments(
+        self,
+        node: nodes.Filter | nodes.Test | nodes.Call,
+        scope: dict[str, Path | None],
+    ) -> None:
+        for arg in node.args:
+            self.expression(arg, scope)
+        for kwarg in node.kwargs:
+            self.expression(kwarg.value, scope)
+        self.expression(node.dyn_args, scope)
+        self.expression(node.dyn_kwargs, scope)
+
+    def assign(
+        self, target: nodes.Node, scope: dict[str, Path | None], path: Path | None
+    ) -> None:
+        """
+        Bind the names of an assignment target in the given scope.
+        """
+        match target:
+            case nodes.Name(name=name):
+                scope[name] = path
+            case _:
+                for name_node in target.find_all(nodes.Name):
+                    scope[name_node.name] = None
+
+    def merge_scopes(
+        self,
+        scope: dict[str, Path | None],
+        branch_scopes: list[dict[str, Path | None]],
+    ) -> None:
+        """
+        Update the given scope with the variables set by the branches of a
+        conditional statement, one of which is taken by each render.  A
+        variable bound to different paths by different branches can't be
+        followed anymore: all of these paths are then used as a whole.
+        """
+        names = {name for branch_scope in branch_scopes for name in branch_scope}
+        for name in names:
+            # An unset variable is looked up in the inputs of the template
+            paths = {
+                branch_scope.get(name, (name, ())) for branch_scope in branch_scopes
+            }
+            if len(paths) == 1:
+                scope[name] = paths.pop()
+                continue
+
+            for path in paths:
+                if path is not None:
+                    self.record(path)
+            scope[name] = None
+
+    def statements(self, body: list[nodes.Node], scope: dict[str, Path | None]) -> None:
+        for node in body:
+            self.statement(node, scope)
+
+    def statement(self, node: nodes.Node, scope: dict[str, Path | None]) -> None:
+        match node:
+            case nodes.Output(nodes=outputs):
+                for output in outputs:
+                    if not isinstance(output, nodes.TemplateData):
+                        self.expression(output, scope)
+            case nodes.If(test=condition, body=body, elif_=elif_, else_=else_):
+                self.expression(condition, scope, test=True)
+                with self.branch():
+                    # Each branch is analysed with its own copy of the scope,
+                    # the variables it sets are only bound that way when this
+                    # branch is taken
+                    branch_scopes = [dict(scope)]
+                    self.statements(body, branch_scopes[-1])
+                    for elif_node in elif_:
+                        self.expression(elif_node.test, scope, test=True)
+                        branch_scopes.append(dict(scope))
+                        self.statements(elif_node.body, branch_scopes[-1])
+                    branch_scopes.append(dict(scope))
+                    self.statements(else_, branch_scopes[-1])
+                    self.merge_scopes(scope, branch_scopes)
+            case nodes.For(target=target, iter=iterable, body=body, else_=else_):
+                loop_scope = dict(scope)
+                loop_scope["loop"] = None
+                path = self.resolve(iterable, scope)
+                if path is not None and isinstance(target, nodes.Name):
+                    # Record the iteration itself, even if the loop variable is
+                    # never used, the number of iterations matters.
+                    self.record((path[0], path[1] + (ITEMS,)), test=True)
+                    self.assign(target, loop_scope, (path[0], path[1] + (ITEMS,)))
+                else:
+                    self.expression(iterable, scope)
+                    self.assign(target, loop_scope, None)
+                # The body, and the filter of the loop, only run when the
+                # collection has items
+                with self.branch():
+                    self.expression(node.test, loop_scope, test=True)
+                    self.statements(body, loop_scope)
+                with self.branch():
+                    self.statements(else_, scope)
+            case nodes.Assign(target=target, node=value):
+                path = self.resolve(value, scope)
+                if path is None:
+                    self.expression(value, scope)
+                else:
+                    self.reach(path)
+                self.assign(target, scope, path)
+            case nodes.AssignBlock(target=target, body=body):
+                self.statements(body, scope)
+                if node.filter is not None:
+                    self.arguments(node.filter, scope)
+                self.assign(target, scope, None)
+            case nodes.With(targets=targets, values=values, body=body):
+                with_scope = dict(scope)
+                for target, value in zip(targets, values):
+                    path = self.resolve(value, scope)
+                    if path is None:
+                        self.expression(value, scope)
+                    else:
+                        self.reach(path)
+                    self.assign(target, with_scope, path)
+                self.statements(body, with_scope)
+            case nodes.Macro(name=name, args=args, defaults=defaults, body=body):
+                scope[name] = None
+                self.macro(args, defaults, body, scope)
+            case nodes.CallBlock(call=call, args=args, defaults=defaults, body=body):
+                self.expression(call, scope)
+                self.macro(args, defaults, body, scope)
+            case nodes.FilterBlock(body=body, filter=filter):
+                self.statements(body, scope)
+                self.arguments(filter, scope)
+            case nodes.Import(target=target, with_context=with_context):
+                self.analysis.cacheable &= not with_context
+                scope[target] = None
+            case nodes.FromImport(names=names, with_context=with_context):
+                self.analysis.cacheable &= not with_context
+                for name in names:
+                    scope[name[1] if isinstance(name, tuple) else name] = None
+            case nodes.Include() | nodes.Extends():
+                # The included/extended template sees our whole context
+                self.analysis.cacheable = False
+            case nodes.ExprStmt(node=value):
+                self.expression(value, scope)
+            case nodes.Block(body=body):
+                # A block only runs when it is rendered, the template may extend
+                # a parent template which never renders it
+                with self.branch():
+                    self.statements(body, dict(scope))
+            case nodes.Scope(body=body):
+                self.statements(body, dict(scope))
+            case nodes.ScopedEvalContextModifier(body=body):
+                self.statements(body, scope)
+            case _:
+                for child in node.iter_child_nodes():
+                    if isinstance(child, nodes.Stmt):
+                        self.statement(child, scope)
+                    else:
+                        self.expression(child, scope)
+
+    def macro(
+        self,
+        args: list[nodes.Name],
+        defaults: list[nodes.Expr],
+        body: list[nodes.Node],
+        scope: dict[str, Path | None],
+    ) -> None:
+        macro_scope = dict(scope)
+        for arg in args:
+            macro_scope[arg.name] = None
+        for name in ("varargs", "kwargs", "caller"):
+            macro_scope[name] = None
+
+        # A macro only runs when it is called
+        with self.branch():
+            for default in defaults:
+                self.expression(default, scope)
+            self.statements(body, macro_scope)
+
+
+def analyze(template: nodes.Template) -> TemplateAnalysis:
+    """
+    Statically analyse a parsed template, and extract the attribute paths it
+    reads from each of the variables it is rendered with.
+
+    :param template: The template AST, as returned by jinja2.Environment.parse
+    """
+    visitor = _Visitor()
+    visitor.statements(template.body, {})
+    # Blocks and macros can also be rendered through these names
+    visitor.analysis.parametrizable = next(
+        template.find_all(CAPTURING_STATEMENTS), None
+    ) is None and all(
+        node.name not in ("self", "caller", "super")
+        for node in template.find_all(nodes.Name)
+    )
+    filters = {node.name for node in template.find_all(nodes.Filter)}
+    tests = {node.name for node in template.find_all(nodes.Test)}
+    visitor.analysis.standalone = (
+        next(template.find_all(LOADING_STATEMENTS), None) is None
+        and filters <= jinja2.filters.FILTERS.keys()
+        and tests <= jinja2.tests.TESTS.keys()
+    )
+    return visitor.analysis
+
+
+def get_value(value: object, step: str | int) -> object:
+    """
+    Get the value a template would read when accessing the given attribute (or
+    item) on the given value.  Return ABSENT when jinja would get an undefined
+    value instead.  UnsetException is propagated.
+    """
+    match value:
+        case _Absent() | None:
+            return ABSENT
+        case Reference():
+            raise Uncacheable()
+        case Mapping():
+            if isinstance(step, str) and hasattr(value, step):
+                # Jinja resolves attributes before items
+                raise Uncacheable()
+            return value[step] if step in value else ABSENT
+        case SequenceProxy() | Sequence():
+            if isinstance(step, str):
+                if hasattr(value, step):
+                    raise Uncacheable()
+                return ABSENT
+            return value[step] if -len(value) <= step < len(value) else ABSENT
+        case DynamicProxy():
+            if not isinstance(step, str):
+                return ABSENT
+            try:
+                return getattr(inmanta.plugins.allow_reference_values(value), step)
+            except (OptionalValueException, NotFoundException, AttributeError):
+                return ABSENT
+        case _:
+            if isinstance(step, str) and hasattr(value, step):
+                raise Uncacheable()
+            return ABSENT
+
+
+def freeze(value: object, references: list[Reference]) -> object:
+    """
+    Convert a value read by a template into a canonical, hashable structure
+    made of primitives only.  Raise Uncacheable if the value is not a frozen
+    primitive value, or a collection of such values.
+
+    References are identified by their type and identity, serializing them
+    could resolve the values they depend on.  They are added to the given
+    list, the structure is only valid as long as they are alive.
+    """
+    match value:
+        case _Absent():
+            return ("absent",)
+        case None | bool() | int() | float() | str():
+            return (type(value).__name__, value)
+        case Reference():
+            references.append(value)
+            reference_type = type(value)
+            return (
+                "reference",
+                f"{reference_type.__module__}.{reference_type.__qualname__}",
+                id(value),
+            )
+        case Mapping():
+            return (
+                "dict",
+                tuple(
+                    sorted(
+                        (str(k), freeze(v, references))
+                        for k, v in inmanta.plugins.allow_reference_values(
+                            value
+                        ).items()
+                    )
+                ),
+            )
+        case SequenceProxy() | Sequence():
+            return (
+                "list",
+                tuple(
+                    freeze(item, references)
+                    for item in inmanta.plugins.allow_reference_values(value)
+                ),
+            )
+        case _:
+            raise Uncacheable()
+
+
+def presence(value: object) -> object:
+    """
+    Get what a presence or truthiness test would see of the given value.
+    """
+    match value:
+        case _Absent():
+            return "absent"
+        case None:
+            return "none"
+        case Reference():
+            return "present"
+        case bool() | int() | float() | str() | Mapping():
+            return bool(value)
+        case SequenceProxy() | Sequence():
+            return len(value) > 0
+        case _:
+            return "present"
+
+
+def walk(value: object, node: PathNode, references: list[Reference]) -> object:
+    """
+    Read all the paths of the given tree from the given value, and return a
+    canonical structure of all the values the template would see.  The
+    references used as a whole are added to the given list (see freeze).
+    """
+    parts: list[object] = []
+    if node.value:
+        parts.append(freeze(value, references))
+    elif node.test:
+        parts.append(presence(value))
+
+    for step, child in sorted(node.children.items(), key=lambda i: repr(i[0])):
+        if step is ITEMS:
+            match value:
+                case str() | _Absent() | None:
+                    parts.append((step, "not-iterable"))
+                case SequenceProxy() | Sequence() | Mapping():
+                    parts.append(
+                        (
+                            step,
+                            tuple(
+                                walk(item, child, references)
+                                for item in inmanta.plugins.allow_reference_values(
+                                    value
+                                )
+                            ),
+                        )
+                    )
+                case _:
+                    raise Uncacheable()
+        else:
+            parts.append((step, walk(get_value(value, step), child, references)))
+
+    return tuple(parts)
+
+
+def fingerprint(analysis: TemplateAnalysis, inputs: Mapping[str, object]) -> str | None:
+    """
+    Compute a fingerprint of all the values the analysed template would read
+    from the given inputs.  Two renders of the template with inputs that have
+    the same fingerprint produce the same output.
+
+    Return None when no fingerprint can be computed: the template is not
+    cacheable, it uses some of its input as a whole (e.g. passes an entity to a
+    filter), or some of the values it reads are not known yet.
+
+    When the template uses references as a whole, the fingerprint starts with
+    LOCAL_FINGERPRINT_PREFIX: references are identified by their identity, the
+    fingerprint must not be reused by another compile.
+
+    :param analysis: The analysis of the template.
+    :param inputs: The inputs the template is about to be rendered with.
+    """
+    if not analysis.cacheable:
+        return None
+
+    references: list[Reference] = []
+    try:
+        parts = tuple(
+            (name, walk(inputs[name], node, references))
+            for name, node in sorted(analysis.roots.items())
+            if name in inputs
+        )
+    except (Uncacheable, UnknownException, UnsetException):
+        return None
+
+    digest = hashlib.sha256(repr(parts).encode()).hexdigest()
+    return f"{LOCAL_FINGERPRINT_PREFIX}{digest}" if references else digest
+
+
+def _merge(nodes: Iterable[PathNode]) -> PathNode:
+    """
+    Merge several path trees into one, reading all the paths of each of them.
+    """
+    merged = PathNode()
+    for node in nodes:
+        merged.value |= node.value
+        merged.test |= node.test
+        merged.required |= node.required
+        for step, child in node.children.items():
+            merged.children[step] = _merge(
+                [merged.children[step], child] if step in merged.children else [child]
+            )
+    return merged
+
+
+def _snapshot(value: object, node: PathNode) -> object:
+    match value:
+        case None | bool() | int() | float() | str() | Reference():
+            return value
+        case Mapping():
+            if any(isinstance(step, int) for step in node.children):
+                raise Uncacheable()
+            items = inmanta.plugins.allow_reference_values(value).items()
+            if node.value:
+                # The mapping is used as a whole (e.g. its items are iterated),
+                # all its values must be plain values
+                return {k: _snapshot(v, PathNode(value=True)) for k, v in items}
+            return {k: _snapshot(v, node.children.get(k, PathNode())) for k, v in items}
+        case SequenceProxy() | Sequence():
+            if any(isinstance(step, str) for step in node.children):
+                raise Uncacheable()
+            # Each item may be read through any index, or by iterating the list
+            item_node = _merge(node.children.values())
+            item_node.value |= node.value
+            return [
+                _snapshot(item, item_node)
+                for item in inmanta.plugins.allow_reference_values(value)
+            ]
+        case DynamicProxy():
+            if node.value or not all(isinstance(step, str) for step in node.children):
+                # Entities can't be passed around without their proxy
+                raise Uncacheable()
+            attributes = {}
+            for step, child in node.children.items():
+                attribute = get_value(value, step)
+                if attribute is not ABSENT:
+                    attributes[step] = _snapshot(attribute, child)
+            return types.SimpleNamespace(**attributes)
+        case _:
+            raise Uncacheable()
+
+
+def snapshot(
+    analysis: TemplateAnalysis, inputs: Mapping[str, object]
+) -> dict[str, object] | None:
+    """
+    Convert the inputs of a template into plain values (namespaces, dicts,
+    lists and primitives), holding all the values the template could read from
+    them.  References are kept as is.  Rendering the template with these values
+    gives the same output as rendering it with the dynamic proxies of the
+    inputs, without the cost of the proxies.
+
+    Return None if the conversion isn't possible: the template is not
+    cacheable, it uses an entity as a whole (e.g. passes it to a filter), or
+    some of the values it could read are not known yet.
+
+    :param analysis: The analysis of the template.
+    :param inputs: The inputs the template is about to be rendered with.
+    """
+    if not analysis.cacheable:
+        return None
+
+    try:
+        return {
+            name: _snapshot(value, analysis.roots.get(name, PathNode()))
+            for name, value in inputs.items()
+        }
+    except (Uncacheable, UnknownException, UnsetException):
+        return None
+
+
+def _find_unset(
+    value: object,
+    node: PathNode,
+    path: tuple[str | int | None, ...],
+    *,
+    required: bool,
+) -> Iterator[tuple[tuple[str | int | None, ...], object]]:
+    """
+    Read the paths of the given tree from the given value, and yield the path
+    and result variable of each value which is not set yet.  When required is
+    True, only the paths read by every render of the template are followed.
+    """
+    for step, child in node.children.items():
+        if required and not child.required:
+            continue
+
+        if step is ITEMS:
+            match value:
+                case str() | _Absent() | None | Reference():
+                    continue
+                case SequenceProxy() | Sequence() | Mapping():
+                    for item in inmanta.plugins.allow_reference_values(value):
+                        yield from _find_unset(
+                            item, child, path + (ITEMS,), required=required
+                        )
+            continue
+
+        try:
+            item = get_value(value, step)
+        except UnsetException as e:
+            variable = e.get_result_variable()
+            if variable is not None:
+                yield path + (step,), variable
+            continue
+        except (Uncacheable, UnknownException):
+            continue
+
+        yield from _find_unset(item, child, path + (step,), required=required)
+
+
+def collect_unset(
+    analysis: TemplateAnalysis,
+    inputs: Mapping[str, object],
+    unset: list[object] | None = None,
+) -> list[object]:
+    """
+    Read all the paths that any render of the analysed template would read
+    from the given inputs, and return the result variables of the values which
+    are not set yet.  The render would fail on these values, so the compiler
+    can wait for all of them before rendering the template at all.
+
+    :param analysis: The analysis of the template.
+    :param inputs: The inputs the template is about to be rendered with.
+    :param unset: A list of result variables already collected, the new ones
+        are appended to it.
+    """
+    unset = unset if unset is not None else []
+    for name, node in analysis.roots.items():
+        if not node.required or name not in inputs:
+            continue
+        for _, variable in _find_unset(inputs[name], node, (), required=True):
+            if not any(v is variable for v in unset):
+                unset.append(variable)
+    return unset
+
+
+def learn_unset(
+    analysis: TemplateAnalysis,
+    learned: TemplateAnalysis,
+    inputs: Mapping[str, object],
+    variables: Collection[object],
+) -> None:
+    """
+    Find the paths of the analysed template which lead to the given unset
+    variables in the given inputs, and add them to the learned paths, as
+    paths read by every render.  Templates rendered many times tend to wait
+    for the same values each time, so these paths can be checked with
+    collect_unset before the next renders.
+
+    :param analysis: The analysis of the template.
+    :param learned: The paths learned so far for the template.
+    :param inputs: The inputs the template was rendered with.
+    :param variables: The result variables the render waits for.
+    """
+    for name, node in analysis.roots.items():
+        if name not in inputs:
+            continue
+        for path, variable in _find_unset(inputs[name], node, (), required=False):
+            if not any(v is variable for v in variables):
+                continue
+            learned_node = learned.roots.setdefault(name, PathNode(required=True))
+            for step in path:
+                learned_node = learned_node.child(step)
+                learned_node.required = True
@@ -0,0 +1,742 @@
+"""
+Copyright 2026 Guillaume Everarts de Velp
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Contact: edvgui@gmail.com
+"""
+
+import collections
+import fnmatch
+import hashlib
+import logging
+import os
+import pathlib
+import tempfile
+import time
+import types
+import weakref
+from collections.abc import Collection, Mapping, MutableMapping
+from dataclasses import dataclass
+
+import jinja2
+import jinja2.bccache
+
+import inmanta_plugins.files.analysis
+
+LOGGER = logging.getLogger(__name__)
+
+# Environment variables controlling the on-disk bytecode cache.  The directory
+# defaults to a private folder in the system's temporary directory (the same
+# one jinja would pick).  Setting the size to 0 disables the cache.
+BYTECODE_CACHE_DIR_ENV = "INMANTA_FILES_JINJA_CACHE_DIR"
+BYTECODE_CACHE_SIZE_ENV = "INMANTA_FILES_JINJA_CACHE_SIZE"
+DEFAULT_BYTECODE_CACHE_SIZE = 64 * 1024 * 1024
+
+# Fingerprint of the filters and tests known by each jinja environment.  The
+# compiled code of a template depends on it: jinja checks at compile time
+# whether each filter used in the template exists, and compiles a call to a
+# missing filter as a runtime error.
+_environment_fingerprints: "weakref.WeakKeyDictionary[jinja2.Environment, str]" = (
+    weakref.WeakKeyDictionary()
+)
+
+_bytecode_cache: "TemplateBytecodeCache | None" = None
+
+# Environment variables controlling the on-disk render cache.  The cache is
+# disabled unless a directory is set.
+RENDER_CACHE_DIR_ENV = "INMANTA_FILES_RENDER_CACHE_DIR"
+RENDER_CACHE_SIZE_ENV = "INMANTA_FILES_RENDER_CACHE_SIZE"
+DEFAULT_RENDER_CACHE_SIZE = 256 * 1024 * 1024
+
+# Version of the format of the entries of the render cache, to bump whenever
+# the output of a render with the same template and inputs could change.
+RENDER_CACHE_FORMAT = "1"
+
+_persistent_render_cache: "PersistentRenderCache | None" = None
+
+
+# The attributes of a jinja environment which change the code its templates are
+# compiled into: the syntax of the templates, the handling of whitespaces and
+# the code generation options.
+ENVIRONMENT_OPTIONS = (
+    "block_start_string",
+    "block_end_string",
+    "variable_start_string",
+    "variable_end_string",
+    "comment_start_string",
+    "comment_end_string",
+    "line_statement_prefix",
+    "line_comment_prefix",
+    "trim_blocks",
+    "lstrip_blocks",
+    "newline_sequence",
+    "keep_trailing_newline",
+    "autoescape",
+    "optimized",
+    "is_async",
+)
+
+
+def _option_fingerprint(value: object) -> str:
+    if callable(value):
+        # e.g. an autoescape function, the address of the function changes
+        # with every process
+        module = getattr(value, "__module__", type(value).__module__)
+        name = getattr(value, "__qualname__", type(value).__qualname__)
+        return f"{module}.{name}"
+    return repr(value)
+
+
+@dataclass(kw_only=True)
+class CompiledTemplate:
+    """
+    The compiled code of a template file, along with everything that should
+    be checked to decide whether the code is still valid.
+    """
+
+    mtime_ns: int
+    size: int
+    checksum: str
+    fingerprint: str
+    code: types.CodeType
+
+    # Whether the file was modified so recently when the entry was saved that
+    # a later modification could go unnoticed with the same mtime and size.
+    # The content of such entries is always checked.
+    racy: bool
+
+    source: str
+    analysis: "inmanta_plugins.files.analysis.TemplateAnalysis | None" = None
+
+    def get_analysis(
+        self, env: jinja2.Environment
+    ) -> "inmanta_plugins.files.analysis.TemplateAnalysis":
+        """
+        Get the static analysis of this template, computed on first use.
+        """
+        if self.analysis is None:
+            self.analysis = inmanta_plugins.files.analysis.analyze(
+                env.parse(self.source)
+            )
+        return self.analysis
+
+
+@dataclass(kw_only=True)
+class CacheStats:
+    """
+    Counters measuring the effectiveness of a cache during a compile.
+
+    :attr hits: The number of lookups which found a value in the cache.
+    :attr misses: The number of lookups which didn't find any value.
+    :attr bypassed: The number of times the cache couldn't be used at all.
+    """
+
+    hits: int = 0
+    misses: int = 0
+    bypassed: int = 0
+
+
+# Compiled code of all the template files rendered by this process, keyed by
+# resolved template path and environment fingerprint.  Contrary to the template
+# objects, which are bound to the jinja environment of a single compile, the
+# code objects don't depend on the lifecycle of the environment, so this cache
+# is not cleared by inmanta_reset_state and is reused by all the compiles
+# running in the same process.  The cache is bounded, the least recently used
+# entries are dropped first.
+COMPILED_TEMPLATE_CACHE_SIZE = 1024
+_compiled_templates: collections.OrderedDict[tuple[str, str], CompiledTemplate] = (
+    collections.OrderedDict()
+)
+
+# Inline templates rendered by this process, keyed by the checksum of their
+# source and the fingerprint of the environment, least recently used first.
+# Contrary to template files, inline templates can be generated by the model,
+# so the number of distinct sources is unbounded, and only the most recently
+# used ones are kept.  The template objects are bound to the environment they were built
+# for, which is reused across compiles as long as the plugins don't change.
+INLINE_TEMPLATE_CACHE_SIZE = 1024
+_inline_templates: collections.OrderedDict[
+    str, tuple[jinja2.Template, CompiledTemplate]
+] = collections.OrderedDict()
+
+# Output of the jinja renders of this compile, keyed by the template, the set of
+# filters it is compiled with and the fingerprint of the values it read from its
+# inputs (see get_render_key).  Templates with structurally identical inputs,
+# e.g. the same unit file deployed on many hosts, are only rendered once.
+_rendered: dict[str, object] = {}
+RENDER_CACHE_STATS = CacheStats()
+PERSISTENT_RENDER_CACHE_STATS = CacheStats()
+
+# Paths of the inputs of each template which were found unset by a render
+# during this compile, keyed by template checksum (see learn_unset).  They
+# depend on the model being compiled, so they are not kept across compiles.
+_learned_unset: dict[str, "inmanta_plugins.files.analysis.TemplateAnalysis"] = {}
+
+
+def inmanta_reset_state() -> None:
+    global RENDER_CACHE_STATS, PERSISTENT_RENDER_CACHE_STATS
+    LOGGER.debug("Jinja render cache usage: %s", RENDER_CACHE_STATS)
+    LOGGER.debug(
+        "Jinja persistent render cache usage: %s", PERSISTENT_RENDER_CACHE_STATS
+    )
+    _rendered.clear()
+    _learned_unset.clear()
+    RENDER_CACHE_STATS = CacheStats()
+    PERSISTENT_RENDER_CACHE_STATS = CacheStats()
+
+
+def environment_fingerprint(env: jinja2.Environment) -> str:
+    """
+    Get a fingerprint of the given environment, which changes whenever the set
+    of filters, tests or extensions available in the environment, its finalize
+    function, or any of its options which change the compiled code (see
+    ENVIRONMENT_OPTIONS), changes.  The result is computed once per environment.
+
+    :param env: The environment in which templates are compiled.
+    """
+    fingerprint = _environment_fingerprints.get(env)
+    if fingerprint is None:
+        digest = hashlib.sha256()
+        for name in sorted(env.filters):
+            digest.update(b"filter:" + name.encode() + b"\0")
+        for name in sorted(env.tests):
+            digest.update(b"test:" + name.encode() + b"\0")
+        for name in sorted(env.extensions):
+            digest.update(b"extension:" + name.encode() + b"\0")
+        for option in ENVIRONMENT_OPTIONS:
+            value = _option_fingerprint(getattr(env, option))
+            digest.update(f"{option}:{value}".encode() + b"\0")
+        if env.finalize is not None:
+            # The calls to the finalize function are part of the compiled code
+            finalize = _option_fingerprint(env.finalize)
+            digest.update(b"finalize:" + finalize.encode() + b"\0")
+        fingerprint = digest.hexdigest()
+        _environment_fingerprints[env] = fingerprint
+    return fingerprint
+
+
+def evict_lru(directory: str, pattern: str, max_size: int) -> int:
+    """
+    Remove the least recently used files of an on-disk cache until their total
+    size is below max_size.  The cache entries mark the files they read as
+    recently used by updating their modification time.
+
+    :param directory: The directory of the cache.
+    :param pattern: The glob pattern matching the files of the cache in this
+        directory.
+    :param max_size: The maximum total size of the files, in bytes.
+    :return: The total size of the remaining files.
+    """
+    entries: list[tuple[float, int, str]] = []
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return 0
+
+    for name in fnmatch.filter(names, pattern):
+        path = os.path.join(directory, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # Removed by another process in the meantime
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        LOGGER.debug("Evicted %s from the cache", path)
+        total_size -= size
+    return total_size
+
+
+class TemplateBytecodeCache(jinja2.FileSystemBytecodeCache):
+    """
+    On-disk cache of compiled jinja templates, shared by all the compiles
+    running on this machine.  Entries are keyed by the content of the template,
+    the version of jinja and the fingerprint of the environment, so that a
+    template which didn't change is loaded as precompiled bytecode instead of
+    being parsed and compiled again.  The python version is already part of the
+    header jinja writes in each entry.
+
+    The total size of the cache directory is bounded: when a new entry is
+    written, the least recently used entries are evicted until the cache fits
+    in max_size bytes again.
+    """
+
+    def __init__(self, directory: str | None = None, *, max_size: int) -> None:
+        super().__init__(directory, pattern="__inmanta_files_%s.cache")
+        self.max_size = max_size
+
+        # The configuration this cache was created from, see get_bytecode_cache
+        self.config: tuple[str | None, int] | None = None
+
+    def get_code(
+        self, env: jinja2.Environment, source: str
+    ) -> tuple[types.CodeType | None, jinja2.bccache.Bucket]:
+        """
+        Look up the compiled code of the given template source.  Returns the
+        code (None if it is not in the cache) and the bucket that should be
+        passed to set_bucket once the code has been compiled.
+
+        :param env: The environment the template is compiled for.
+        :param source: The source of the template.
+        """
+        checksum = self.get_source_checksum(source)
+        key = hashlib.sha1(
+            f"{jinja2.__version__}:{environment_fingerprint(env)}:{checksum}".encode()
+        ).hexdigest()
+        bucket = jinja2.bccache.Bucket(env, key, checksum)
+        self.load_bytecode(bucket)
+        return bucket.code, bucket
+
+    def load_bytecode(self, bucket: jinja2.bccache.Bucket) -> None:
+        super().load_bytecode(bucket)
+        if bucket.code is not None:
+            # Mark the entry as recently used, so that it is evicted last
+            try:
+                os.utime(self._get_cache_filename(bucket))
+            except OSError:
+                pass
+
+    def dump_bytecode(self, bucket: jinja2.bccache.Bucket) -> None:
+        super().dump_bytecode(bucket)
+        self.evict()
+
+    def evict(self) -> None:
+        """
+        Remove the least recently used entries of the cache until its total
+        size is below max_size.
+        """
+        evict_lru(self.directory, self.pattern % ("*",), self.max_size)
+
+
+def get_bytecode_cache() -> TemplateBytecodeCache | None:
+    """
+    Get the on-disk bytecode cache, configured from the environment variables
+    of the compiler process.  Returns None if the cache is disabled.
+    """
+    global _bytecode_cache
+
+    max_size = int(os.environ.get(BYTECODE_CACHE_SIZE_ENV, DEFAULT_BYTECODE_CACHE_SIZE))
+    if max_size <= 0:
+        return None
+
+    directory = os.environ.get(BYTECODE_CACHE_DIR_ENV)
+    if _bytecode_cache is None or _bytecode_cache.config != (directory, max_size):
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        _bytecode_cache = TemplateBytecodeCache(directory, max_size=max_size)
+        _bytecode_cache.config = (directory, max_size)
+
+    return _bytecode_cache
+
+
+class PersistentRenderCache:
+    """
+    On-disk cache of the output of jinja renders, shared by all the compiles
+    running on this machine.  Entries are keyed by the render key (the content
+    of the template, the fingerprint of the environment and the fingerprint of
+    the values read from the inputs, see get_render_key), so that a render
+    which didn't change since a previous compile is not done again.
+
+    The total size of the cache directory is bounded: the least recently used
+    entries are evicted when the cache grows beyond max_size bytes.
+    """
+
+    pattern = "__inmanta_files_render_%s.txt"
+
+    def __init__(self, directory: str, *, max_size: int) -> None:
+        self.directory = directory
+        self.max_size = max_size
+
+        # The total size of the entries, only computed when a first entry is
+        # written, and kept up to date with the entries written since then
+        self.size: int | None = None
+
+        # The configuration this cache was created from, see
+        # get_persistent_render_cache
+        self.config: tuple[str, int] | None = None
+
+    def get_path(self, key: str) -> str:
+        digest = hashlib.sha256(
+            f"{RENDER_CACHE_FORMAT}:{jinja2.__version__}:{key}".encode()
+        ).hexdigest()
+        return os.path.join(self.directory, self.pattern % digest)
+
+    def get(self, key: str) -> str | None:
+        """
+        Get the output of the render with the given key, if it is in the cache.
+
+        :param key: The key of the render, as returned by get_render_key.
+        """
+        path = self.get_path(key)
+        try:
+            rendered = pathlib.Path(path).read_text()
+            # Mark the entry as recently used, so that it is evicted last
+            os.utime(path)
+        except OSError:
+            return None
+        return rendered
+
+    def set(self, key: str, rendered: str) -> None:
+        """
+        Save the output of the render with the given key in the cache.  The
+        entry is written atomically, concurrent compiles never read a partial
+        entry.
+
+        :param key: The key of the render, as returned by get_render_key.
+        :param rendered: The output of the render.
+        """
+        content = rendered.encode()
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_path, self.get_path(key))
+        except OSError:
+            LOGGER.debug("Failed to persist render %s", key, exc_info=True)
+            return
+
+        if self.size is None:
+            self.size = self.evict()
+        else:
+            self.size += len(content)
+            if self.size > self.max_size:
+                self.size = self.evict()
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used entries of the cache until its total
+        size is below max_size.  Return the size of the remaining entries.
+        """
+        return evict_lru(self.directory, self.pattern % ("*",), self.max_size)
+
+    def clear(self) -> None:
+        """
+        Remove all the entries of the cache.
+        """
+        max_size, self.max_size = self.max_size, 0
+        try:
+            self.size = self.evict()
+        finally:
+            self.max_size = max_size
+
+
+def get_persistent_render_cache() -> PersistentRenderCache | None:
+    """
+    Get the on-disk render cache, configured from the environment variables of
+    the compiler process.  Returns None if the cache is disabled, which is the
+    default.
+    """
+    global _persistent_render_cache
+
+    directory = os.environ.get(RENDER_CACHE_DIR_ENV)
+    max_size = int(os.environ.get(RENDER_CACHE_SIZE_ENV, DEFAULT_RENDER_CACHE_SIZE))
+    if not directory or max_size <= 0:
+        return None
+
+    if _persistent_render_cache is None or _persistent_render_cache.config != (
+        directory,
+        max_size,
+    ):
+        os.makedirs(directory, exist_ok=True)
+        _persistent_render_cache = PersistentRenderCache(directory, max_size=max_size)
+        _persistent_render_cache.config = (directory, max_size)
+
+    return _persistent_render_cache
+
+
+def clear_persistent_render_cache() -> None:
+    """
+    Remove all the renders saved in the on-disk render cache, if it is enabled.
+    """
+    cache = get_persistent_render_cache()
+    if cache is not None:
+        cache.clear()
+
+
+def compile_code(env: jinja2.Environment, source: str) -> types.CodeType:
+    """
+    Compile the given template source for the given environment.  Load the
+    compiled code from the on-disk bytecode cache when it is available there.
+
+    :param env: The environment the template is compiled for.
+    :param source: The source of the template.
+    """
+    bcc = get_bytecode_cache()
+    if bcc is None:
+        return env.compile(source)
+
+    code, bucket = bcc.get_code(env, source)
+    if code is None:
+        code = env.compile(source)
+        bucket.code = code
+        try:
+            bcc.set_bucket(bucket)
+        except OSError as e:
+            # The cache is an optimization, failing to write to it should
+            # never fail the compile
+            LOGGER.warning("Failed to save compiled template to the cache: %s", e)
+
+    return code
+
+
+def compile_template(env: jinja2.Environment, source: str) -> jinja2.Template:
+    """
+    Build a template object for the given source, equivalent to
+    env.from_string(source), but load the compiled code from the on-disk
+    bytecode cache when it is available there.
+
+    :param env: The environment the template should be bound to.
+    :param source: The source of the template.
+    """
+    return env.template_class.from_code(
+        env, compile_code(env, source), env.make_globals(None)
+    )
+
+
+def load_template(
+    env: jinja2.Environment,
+    template_path: str,
+    globals: MutableMapping[str, object] | None = None,
+) -> tuple[jinja2.Template, CompiledTemplate]:
+    """
+    Build a template object for the template file at the given path.  The
+    compiled code of the file is reused from a previous compile running in
+    this process if the file didn't change since then (same mtime and size,
+    or same content) and if it was compiled with the same set of filters.
+
+    Return the template object and the compiled template it was built from.
+
+    :param env: The environment the template should be bound to.
+    :param template_path: The resolved path to the template file.
+    :param globals: The globals of the template, as built by env.make_globals.
+    """
+    stat = os.stat(template_path)
+    fingerprint = environment_fingerprint(env)
+
+    entry = _compiled_templates.get((template_path, fingerprint))
+    if entry is not None:
+        _compiled_templates.move_to_end((template_path, fingerprint))
+    if (
+        entry is None
+        or entry.racy
+        or entry.mtime_ns != stat.st_mtime_ns
+        or entry.size != stat.st_size
+    ):
+        # The file might have changed, check its content
+        source = pathlib.Path(template_path).read_text()
+        checksum = hashlib.sha256(source.encode()).hexdigest()
+        unchanged = entry is not None and entry.checksum == checksum
+        entry = CompiledTemplate(
+            mtime_ns=stat.st_mtime_ns,
+            size=stat.st_size,
+            checksum=checksum,
+            fingerprint=fingerprint,
+            code=entry.code if unchanged else compile_code(env, source),
+            racy=time.time_ns() - stat.st_mtime_ns < 2_000_000_000,
+            source=source,
+            analysis=entry.analysis if unchanged else None,
+        )
+        _compiled_templates[(template_path, fingerprint)] = entry
+        while len(_compiled_templates) > COMPILED_TEMPLATE_CACHE_SIZE:
+            _compiled_templates.popitem(last=False)
+
+    template = env.template_class.from_code(
+        env, entry.code, globals if globals is not None else env.make_globals(None)
+    )
+    return template, entry
+
+
+def get_render_key(
+    env: jinja2.Environment,
+    compiled: CompiledTemplate,
+    inputs: Mapping[str, object],
+) -> str | None:
+    """
+    Compute the key under which the output of the render of the given template
+    with the given inputs is saved in the render cache.  Return None if the
+    render can't be cached (see inmanta_plugins.files.analysis.fingerprint).
+
+    :param env: The environment the template is rendered in.
+    :param compiled: The template that is about to be rendered.
+    :param inputs: The inputs the template is about to be rendered with.
+    """
+    fingerprint = inmanta_plugins.files.analysis.fingerprint(
+        compiled.get_analysis(env), inputs
+    )
+    if fingerprint is None:
+        RENDER_CACHE_STATS.bypassed += 1
+        return None
+
+    return f"{compiled.checksum}:{compiled.fingerprint}:{fingerprint}"
+
+
+def is_local_render_key(key: str) -> bool:
+    """
+    Whether the given render key is only valid for the current compile, and
+    can't be saved to or looked up in the on-disk render cache.
+    """
+    _, _, fingerprint = key.rpartition(":")
+    return fingerprint.startswith(
+        inmanta_plugins.files.analysis.LOCAL_FINGERPRINT_PREFIX
+    )
+
+
+def get_rendered(key: str, *, persistent: bool = False) -> object | None:
+    """
+    Get the output of a previous render with the given key, if there is any.
+
+    :param key: The key of the render, as returned by get_render_key.
+    :param persistent: Whether the output can be looked up in the on-disk
+        render cache, when the render was not done by this compile.
+    """
+    rendered = _rendered.get(key)
+    if rendered is not None:
+        RENDER_CACHE_STATS.hits += 1
+        return rendered
+
+    RENDER_CACHE_STATS.misses += 1
+    if not persistent or is_local_render_key(key):
+        return None
+    cache = get_persistent_render_cache()
+    if cache is None:
+        return None
+
+    rendered = cache.get(key)
+    if rendered is None:
+        PERSISTENT_RENDER_CACHE_STATS.misses += 1
+    else:
+        PERSISTENT_RENDER_CACHE_STATS.hits += 1
+        _rendered[key] = rendered
+    return rendered
+
+
+def save_rendered(key: str, rendered: object, *, persistent: bool = False) -> None:
+    """
+    Save the output of a render in the render cache.  Only renders which didn't
+    access any unset value should be saved.
+
+    :param key: The key of the render, as returned by get_render_key.
+    :param rendered: The output of the render.
+    :param persistent: Whether the output should also be saved in the on-disk
+        render cache, for the next compiles.  Only outputs without reference
+        are saved there.
+    """
+    _rendered[key] = rendered
+    if persistent and isinstance(rendered, str) and not is_local_render_key(key):
+        cache = get_persistent_render_cache()
+        if cache is not None:
+            cache.set(key, rendered)
+
+
+def get_unset(
+    env: jinja2.Environment,
+    compiled: CompiledTemplate,
+    inputs: Mapping[str, object],
+) -> list[object]:
+    """
+    Get the result variables of the values which are not set yet, and which
+    the render of the given template with the given inputs is expected to
+    read: the paths that previous renders of the template found unset first,
+    then the paths read by every render of the template.
+
+    :param env: The environment the template is rendered in.
+    :param compiled: The template that is about to be rendered.
+    :param inputs: The inputs the template is about to be rendered with.
+    """
+    unset: list[object] = []
+    learned = _learned_unset.get(compiled.checksum)
+    if learned is not None:
+        inmanta_plugins.files.analysis.collect_unset(learned, inputs, unset)
+
+    return inmanta_plugins.files.analysis.collect_unset(
+        compiled.get_analysis(env), inputs, unset
+    )
+
+
+def learn_unset(
+    env: jinja2.Environment,
+    compiled: CompiledTemplate,
+    inputs: Mapping[str, object],
+    variables: Collection[object],
+) -> None:
+    """
+    Remember which paths of the inputs of the given template led to the given
+    unset values, so that the next renders of the template check them before
+    rendering (see get_unset).
+
+    :param env: The environment the template is rendered in.
+    :param compiled: The template that was rendered.
+    :param inputs: The inputs the template was rendered with.
+    :param variables: The result variables the render found unset.
+    """
+    learned = _learned_unset.setdefault(
+        compiled.checksum, inmanta_plugins.files.analysis.TemplateAnalysis()
+    )
+    inmanta_plugins.files.analysis.learn_unset(
+        compiled.get_analysis(env), learned, inputs, variables
+    )
+
+
+def load_inline_template(
+    env: jinja2.Environment, source: str
+) -> tuple[jinja2.Template, CompiledTemplate]:
+    """
+    Build a template object for the given template source.  Templates are kept
+    in a bounded cache, so that a snippet rendered many times is only compiled
+    once.
+
+    Return the template object and the compiled template it was built from.
+
+    :param env: The environment the template should be bound to.
+    :param source: The source of the template.
+    """
+    checksum = hashlib.sha256(source.encode()).hexdigest()
+    fingerprint = environment_fingerprint(env)
+    key = f"{checksum}:{fingerprint}"
+
+    cached = _inline_templates.get(key)
+    if cached is not None:
+        _inline_templates.move_to_end(key)
+        if cached[0].environment is env:
+            return cached
+
+    if cached is not None:
+        # Compiled for another environment with the same filters, only the
+        # template object needs to be built again
+        compiled = cached[1]
+    else:
+        compiled = CompiledTemplate(
+            mtime_ns=0,
+            size=len(source),
+            checksum=checksum,
+            fingerprint=fingerprint,
+            code=compile_code(env, source),
+            racy=False,
+            source=source,
+        )
+
+    template = env.template_class.from_code(env, compiled.code, env.make_globals(None))
+    _inline_templates[key] = (template, compiled)
+    while len(_inline_templates) > INLINE_TEMPLATE_CACHE_SIZE:
+        _inline_templates.popitem(last=False)
+
+    return template, compiled
@@ -0,0 +1,223 @@
+"""
+Copyright 2026 Guillaume Everarts de Velp
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Contact: edvgui@gmail.com
+"""
+
+import functools
+import inspect
+import typing
+from collections.abc import Callable, Mapping, Sequence
+from dataclasses import dataclass
+
+import inmanta.ast
+import inmanta.plugins
+
+# Attribute set on the functions marked by the deterministic decorator
+DETERMINISTIC = "__files_deterministic__"
+
+# The python types a plugin can be called directly with, the values of these
+# types are passed to plugins as is by the compiler.
+PRIMITIVES: frozenset[type] = frozenset({str, int, float, bool})
+
+# Maximum number of results memoized for each deterministic plugin
+MEMOIZE_SIZE = 4096
+
+
+def deterministic[F: Callable](function: F) -> F:
+    """
+    Mark the python function of a plugin as deterministic: it has no side
+    effect and always returns the same value for the same arguments.  When such
+    a plugin is called directly as a jinja filter (see get_direct_call), its
+    results are memoized.  The decorator should be placed below the @plugin
+    decorator.
+    """
+    setattr(function, DETERMINISTIC, True)
+    return function
+
+
+@dataclass(frozen=True, kw_only=True)
+class DirectCall:
+    """
+    A plugin which can be called from a jinja template as a plain python
+    function, without going through the compiler.  This is only possible for
+    plugins without Context argument, whose arguments and return value are all
+    primitives.
+
+    :attr function: The function to call, memoized if the plugin is
+        deterministic.
+    :attr positional: The name and type of each argument which can be passed
+        positionally, in order.
+    :attr varargs: The type of the variadic positional arguments, if the plugin
+        accepts any.
+    :attr keywords: The type of each argument which can be passed by name.
+    :attr required: The name, and position if the argument can be passed
+        positionally, of each argument without default value.
+    """
+
+    function: Callable[..., object]
+    positional: Sequence[tuple[str, type]]
+    varargs: type | None
+    keywords: Mapping[str, type]
+    required: Sequence[tuple[int | None, str]]
+
+    def accepts(self, args: Sequence[object], kwargs: Mapping[str, object]) -> bool:
+        """
+        Check whether the given arguments can be passed to the function
+        directly: they match the signature of the plugin and they are all
+        primitives of the expected type.  Any other call should go through the
+        compiler, which validates and converts the arguments, and reports
+        errors properly.
+        """
+        if len(args) > len(self.positional) and self.varargs is None:
+            return False
+
+        expected: type | None
+        for i, value in enumerate(args):
+            if i < len(self.positional):
+                name, expected = self.positional[i]
+                if name in kwargs:
+                    # Passed both positionally and by name
+                    return False
+            else:
+                expected = self.varargs
+            if type(value) is not expected:
+                return False
+
+        for name, value in kwargs.items():
+            if type(value) is not self.keywords.get(name):
+                return False
+
+        # All the arguments without default value must be passed
+        return all(
+            name in kwargs or (index is not None and index < len(args))
+            for index, name in self.required
+        )
+
+    def call(
+        self,
+        plugin: inmanta.plugins.Plugin,
+        location: inmanta.ast.Location,
+        args: Sequence[object],
+        kwargs: Mapping[str, object],
+    ) -> object:
+        """
+        Call the function with the given arguments, which it accepts (see
+        accepts).  As when the compiler calls the plugin, the returned value is
+        validated against the return type of the plugin.  Any error is raised
+        as a PluginException, mentioning the plugin and the location of the
+        call.
+
+        :param plugin: The plugin this is the direct call of.
+        :param location: The location of the call, i.e. the template using
+            the plugin as a filter.
+        :param args: The positional arguments of the call.
+        :param kwargs: The keyword arguments of the call.
+        """
+        try:
+            value = self.function(*args, **kwargs)
+        except Exception as e:
+            raise inmanta.plugins.PluginException(
+                f"Exception in plugin {plugin.get_full_name()} ({location}): {e}"
+            ) from e
+
+        try:
+            plugin.return_type.validate(value)
+        except inmanta.ast.RuntimeException as e:
+            raise inmanta.plugins.PluginException(
+                f"Return value {value!r} of plugin {plugin.get_full_name()}"
+                f" ({location}) has incompatible type: {e.msg}"
+            ) from e
+
+        return value
+
+
+# The direct call of each plugin function, or None if the plugin can't be
+# called directly.  Plugin functions don't change across compiles (unless the
+# module is reloaded, in which case a new function object is created), so this
+# is kept for the whole process.
+_direct_calls: dict[Callable, DirectCall | None] = {}
+
+
+def _build_direct_call(function: Callable) -> DirectCall | None:
+    try:
+        hints = typing.get_type_hints(function)
+        signature = inspect.signature(function)
+    except Exception:
+        # Annotations which are not python types (e.g. inmanta types)
+        return None
+
+    if hints.get("return") not in PRIMITIVES:
+        return None
+
+    positional: list[tuple[str, type]] = []
+    varargs: type | None = None
+    keywords: dict[str, type] = {}
+    required: list[tuple[int | None, str]] = []
+    for parameter in signature.parameters.values():
+        expected = hints.get(parameter.name)
+        if expected not in PRIMITIVES:
+            return None
+
+        match parameter.kind:
+            case inspect.Parameter.POSITIONAL_ONLY:
+                index: int | None = len(positional)
+                positional.append((parameter.name, expected))
+            case inspect.Parameter.POSITIONAL_OR_KEYWORD:
+                index = len(positional)
+                positional.append((parameter.name, expected))
+                keywords[parameter.name] = expected
+            case inspect.Parameter.VAR_POSITIONAL:
+                varargs = expected
+                continue
+            case inspect.Parameter.KEYWORD_ONLY:
+                index = None
+                keywords[parameter.name] = expected
+            case _:
+                # **kwargs
+                return None
+
+        if parameter.default is inspect.Parameter.empty:
+            required.append((index, parameter.name))
+
+    if getattr(function, DETERMINISTIC, False):
+        function = functools.lru_cache(maxsize=MEMOIZE_SIZE, typed=True)(function)
+
+    return DirectCall(
+        function=function,
+        positional=positional,
+        varargs=varargs,
+        keywords=keywords,
+        required=required,
+    )
+
+
+def get_direct_call(plugin: inmanta.plugins.Plugin) -> DirectCall | None:
+    """
+    Get the direct call of the given plugin, if it can be called directly from
+    a jinja template.  The signature of each plugin is only inspected once.
+
+    :param plugin: The plugin, as registered in the compiler.
+    """
+    if plugin._context != -1 or plugin.deprecated:
+        # The plugin needs the compiler context, or the compiler should warn
+        # about its usage
+        return None
+
+    # The python function is set on the class the plugin decorator generates
+    function: Callable = getattr(type(plugin), "__function__")
+    if function not in _direct_calls:
+        _direct_calls[function] = _build_direct_call(function)
+    return _direct_calls[function]
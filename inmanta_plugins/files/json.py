@@ -16,9 +16,11 @@ limitations under the License.
 Contact: edvgui@gmail.com
 """
 
+import contextvars
 import copy
 import enum
 import json
+import logging
 import typing
 from collections.abc import Collection, Mapping, Sequence
 from dataclasses import asdict, dataclass
@@ -30,12 +32,16 @@ import inmanta.agent.handler
 import inmanta.execute.proxy
 import inmanta.execute.util
 import inmanta.plugins
+import inmanta.references
 import inmanta.resources
 import inmanta_plugins.files.base
-from inmanta.ast import OptionalValueException
+import inmanta_plugins.files.cache
+from inmanta.ast import MultiUnsetException, OptionalValueException, UnsetException
 from inmanta.ast.attribute import RelationAttribute
 from inmanta.ast.entity import Entity
-from inmanta.execute.proxy import SequenceProxy
+from inmanta.execute.proxy import DictProxy, DynamicProxy, SequenceProxy
+from inmanta.execute.runtime import ResultVariable
+from inmanta.execute.util import NoneValue
 from inmanta.util import dict_path
 
 type Resource = typing.Annotated[
@@ -43,6 +49,8 @@ type Resource = typing.Annotated[
     inmanta.plugins.ModelType["std::Resource"],
 ]
 
+LOGGER = logging.getLogger(__name__)
+
 
 class SerializableEntityProtocol(typing.Protocol):
     path: str
@@ -94,12 +102,17 @@ def json_value(raw_value: object) -> object:
     time.  Because ``allow_reference_values`` only opts in a single proxy
     level, it is re-applied each time we descend into a collection.
 
+    Dicts and lists behind a proxy are read straight from the frozen value
+    wrapped by the proxy, see compiler_json_value.
+
     :param raw_value: The raw value that should be converted.
     """
     match raw_value:
         case str():
             return raw_value
-        case Sequence() | SequenceProxy():
+        case DictProxy() | SequenceProxy():
+            return compiler_json_value(raw_value._get_instance())
+        case Sequence():
             return [
                 json_value(item)
                 for item in inmanta.plugins.allow_reference_values(raw_value)
@@ -113,6 +126,69 @@ def json_value(raw_value: object) -> object:
             return raw_value
 
 
+def compiler_json_value(raw_value: object) -> object:
+    """
+    Convert a value of the compiler domain (i.e. the value of an attribute of
+    an instance, as it is stored by the compiler) into a mutable, json-like
+    python object, the same way json_value does for the values of the plugin
+    domain, without wrapping each nested value into a proxy.  References are
+    passed through unchanged.  Any value that is not a plain python value is
+    converted through its proxy.
+
+    :param raw_value: The value, as stored by the compiler.
+    """
+    match raw_value:
+        case NoneValue():
+            return None
+        case str() | int() | float() | bool() | inmanta.references.Reference():
+            return raw_value
+        case list() | tuple():
+            return [compiler_json_value(item) for item in raw_value]
+        case dict():
+            return {k: compiler_json_value(v) for k, v in raw_value.items()}
+        case _:
+            # e.g. unknown values, which the proxy refuses to convert
+            return json_value(DynamicProxy.return_value(raw_value))
+
+
+def get_attribute_value(entity: object, name: str) -> object:
+    """
+    Get the value of the given attribute of an entity, converted by json_value.
+    When the entity is a proxy, the value is read straight from the compiler
+    instance behind it, with references allowed.  Unset values raise the same
+    exception as when they are read through the proxy.
+
+    :param entity: The entity holding the attribute.
+    :param name: The name of the attribute.
+    """
+    if isinstance(entity, DynamicProxy):
+        instance = entity._get_instance()
+        return compiler_json_value(instance.get_attribute(name).get_value())
+
+    return json_value(
+        getattr(inmanta.plugins.allow_reference_values(entity), name),
+    )
+
+
+def get_multi_relation(entity: object, name: str) -> list[object]:
+    """
+    Get all the entities in the given relation of an entity, as proxies.  When
+    the entity is a proxy, the relation is read straight from the compiler
+    instance behind it, instead of going through a SequenceProxy.
+
+    :param entity: The entity holding the relation.
+    :param name: The name of the relation.
+    """
+    if isinstance(entity, DynamicProxy):
+        instance = entity._get_instance()
+        return [
+            DynamicProxy.return_value(item)
+            for item in instance.get_attribute(name).get_value()
+        ]
+
+    return list(getattr(entity, name))
+
+
 def get_optional_relation(entity: object, name: str) -> object | None:
     """
     helper function to get the value of an optional relation, which will raise
@@ -131,18 +207,67 @@ class SerializedEntity:
     value: dict | None
 
 
-@inmanta.plugins.plugin()
-def get_relation_from_parent(
-    serializable_entity: SerializableEntity,
-) -> str | None:
+@dataclass(frozen=True, kw_only=True)
+class SerializationSchema:
     """
-    Figure out the relation that leads to a serializable entity, from its parent,
-    if it has any.  If the entity has no parent, return None instead.
-
-    :param serializable_entity: An instance of the serializable entity, for
-        which we want to know the relation from the parent.
+    Everything the serializer needs to know about a serializable entity type,
+    which only depends on the type and not on its instances.  The schema of
+    each type is built and validated once per compile, see get_schema.
+
+    :attr relation_from_parent: The name of the relation leading from the
+        parent entity to the instances of this type, or None if the type
+        doesn't have any parent.
+    :attr index_attributes: The attributes, other than the parent relation, of
+        the first index of the type that contains the parent relation, or None
+        if the type doesn't have any such index.
+    :attr attributes: The name of each primitive attribute to serialize, in
+        order, and whether the attribute is private.
+    :attr children: The name of each relation towards child serializable
+        entities, in order, whether the relation is private and whether it is
+        a multi relation.
     """
-    entity_type = serializable_entity._type()
+
+    relation_from_parent: str | None
+    index_attributes: Sequence[str] | None
+    attributes: Sequence[tuple[str, bool]]
+    children: Sequence[tuple[str, bool, bool]]
+
+
+# The schema of each serializable entity type, the types are created by the
+# compiler, so this is reset before every compile.
+_schemas: dict[Entity, SerializationSchema] = {}
+
+# The serialized entities of each tree, grouped by the resource they are
+# attached to, keyed by the root of the tree, see partition.
+_partitions: dict[SerializableEntity, dict[JsonResource, list[SerializedEntity]]] = {}
+
+# The serialized version of each entity instance, see serialize.
+_serialized: dict[SerializableEntity, SerializedEntity | None] = {}
+SERIALIZE_CACHE_STATS = inmanta_plugins.files.cache.CacheStats()
+
+# The unset values read by the ongoing serialization plugin call.  Each time
+# the compiler re-invokes a plugin after an unset value, the whole tree is
+# walked again, so a tree with K independent unset values would be walked K+1
+# times.  Instead, while this is set, each unset value is collected and the
+# walk goes on with the other values, then a single MultiUnsetException is
+# raised for the whole batch, see collect_unset.  Only a walk that didn't
+# collect anything read real values throughout, so only its result is used,
+# or kept in the caches above.
+SERIALIZE_UNSET_COLLECTOR: contextvars.ContextVar[
+    list[ResultVariable[object]] | None
+] = contextvars.ContextVar("files_json_unset_collector", default=None)
+
+
+def inmanta_reset_state() -> None:
+    global SERIALIZE_CACHE_STATS
+    LOGGER.debug("Json serialization cache usage: %s", SERIALIZE_CACHE_STATS)
+    _schemas.clear()
+    _partitions.clear()
+    _serialized.clear()
+    SERIALIZE_CACHE_STATS = inmanta_plugins.files.cache.CacheStats()
+
+
+def _build_relation_from_parent(entity_type: Entity) -> str | None:
     parent_relation = entity_type.get_attribute(PARENT_RELATION)
 
     match parent_relation:
@@ -192,32 +317,8 @@ def get_relation_from_parent(
             )
 
 
-@inmanta.plugins.plugin()
-def get_relative_path(serializable_entity: SerializableEntity) -> str | None:
-    """
-    Calculate the relative path from the parent entity.  If there is no parent
-    entity, return None instead.  The relative path is derived from the index
-    of this entity that contains the relation to the parent entity.
-
-    :param serializable_entity: The instance for which we want to get the
-        path from the parent, or None if the entity doesn't have a parent.
-    """
-    relation_from_parent = get_relation_from_parent(serializable_entity)
-    if relation_from_parent is None:
-        # No parent, no relative parent
-        return None
-
-    # If the relation from parent has been overwritten in the mapping of
-    # the parent, we should adapt the relative path too.
-    relation_from_parent = serializable_entity.parent.mapping_overwrite.get(
-        relation_from_parent,
-        relation_from_parent,
-    )
-
-    entity_type = serializable_entity._type()
-    indices = entity_type.get_indices()
-
-    for index in indices:
+def _build_index_attributes(entity_type: Entity) -> list[str] | None:
+    for index in entity_type.get_indices():
         if PARENT_RELATION not in index:
             # We only consider the index expression that contain the
             # parent relation, this allows to define additional index
@@ -242,40 +343,224 @@ def get_relative_path(serializable_entity: SerializableEntity) -> str | None:
                 f"Index {index} contains some relations: {[attr.name for attr in relation_attributes]}"
             )
 
-        if not index_attributes:
-            # Single instance, use InDict path
-            return str(dict_path.InDict(relation_from_parent))
-        else:
-            # Get the keys and values from the model
-            keys = {
-                attr.name: getattr(serializable_entity, attr.name)
-                for attr in index_attributes
-            }
+        return [attr.name for attr in index_attributes]
 
-            # Normalize the keys, use the overwrite if it is defined, replace None value
-            # by proper escape character
-            return str(
-                dict_path.KeyedList(
-                    relation_from_parent,
-                    [
-                        (
-                            serializable_entity.mapping_overwrite.get(key, key),
-                            (
-                                value
-                                if value is not None
-                                else dict_path.NullValue().escape()
-                            ),
-                        )
-                        for key, value in keys.items()
-                    ],
-                )
+    # No valid index defined
+    return None
+
+
+def _build_attributes(
+    entity_type: Entity,
+) -> tuple[dict[str, bool], dict[str, tuple[bool, bool]]]:
+    """
+    Collect the primitive attributes and the child relations of the given
+    type, and of all its parent types, in the order in which they should be
+    serialized.
+    """
+    if entity_type.type_string() == SERIALIZABLE_ENTITY_TYPE:
+        # The base entity doesn't have any attribute to serialize
+        return {}, {}
+
+    if SERIALIZABLE_ENTITY_TYPE not in entity_type.get_all_parent_names():
+        # This entity is not a subentity of the serializable entity
+        # its attributes are not serializable
+        return {}, {}
+
+    attributes: dict[str, bool] = {}
+    children: dict[str, tuple[bool, bool]] = {}
+    for super_entity in entity_type.parent_entities:
+        # Let each parent entity contribute the relevant attributes, if they
+        # have the right type
+        super_attributes, super_children = _build_attributes(super_entity)
+        attributes.update(super_attributes)
+        children.update(super_children)
+
+    for attr_name, attr in entity_type.attributes.items():
+        private = attr_name.startswith("_")
+
+        if not isinstance(attr, RelationAttribute):
+            if attr_name in SERIALIZABLE_ENTITY_ATTRIBUTES:
+                # Make sure that any redefinition of the attributes of the base
+                # entity stay ignored
+                continue
+
+            attributes[attr_name] = private
+            continue
+
+        if attr_name == PARENT_RELATION:
+            # We only want the child entities
+            continue
+
+        if attr.end is None:
+            # Child instances will always be bi-directional
+            continue
+
+        child_type = attr.end.entity
+        if not isinstance(child_type, Entity):
+            raise RuntimeError(
+                f"Unexpected type for child relation end's entity: {child_type} ({type(child_type)})"
             )
 
-    # No valid index defined, impossible to derive a relative path.
-    raise LookupError(
-        f"Could not find any valid index on entity {entity_type.type_string()}."
+        if SERIALIZABLE_ENTITY_TYPE not in child_type.get_all_parent_names():
+            # Not a relation towards a serializable entity
+            continue
+
+        children[attr_name] = (private, attr.is_multi())
+
+    return attributes, children
+
+
+def get_schema(entity_type: Entity) -> SerializationSchema:
+    """
+    Get the serialization schema of the given serializable entity type.  The
+    type hierarchy is only walked, and validated, the first time the schema of
+    a type is requested during a compile.
+
+    :param entity_type: The type of a serializable entity.
+    """
+    schema = _schemas.get(entity_type)
+    if schema is None:
+        attributes, children = _build_attributes(entity_type)
+        relation_from_parent = _build_relation_from_parent(entity_type)
+        schema = SerializationSchema(
+            relation_from_parent=relation_from_parent,
+            index_attributes=(
+                _build_index_attributes(entity_type)
+                if relation_from_parent is not None
+                else None
+            ),
+            attributes=list(attributes.items()),
+            children=[
+                (name, private, multi) for name, (private, multi) in children.items()
+            ],
+        )
+        _schemas[entity_type] = schema
+    return schema
+
+
+@inmanta.plugins.plugin()
+def get_relation_from_parent(
+    serializable_entity: SerializableEntity,
+) -> str | None:
+    """
+    Figure out the relation that leads to a serializable entity, from its parent,
+    if it has any.  If the entity has no parent, return None instead.
+
+    :param serializable_entity: An instance of the serializable entity, for
+        which we want to know the relation from the parent.
+    """
+    return get_schema(serializable_entity._type()).relation_from_parent
+
+
+@inmanta.plugins.plugin()
+def get_relative_path(serializable_entity: SerializableEntity) -> str | None:
+    """
+    Calculate the relative path from the parent entity.  If there is no parent
+    entity, return None instead.  The relative path is derived from the index
+    of this entity that contains the relation to the parent entity.
+
+    :param serializable_entity: The instance for which we want to get the
+        path from the parent, or None if the entity doesn't have a parent.
+    """
+    entity_type = serializable_entity._type()
+    schema = get_schema(entity_type)
+    relation_from_parent = schema.relation_from_parent
+    if relation_from_parent is None:
+        # No parent, no relative parent
+        return None
+
+    if schema.index_attributes is None:
+        # No valid index defined, impossible to derive a relative path.
+        raise LookupError(
+            f"Could not find any valid index on entity {entity_type.type_string()}."
+        )
+
+    # If the relation from parent has been overwritten in the mapping of
+    # the parent, we should adapt the relative path too.
+    relation_from_parent = serializable_entity.parent.mapping_overwrite.get(
+        relation_from_parent,
+        relation_from_parent,
     )
 
+    if not schema.index_attributes:
+        # Single instance, use InDict path
+        return str(dict_path.InDict(relation_from_parent))
+
+    # Get the keys and values from the model, normalize the keys, use the
+    # overwrite if it is defined, replace None value by proper escape character
+    mapping_overwrite = serializable_entity.mapping_overwrite
+    keys = []
+    for attr_name in schema.index_attributes:
+        value = getattr(serializable_entity, attr_name)
+        keys.append(
+            (
+                mapping_overwrite.get(attr_name, attr_name),
+                value if value is not None else dict_path.NullValue().escape(),
+            )
+        )
+    return str(dict_path.KeyedList(relation_from_parent, keys))
+
+
+def collect_unset(exc: UnsetException) -> None:
+    """
+    During a serialization plugin call, record the unset value and return, so
+    that the walk of the tree can continue.  Outside of it, or if the unset
+    value is unknown, propagate the exception.
+    """
+    collector = SERIALIZE_UNSET_COLLECTOR.get()
+    variable = exc.get_result_variable()
+    if collector is None or variable is None:
+        raise exc
+    # The compiler raises the exception with the result variable which is not
+    # set yet, see MultiUnsetException
+    collector.append(typing.cast(ResultVariable[object], variable))
+
+
+def collected_unset() -> int:
+    """
+    Get the number of unset values collected so far by the ongoing
+    serialization plugin call, to check whether a part of the walk was
+    complete.
+    """
+    collector = SERIALIZE_UNSET_COLLECTOR.get()
+    return len(collector) if collector is not None else 0
+
+
+def batch_unset[**P, T](
+    message: str,
+    function: typing.Callable[P, T],
+    *args: P.args,
+    **kwargs: P.kwargs,
+) -> T:
+    """
+    Call the given function, collecting all the unset values it reads (see
+    SERIALIZE_UNSET_COLLECTOR).  If any was collected, discard the result and
+    raise them as a single MultiUnsetException.
+
+    :param message: The message of the exception.
+    :param function: The function to call.
+    """
+    collector: list[ResultVariable[object]] = []
+    token = SERIALIZE_UNSET_COLLECTOR.set(collector)
+    try:
+        result = function(*args, **kwargs)
+    except (UnsetException, MultiUnsetException):
+        raise
+    except Exception:
+        # An error may be a consequence of a collected unset value (e.g. an
+        # incomplete list of children), wait for the batch and retry.  A genuine
+        # error surfaces unchanged on the final walk, where nothing is collected.
+        if collector:
+            raise MultiUnsetException(message, list(dict.fromkeys(collector))) from None
+        raise
+    finally:
+        SERIALIZE_UNSET_COLLECTOR.reset(token)
+
+    if collector:
+        raise MultiUnsetException(message, list(dict.fromkeys(collector)))
+
+    return result
+
 
 def get_instance_attributes(
     serializable_entity: SerializableEntity,
@@ -290,53 +575,26 @@ def get_instance_attributes(
     :param serializable_entity: The instance to serialize
     :param serializable_entity_type: The type of the entity to serialize
     """
-    if serializable_entity_type.type_string() == SERIALIZABLE_ENTITY_TYPE:
-        # The base entity doesn't have any attribute to serialize
+    schema = get_schema(serializable_entity_type)
+    if not schema.attributes:
         return {}
 
-    if SERIALIZABLE_ENTITY_TYPE not in serializable_entity_type.get_all_parent_names():
-        # This entity is not a subentity of the serializable entity
-        # its attributes are not serializable
-        return {}
+    mapping_overwrite = serializable_entity.mapping_overwrite
 
     attributes: dict[str, object] = {}
-    for super_entity in serializable_entity_type.parent_entities:
-        # Let each parent entity extract the relevant attributes from the
-        # model, if they have the right type
-        attributes.update(
-            get_instance_attributes(
-                serializable_entity,
-                serializable_entity_type=super_entity,
-            )
-        )
-
-    for attr_name, attr in serializable_entity_type.attributes.items():
-        if attr_name in SERIALIZABLE_ENTITY_ATTRIBUTES:
-            # Make sure that any redefinition of the attributes of the base entity
-            # stay ignored
-            continue
-
-        if isinstance(attr, RelationAttribute):
-            # Only consider primitive attributes
-            continue
-
-        if (
-            attr_name.startswith("_")
-            and attr_name not in serializable_entity.mapping_overwrite
-        ):
+    for attr_name, private in schema.attributes:
+        if private and attr_name not in mapping_overwrite:
             # Private attributes should not be serialized
             continue
 
         # Add the serialized attribute to the dict of attributes
-        serialized_name = serializable_entity.mapping_overwrite.get(
-            attr_name, attr_name
-        )
-        attributes[serialized_name] = json_value(
-            getattr(
-                inmanta.plugins.allow_reference_values(serializable_entity),
-                attr_name,
+        serialized_name = mapping_overwrite.get(attr_name, attr_name)
+        try:
+            attributes[serialized_name] = get_attribute_value(
+                serializable_entity, attr_name
             )
-        )
+        except UnsetException as e:
+            collect_unset(e)
 
     return attributes
 
@@ -349,66 +607,36 @@ def get_child_instances(
     """
     Get all the child serializable entities of a serializable entity.
     """
-    if serializable_entity_type.type_string() == SERIALIZABLE_ENTITY_TYPE:
-        # The base entity doesn't have any attribute to serialize
+    schema = get_schema(serializable_entity_type)
+    if not schema.children:
         return {}
 
-    if SERIALIZABLE_ENTITY_TYPE not in serializable_entity_type.get_all_parent_names():
-        # This entity is not a subentity of the serializable entity
-        # its attributes are not serializable
-        return {}
+    mapping_overwrite = serializable_entity.mapping_overwrite
 
     attributes: dict[str, list[SerializableEntity] | SerializableEntity] = {}
-    for super_entity in serializable_entity_type.parent_entities:
-        # Let each parent entity extract the relevant attributes from the
-        # model, if they have the right type
-        attributes.update(
-            get_child_instances(
-                serializable_entity,
-                serializable_entity_type=super_entity,
-            )
-        )
-
-    for attr_name, attr in serializable_entity_type.attributes.items():
-        if attr_name == PARENT_RELATION:
-            # We only want the child entities
-            continue
-
-        if not isinstance(attr, RelationAttribute):
-            # Only consider primitive attributes
-            continue
-
-        if attr.end is None:
-            # Child instances will always be bi-directional
-            continue
-
-        child_type = attr.end.entity
-        if not isinstance(child_type, Entity):
-            raise RuntimeError(
-                f"Unexpected type for child relation end's entity: {child_type} ({type(child_type)})"
-            )
-
-        if SERIALIZABLE_ENTITY_TYPE not in child_type.get_all_parent_names():
-            # Not a relation towards a serializable entity
-            continue
-
-        if (
-            attr_name.startswith("_")
-            and attr_name not in serializable_entity.mapping_overwrite
-        ):
+    for attr_name, private, multi in schema.children:
+        if private and attr_name not in mapping_overwrite:
             # Private attributes should not be serialized
             continue
 
         # Add the serialized attribute to the dict of attributes
-        serialized_name = serializable_entity.mapping_overwrite.get(
-            attr_name, attr_name
-        )
-        if attr.is_multi():
-            attributes[serialized_name] = list(getattr(serializable_entity, attr_name))
-        else:
-            optional_entity = get_optional_relation(serializable_entity, attr_name)
-            if optional_entity is not None:
-                attributes[serialized_name] = optional_entity
+        serialized_name = mapping_overwrite.get(attr_name, attr_name)
+        try:
+            # The children relations are typed as serializable entities in the
+            # schema
+            if multi:
+                attributes[serialized_name] = typing.cast(
+                    list[SerializableEntity],
+                    get_multi_relation(serializable_entity, attr_name),
+                )
+            else:
+                optional_entity = get_optional_relation(serializable_entity, attr_name)
+                if optional_entity is not None:
+                    attributes[serialized_name] = typing.cast(
+                        SerializableEntity, optional_entity
+                    )
+        except UnsetException as e:
+            collect_unset(e)
 
     return attributes
 
@@ -427,8 +655,33 @@ def serialize(
     When the operation is "merge", the serialized value only contains the attributes of this instance.
     When the operation is "remove", the serialized value is None as we don't need to know its content.
 
+    Each instance is only serialized once per compile, the serialized value of
+    the child instances of a "replace" entity is shared with the value of the
+    parent.  The returned value should therefore never be modified.
+
     :param serializable_entity: An instance of a serializable entity.
     """
+    if serializable_entity in _serialized:
+        SERIALIZE_CACHE_STATS.hits += 1
+        return _serialized[serializable_entity]
+
+    SERIALIZE_CACHE_STATS.misses += 1
+    collected = collected_unset()
+    try:
+        serialized = _serialize(serializable_entity)
+    except UnsetException as e:
+        collect_unset(e)
+        return None
+
+    if collected_unset() == collected:
+        # Only keep complete results
+        _serialized[serializable_entity] = serialized
+    return serialized
+
+
+def _serialize(
+    serializable_entity: SerializableEntity,
+) -> SerializedEntity | None:
     if not serializable_entity.managed:
         # The entity is not managed, no need to serialize it
         return None
@@ -484,103 +737,111 @@ def serialize(
 def serialize_plugin(
     serializable_entity: SerializableEntity,
 ) -> dict | None:  # TODO: https://github.com/edvgui/inmanta-module-files/issues/136
-    return asdict(serialize(serializable_entity))
+    serialized = batch_unset(
+        f"Serialization of {serializable_entity} accessed values that were "
+        "not set yet",
+        serialize,
+        serializable_entity,
+    )
+    return asdict(serialized) if serialized is not None else None
 
 
-def serialize_for_resource(
+def partition(
     serializable_entity: SerializableEntity,
-    resource: JsonResource,
-) -> list[SerializedEntity]:
+) -> dict[JsonResource, list[SerializedEntity]]:
     """
-    Go through the serializable entity tree, and return a list of all
-    the serialized entities which are attached to the given resource.
+    Go through the serializable entity tree once, and group all the serialized
+    entities by the resource they are attached to.  The result is computed
+    once per tree and per compile, see serialize_for_resource.
 
     :param serializable_entity: An entity tree that can be serialized.
-    :param resource: The resource that might be attached to some elements
-        of the tree.
     """
-    current_resource = serializable_entity._resource
-    current_operation = serializable_entity._operation
+    partitioned = _partitions.get(serializable_entity)
+    if partitioned is None:
+        collected = collected_unset()
+        partitioned = {}
+        _partition(serializable_entity, partitioned, excluded=frozenset())
+        for serialized in partitioned.values():
+            serialized.sort(key=lambda s: s.path)
+        if collected_unset() == collected:
+            # Only keep complete results
+            _partitions[serializable_entity] = partitioned
+    return partitioned
+
+
+def _partition(
+    serializable_entity: SerializableEntity,
+    partitioned: dict[JsonResource, list[SerializedEntity]],
+    *,
+    excluded: frozenset[JsonResource],
+) -> None:
+    """
+    Add the serialized entities of the given tree to the partitioned dict.
+
+    :param serializable_entity: An entity tree that can be serialized.
+    :param partitioned: The serialized entities found so far, grouped by
+        resource.
+    :param excluded: The resources which are removing an ancestor of this
+        entity, nothing below it should be attached to them.
+    """
+    try:
+        current_resource = serializable_entity._resource
+        current_operation = serializable_entity._operation
+    except UnsetException as e:
+        collect_unset(e)
+        return
+
+    if current_operation not in (
+        Operation.REPLACE,
+        Operation.REMOVE,
+        Operation.MERGE,
+    ):
+        raise ValueError(f"Unexpected operation: {current_operation}")
+
+    if current_resource not in excluded:
+        serialized = serialize(serializable_entity)
+        if serialized is not None:
+            partitioned.setdefault(current_resource, []).append(serialized)
 
     if current_operation == Operation.REPLACE:
-        # A replace tree is not shared, if the resource is not
-        # attached to this entity, it won't be attached lower
-        # in the tree either
-        if current_resource == resource:
-            serialized = serialize(serializable_entity)
-            return [serialized] if serialized is not None else []
-        else:
-            return []
+        # A replace tree is not shared, nothing lower in the tree is attached
+        # to any other resource
+        return
 
     if current_operation == Operation.REMOVE:
-        if current_resource == resource:
-            # This entity is deleted and attached to our resource, we don't
-            # need to look further in the tree for other deleted elements
-            serialized = serialize(serializable_entity)
-            return [serialized] if serialized is not None else []
+        # The resource of this entity removes it with all its children, the
+        # other resources may still remove some part of the config before this
+        # entity is deleted
+        excluded = excluded | {current_resource}
+
+    # For a merge operation, we might share a part of the tree with any
+    # other resource, we take what we can at every level
+    for instances in get_child_instances(
+        serializable_entity,
+        serializable_entity_type=serializable_entity._type(),
+    ).values():
+        if isinstance(instances, list):
+            for instance in instances:
+                _partition(instance, partitioned, excluded=excluded)
         else:
-            # We still try to see if our resource is supposed to delete some
-            # part of the config before this entity is deleted
-            serialized: list[SerializedEntity | None] = []
-            for _, instances in get_child_instances(
-                serializable_entity,
-                serializable_entity_type=serializable_entity._type(),
-            ).items():
-                if isinstance(instances, list):
-                    for instance in instances:
-                        serialized.extend(
-                            serialize_for_resource(
-                                instance,
-                                resource,
-                            ),
-                        )
-                else:
-                    serialized.extend(
-                        serialize_for_resource(
-                            instances,
-                            resource,
-                        ),
-                    )
-
-            return sorted(
-                [s for s in serialized if s is not None],
-                key=lambda s: s.path,
-            )
+            _partition(instances, partitioned, excluded=excluded)
 
-    if current_operation == Operation.MERGE:
-        # For a merge operation, we might share a part of the tree with any
-        # other resource, we take what we can at ever level and group them
-        # in a list
-        serialized: list[SerializedEntity | None] = []
-        if current_resource == resource:
-            serialized.append(serialize(serializable_entity))
-
-        for _, instances in get_child_instances(
-            serializable_entity,
-            serializable_entity_type=serializable_entity._type(),
-        ).items():
-            if isinstance(instances, list):
-                for instance in instances:
-                    serialized.extend(
-                        serialize_for_resource(
-                            instance,
-                            resource,
-                        ),
-                    )
-            else:
-                serialized.extend(
-                    serialize_for_resource(
-                        instances,
-                        resource,
-                    ),
-                )
 
-        return sorted(
-            [s for s in serialized if s is not None],
-            key=lambda s: s.path,
-        )
+def serialize_for_resource(
+    serializable_entity: SerializableEntity,
+    resource: JsonResource,
+) -> list[SerializedEntity]:
+    """
+    Go through the serializable entity tree, and return a list of all
+    the serialized entities which are attached to the given resource.
+    The tree is only walked once for all the resources attached to it,
+    see partition.
 
-    raise ValueError(f"Unexpected operation: {current_operation}")
+    :param serializable_entity: An entity tree that can be serialized.
+    :param resource: The resource that might be attached to some elements
+        of the tree.
+    """
+    return list(partition(serializable_entity).get(resource, []))
 
 
 @inmanta.plugins.plugin("serialize_for_resource")
@@ -588,7 +849,16 @@ def serialize_for_resource_plugin(
     serializable_entity: SerializableEntity,
     resource: JsonResource,
 ) -> list[dict]:  # TODO: https://github.com/edvgui/inmanta-module-files/issues/136
-    return [asdict(s) for s in serialize_for_resource(serializable_entity, resource)]
+    return [
+        asdict(s)
+        for s in batch_unset(
+            f"Serialization of {serializable_entity} for {resource} accessed values "
+            "that were not set yet",
+            serialize_for_resource,
+            serializable_entity,
+            resource,
+        )
+    ]
 
 
 @inmanta.plugins.plugin()
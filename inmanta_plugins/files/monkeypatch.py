@@ -16,9 +16,9 @@ limitations under the License.
 Contact: edvgui@gmail.com
 """
 
-import contextlib
+import contextvars
 import typing
-from collections.abc import Collection, Iterator
+from dataclasses import dataclass
 
 from inmanta_plugins.std import JinjaDynamicProxy
 
@@ -26,61 +26,95 @@ from inmanta.ast import UnsetException
 from inmanta.execute.proxy import DynamicProxy, ProxyContext
 from inmanta.references import Reference
 
+# Attribute set on the patched functions, holding the function they replace.
+# Patching a function which is already patched (e.g. when this module is
+# reloaded) replaces the existing patch instead of stacking a new one on top.
+ORIGINAL = "__files_original__"
 
-@contextlib.contextmanager
-def overwrite_reference_str(
-    ref_cls: type[Reference],
-    register_reference: typing.Callable[[Reference], str],
-) -> Iterator[None]:
+
+@dataclass(frozen=True, kw_only=True)
+class RenderHooks:
+    """
+    The callbacks used by the patches below while a jinja template is being
+    rendered by the jinja plugin.
+
+    :attr register_reference: Called instead of the __str__ method of the
+        patched reference classes, to register the reference in the current
+        jinja reference context.
+    :attr collect_or_raise: Called with the UnsetException raised when a
+        template reads a model value which is not frozen yet.
+    """
+
+    register_reference: typing.Callable[[Reference], str]
+    collect_or_raise: typing.Callable[[UnsetException], object]
+
+
+# The hooks of the jinja render running in the current context, if any.  The
+# patches are installed once, and only change the behavior of the patched
+# methods while this variable is set, i.e. during a jinja render.  Code running
+# outside of a jinja render (e.g. the compiler logging a rescheduled plugin
+# call) always gets the original behavior.
+JINJA_RENDER_HOOKS: contextvars.ContextVar[RenderHooks | None] = contextvars.ContextVar(
+    "files_jinja_render_hooks", default=None
+)
+
+# The classes whose methods have been patched by this module
+_patched: set[type] = set()
+
+
+def get_original[F](func: F) -> F:
+    """
+    Get the original implementation of a function patched by this module.
+    """
+    return getattr(func, ORIGINAL, func)
+
+
+def patch_reference_str(ref_cls: type[Reference]) -> None:
     """
     Overwrite the __str__ method of a reference class, to call the register_reference
-    method instead.  This is used by the jinja template to automatically catch
-    references which are about to be serialized by jinja, and register these
-    references for the jinja reference context.
-
-    The patch is only active for the duration of the context manager, so a
-    reference being serialized outside of a jinja render (e.g. by the compiler
-    when logging a rescheduled plugin call) keeps its normal string
-    representation.
+    hook instead during a jinja render.  This is used by the jinja template to
+    automatically catch references which are about to be serialized by jinja, and
+    register these references for the jinja reference context.
     """
-    original_str = ref_cls.__str__
+    if ref_cls in _patched:
+        return
+
+    original_str = get_original(ref_cls.__str__)
 
     def __str__(self: object) -> str:
+        hooks = JINJA_RENDER_HOOKS.get()
+        if hooks is None:
+            return original_str(self)
+
         if not isinstance(self, Reference):
             raise ValueError(f"Invalid type for {type(self)} it is not a Reference")
 
-        return register_reference(self)
+        return hooks.register_reference(self)
 
-    # Overwrite the reference class's str method with our own special one
+    setattr(__str__, ORIGINAL, original_str)
     ref_cls.__str__ = __str__
-
-    try:
-        yield None
-    finally:
-        # Make sure that this method is not patched outside of the context of
-        # this function
-        ref_cls.__str__ = original_str
+    _patched.add(ref_cls)
 
 
-@contextlib.contextmanager
-def allow_references_in_templates(
-    ref_classes: Collection[type[Reference]],
-    register_reference: typing.Callable[[Reference], str],
-) -> Iterator[None]:
+def install_patches() -> None:
     """
-    This contextmanager temporarily allows the usage of references in jinja
-    templates.  It monkeypatches core and std so that references aren't blocked
-    when wrapped in a dynamic proxy, and overwrites the __str__ method of the
-    known reference classes so that they register themselves in the current
-    jinja reference context when serialized.
-
-    All patches are reverted when the context manager is exited (even on error),
-    so they never leak to code running outside of a jinja render.
+    Monkeypatch core and std so that references aren't blocked when wrapped in
+    a dynamic proxy, and so that reading a model value which is not frozen yet
+    is reported to the collect_or_raise hook instead of aborting the render at
+    the first miss.
+
+    The patches are installed once per process, and are only active during a
+    jinja render (see JINJA_RENDER_HOOKS), so entering and leaving a render only
+    costs a context variable update.
     """
-    # Register original implementations so they can be restored when the
-    # contextmanager is exited
-    original_jinja_dynamic_proxy_return_value = JinjaDynamicProxy.return_value
-    original_dynamic_proxy_return_value = DynamicProxy._return_value
+    if JinjaDynamicProxy in _patched:
+        return
+
+    original_jinja_dynamic_proxy_return_value = get_original(
+        JinjaDynamicProxy.return_value.__func__
+    )
+    original_dynamic_proxy_return_value = get_original(DynamicProxy._return_value)
+    original_getattr = get_original(JinjaDynamicProxy.__getattr__)
 
     def return_value(
         cls: type[JinjaDynamicProxy],
@@ -92,6 +126,11 @@ def allow_references_in_templates(
         Alternative implementation of JinjaDynamicProxy.return_value which doesn't
         block the usage of References in templates.
         """
+        if JINJA_RENDER_HOOKS.get() is None:
+            return original_jinja_dynamic_proxy_return_value(
+                cls, value, context=context
+            )
+
         context = (
             context
             if context is not None
@@ -104,6 +143,7 @@ def allow_references_in_templates(
 
     # Overwrite the return_value method of JinjaDynamicProxy to allow usage of
     # references in templates.
+    setattr(return_value, ORIGINAL, original_jinja_dynamic_proxy_return_value)
     JinjaDynamicProxy.return_value = classmethod(return_value)
 
     def _return_value(
@@ -113,6 +153,11 @@ def allow_references_in_templates(
         Alternative implementation of DynamicProxy._return_value which doesn't
         block the usage of References in templates.
         """
+        if JINJA_RENDER_HOOKS.get() is None:
+            return original_dynamic_proxy_return_value(
+                self, value, relative_path=relative_path
+            )
+
         context: ProxyContext = self._get_context()
         value_context: ProxyContext = context.nested(relative_path=relative_path)
 
@@ -120,49 +165,26 @@ def allow_references_in_templates(
 
     # Overwrite the _return_value method of DynamicProxy to allow usage of
     # references in templates.
+    setattr(_return_value, ORIGINAL, original_dynamic_proxy_return_value)
     DynamicProxy._return_value = _return_value
 
-    with contextlib.ExitStack() as stack:
-        # Patch known reference classes so they can be registered automatically
-        for ref_cls in ref_classes:
-            stack.enter_context(overwrite_reference_str(ref_cls, register_reference))
-
-        try:
-            yield None
-        finally:
-            # Make sure that these functions are not patched outside of the
-            # context of this function
-            JinjaDynamicProxy.return_value = original_jinja_dynamic_proxy_return_value
-            DynamicProxy._return_value = original_dynamic_proxy_return_value
-
-
-@contextlib.contextmanager
-def collect_unset_values(
-    collect_or_raise: typing.Callable[[UnsetException], object],
-) -> Iterator[None]:
-    """
-    Temporarily patch JinjaDynamicProxy.__getattr__ so that reading a model
-    value which is not frozen yet is reported to collect_or_raise instead of
-    aborting the render at the first miss.
-
-    This enables the one-pass dependency discovery implemented by the jinja
-    plugin: collect_or_raise records the miss and returns a chaining-undefined,
-    so the render keeps going and reaches the other (independent) unset values.
-
-    The patch is reverted when the context manager is exited (even on error), so
-    it never leaks to code running outside of a jinja render.
-    """
-    original_getattr = JinjaDynamicProxy.__getattr__
-
     def __getattr__(self: JinjaDynamicProxy, name: str) -> object:
+        """
+        Alternative implementation of JinjaDynamicProxy.__getattr__ which reports
+        unset values to the collect_or_raise hook.  This enables the one-pass
+        dependency discovery implemented by the jinja plugin: collect_or_raise
+        records the miss and returns a chaining-undefined, so the render keeps
+        going and reaches the other (independent) unset values.
+        """
         try:
             return original_getattr(self, name)
         except UnsetException as e:
-            return collect_or_raise(e)
+            hooks = JINJA_RENDER_HOOKS.get()
+            if hooks is None:
+                raise
+            return hooks.collect_or_raise(e)
 
+    setattr(__getattr__, ORIGINAL, original_getattr)
     JinjaDynamicProxy.__getattr__ = __getattr__
 
-    try:
-        yield None
-    finally:
-        JinjaDynamicProxy.__getattr__ = original_getattr
+    _patched.add(JinjaDynamicProxy)
@@ -0,0 +1,117 @@
+"""
+Copyright 2026 Guillaume Everarts de Velp
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Contact: edvgui@gmail.com
+"""
+
+import concurrent.futures
+import contextvars
+import os
+import threading
+from collections.abc import Mapping
+
+from inmanta.agent.handler import LoggerABC
+from inmanta.references import Reference
+
+# The maximum number of references resolved concurrently by a reference
+# embedding several other references (e.g. a JinjaReference), configured with
+# an environment variable on the agent.  By default, all the references are
+# resolved one after the other, as the process resolving them (e.g. the
+# compiler) may not expect any thread to be started.
+RESOLUTION_THREADS_ENV = "INMANTA_FILES_RESOLUTION_THREADS"
+DEFAULT_RESOLUTION_THREADS = 1
+
+# Set while a reference is resolved by a thread of the pool.  References
+# resolved by such a thread resolve their own references themselves, waiting
+# for other tasks of the pool from one of its threads could exhaust it.
+_IN_POOL: contextvars.ContextVar[bool] = contextvars.ContextVar(
+    "files_resolution_in_pool", default=False
+)
+
+_executor: tuple[int, concurrent.futures.ThreadPoolExecutor] | None = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> concurrent.futures.ThreadPoolExecutor | None:
+    """
+    Get the thread pool resolving references concurrently, configured from the
+    environment variables of the process.  Returns None if references should
+    be resolved one after the other.
+    """
+    global _executor
+
+    max_workers = int(
+        os.environ.get(RESOLUTION_THREADS_ENV, DEFAULT_RESOLUTION_THREADS)
+    )
+    if max_workers <= 1:
+        return None
+
+    with _executor_lock:
+        if _executor is None or _executor[0] != max_workers:
+            if _executor is not None:
+                _executor[1].shutdown(wait=False)
+            _executor = (
+                max_workers,
+                concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max_workers,
+                    thread_name_prefix="files-resolution",
+                ),
+            )
+        return _executor[1]
+
+
+def _resolve_in_pool(
+    reference: Reference, value: Reference[str], logger: LoggerABC
+) -> str:
+    _IN_POOL.set(True)
+    return reference.resolve_other(value, logger)
+
+
+def resolve_all(
+    reference: Reference,
+    values: Mapping[str, str | Reference[str]],
+    logger: LoggerABC,
+) -> dict[str, str]:
+    """
+    Resolve all the given values, which may be references, on behalf of the
+    given reference.  The references are independent of each other, so when
+    there are several of them, they are resolved concurrently, and the whole
+    resolution takes roughly as long as the slowest of them.  If any of them
+    fails, the error of the first one (in order) is raised, as if they were
+    resolved one after the other.
+
+    :param reference: The reference embedding the values.
+    :param values: The values to resolve, by name.
+    :param logger: The logger of the resolution.
+    """
+    # The same reference can be used under several names, it is only resolved
+    # once
+    distinct = {id(v): v for v in values.values() if isinstance(v, Reference)}
+    executor = get_executor() if len(distinct) > 1 and not _IN_POOL.get() else None
+    if executor is None:
+        return {k: reference.resolve_other(v, logger) for k, v in values.items()}
+
+    # Each task runs in a copy of the current context, as it would if the
+    # references were resolved by this thread
+    futures = {
+        key: executor.submit(
+            contextvars.copy_context().run, _resolve_in_pool, reference, value, logger
+        )
+        for key, value in distinct.items()
+    }
+    return {
+        k: futures[id(v)].result() if isinstance(v, Reference) else v
+        for k, v in values.items()
+    }
@@ -20,9 +20,11 @@ import inmanta.agent.handler
 import inmanta.resources
 import inmanta_plugins.files.base
 from inmanta.plugins import plugin
+from inmanta_plugins.files.filters import deterministic
 
 
 @plugin
+@deterministic
 def quote(s: str) -> str:
     """
     Quote a string with double quotes and escape the following characters:
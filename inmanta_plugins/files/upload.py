@@ -16,6 +16,9 @@ limitations under the License.
 Contact: edvgui@gmail.com
 """
 
+import hashlib
+import io
+
 import inmanta.compiler
 import inmanta.execute.proxy
 import inmanta.export
@@ -45,10 +48,47 @@ def collect_snapshot(content: bytes) -> str:
     :return: The hash of the content, which can be used to retrieve it.
     """
     file_hash = inmanta.export.hash_file(content)
+    _register_snapshot(file_hash, content)
+    return file_hash
+
+
+def _register_snapshot(file_hash: str, content: bytes) -> None:
     _snapshots[file_hash] = content
     if _exporter is not None:
         _exporter.upload_file(content)
-    return file_hash
+
+
+class SnapshotWriter:
+    """
+    Build the snapshot of a file from a stream of text chunks, e.g. the output
+    of a jinja template being rendered.  The chunks are encoded and hashed as
+    they are written, so that the only full copy of the content is the one
+    which is uploaded, instead of the text, the encoded text and the snapshot.
+    """
+
+    def __init__(self) -> None:
+        self._buffer = io.BytesIO()
+        # Same hash as inmanta.export.hash_file, used by collect_snapshot
+        self._hash = hashlib.sha1()
+
+    def write(self, text: str) -> None:
+        """
+        Append the given text to the content of the file.
+        """
+        chunk = text.encode()
+        self._buffer.write(chunk)
+        self._hash.update(chunk)
+
+    def collect(self) -> str:
+        """
+        Freeze the content written so far and register it for upload to the
+        server, the same way collect_snapshot does.
+
+        :return: The hash of the content, which can be used to retrieve it.
+        """
+        file_hash = self._hash.hexdigest()
+        _register_snapshot(file_hash, self._buffer.getvalue())
+        return file_hash
 
 
 def get_snapshot(file_hash: str) -> bytes | None:
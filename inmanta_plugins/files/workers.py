@@ -0,0 +1,121 @@
+"""
+Copyright 2026 Guillaume Everarts de Velp
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Contact: edvgui@gmail.com
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import types
+from collections.abc import Mapping
+
+import jinja2
+
+import inmanta_plugins.files.cache
+from inmanta.references import Reference
+
+# The number of worker processes rendering templates in parallel of the
+# compiler, configured with an environment variable on the compiler process.
+# Setting it to 0 renders all the templates in the compiler process.
+RENDER_WORKERS_ENV = "INMANTA_FILES_RENDER_WORKERS"
+
+# The default number of workers: the compiler keeps running while they render,
+# and each worker is a whole python process, so only half of the cpus are used,
+# and no more than a few workers.
+DEFAULT_RENDER_WORKERS = max(1, min(4, (os.cpu_count() or 1) // 2))
+
+_executor: tuple[int, concurrent.futures.ProcessPoolExecutor] | None = None
+
+# The environment rendering the templates in a worker process.  It only knows
+# the builtin filters and tests of jinja, see TemplateAnalysis.standalone.
+_worker_env: jinja2.Environment | None = None
+
+
+def get_executor() -> concurrent.futures.ProcessPoolExecutor | None:
+    """
+    Get the pool of processes rendering templates, configured from the
+    environment variables of the compiler process.  Returns None if templates
+    should be rendered by the compiler process.  The pool is kept for the
+    lifetime of the process, so that the templates compiled by the workers are
+    reused by the next compiles.
+    """
+    global _executor
+
+    max_workers = int(os.environ.get(RENDER_WORKERS_ENV, DEFAULT_RENDER_WORKERS))
+    if max_workers <= 0:
+        return None
+
+    if _executor is None or _executor[0] != max_workers:
+        if _executor is not None:
+            _executor[1].shutdown(wait=False)
+        # The compiler runs other threads, forking it could copy the locks
+        # they hold.  The workers are started from a clean process instead,
+        # they only import this module to render the templates.
+        _executor = (
+            max_workers,
+            concurrent.futures.ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            ),
+        )
+    return _executor[1]
+
+
+def is_plain(value: object) -> bool:
+    """
+    Check whether the given value, as converted by
+    inmanta_plugins.files.analysis.snapshot, can be sent to a worker process:
+    it doesn't contain any reference.
+    """
+    match value:
+        case Reference():
+            return False
+        case types.SimpleNamespace():
+            return all(is_plain(v) for v in vars(value).values())
+        case Mapping():
+            return all(is_plain(v) for v in value.values())
+        case list() | tuple():
+            return all(is_plain(v) for v in value)
+        case _:
+            return True
+
+
+def _render(source: str, inputs: Mapping[str, object]) -> str:
+    global _worker_env
+    if _worker_env is None:
+        _worker_env = jinja2.Environment(undefined=jinja2.StrictUndefined)
+
+    # Each worker keeps its own cache of compiled templates
+    template, _ = inmanta_plugins.files.cache.load_inline_template(_worker_env, source)
+    return template.render(inputs)
+
+
+def submit(
+    source: str, inputs: Mapping[str, object]
+) -> concurrent.futures.Future[str] | None:
+    """
+    Render the given template with the given inputs in a worker process.
+    Return the future output of the render, or None if there is no worker.
+
+    :param source: The source of the template, which must be standalone (see
+        TemplateAnalysis.standalone).
+    :param inputs: The inputs of the template, as converted by
+        inmanta_plugins.files.analysis.snapshot, without any reference.
+    """
+    executor = get_executor()
+    if executor is None:
+        return None
+    return executor.submit(_render, source, inputs)
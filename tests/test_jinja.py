@@ -23,8 +23,10 @@ import jinja2
 import pytest
 from pytest_inmanta.plugin import Project
 
+import inmanta.ast
 import inmanta.plugins
 from inmanta.agent.handler import PythonLogger
+from inmanta.references import Reference
 
 LOGGER = logging.getLogger()
 
@@ -249,8 +251,10 @@ def test_one_pass_unset_discovery(project: Project, tmp_path: pathlib.Path) -> N
 
     template_dir = pathlib.Path(project._test_project_dir, "templates")
     template_dir.mkdir(parents=True, exist_ok=True)
+    # The values are read conditionally, so they can't be checked before the
+    # render, and are discovered by the render instead.
     (template_dir / "multi.j2").write_text(
-        "{{ config.a }}-{{ config.b }}-{{ config.c }}"
+        "{% if config is defined %}{{ config.a }}-{{ config.b }}-{{ config.c }}{% endif %}"
     )
 
     # Count full template renders, and record how many misses the collector held
@@ -327,3 +331,1092 @@ def test_one_pass_unset_discovery(project: Project, tmp_path: pathlib.Path) -> N
     assert max(pass_sizes) == 3
     # One discovery render that collected the batch, then one clean render.
     assert render_count == 2
+
+
+def test_nested_renders(project: Project) -> None:
+    """
+    A template rendered by another template through the files.jinja filter is
+    only rendered once per distinct set of arguments, and the values it is
+    waiting for are discovered by the same render as the values the outer
+    template is waiting for.
+    """
+    import inmanta_plugins.files as files_plugin
+
+    template_dir = pathlib.Path(project._test_project_dir, "templates")
+    template_dir.mkdir(parents=True, exist_ok=True)
+    (template_dir / "outer.j2").write_text(
+        "{% for i in range(3) %}"
+        "{{ 'template:///inner.j2' | files.jinja(config=config) }};"
+        "{% endfor %}"
+        "{% if config is defined %}{{ config.a }}{% endif %}"
+    )
+    (template_dir / "inner.j2").write_text(
+        "{% if config is defined %}{{ config.b }}{% endif %}"
+    )
+
+    pass_sizes: list[int] = []
+    original_collect = files_plugin.collect_or_raise
+
+    def spy_collect(exc: object) -> object:
+        result = original_collect(exc)
+        collector = files_plugin.JINJA_UNSET_COLLECTOR.get()
+        if collector is not None:
+            pass_sizes.append(len(collector))
+        return result
+
+    files_plugin.collect_or_raise = spy_collect
+    try:
+        project.compile(
+            """
+            import files
+            import files::host
+            import mitogen
+            import std
+
+            host = std::Host(
+                name="localhost",
+                os=std::linux,
+                via=mitogen::Local(),
+            )
+
+            entity Config:
+                string a
+                string b
+            end
+            implement Config using compute
+
+            implementation compute for Config:
+                self.a = "AAA"
+                self.b = "BBB"
+            end
+
+            files::TextFile(
+                path="/a",
+                content=files::jinja("template:///outer.j2", config=Config()),
+                host=host,
+            )
+            """,
+            no_dedent=False,
+        )
+    finally:
+        files_plugin.collect_or_raise = original_collect
+
+    file = project.get_instances("files::TextFile").pop()
+    assert file.content == "BBB;BBB;BBB;AAA"
+
+    # The unset value of the nested render was merged in the outer collector
+    assert max(pass_sizes) == 2
+
+    # The inner template was rendered once by the final render of the outer one
+    assert files_plugin.NESTED_RENDER_STATS.hits == 2
+
+
+def test_unset_values_checked_before_render(
+    project: Project, tmp_path: pathlib.Path
+) -> None:
+    """
+    The values read by every render of a template are checked before rendering
+    it, if some of them are not set yet, the compiler waits for all of them at
+    once without rendering the template.
+    """
+    import inmanta_plugins.files as files_plugin
+
+    template_dir = pathlib.Path(project._test_project_dir, "templates")
+    template_dir.mkdir(parents=True, exist_ok=True)
+    (template_dir / "unconditional.j2").write_text(
+        "{{ config.a }}-{{ config.b }}{% for c in config.c %}-{{ c }}{% endfor %}"
+    )
+
+    render_count = 0
+    original_render = jinja2.Template.render
+
+    def counting_render(self: jinja2.Template, *args: object, **kwargs: object) -> str:
+        nonlocal render_count
+        render_count += 1
+        return original_render(self, *args, **kwargs)
+
+    collected: list[object] = []
+    original_collect = files_plugin.collect_or_raise
+
+    def spy_collect(exc: object) -> object:
+        collected.append(exc)
+        return original_collect(exc)
+
+    jinja2.Template.render = counting_render
+    files_plugin.collect_or_raise = spy_collect
+    try:
+        project.compile(
+            """
+            import files
+            import files::host
+            import mitogen
+            import std
+
+            host = std::Host(
+                name="localhost",
+                os=std::linux,
+                via=mitogen::Local(),
+            )
+
+            entity Config:
+                string a
+                string b
+                string[] c
+            end
+            implement Config using compute
+
+            implementation compute for Config:
+                self.a = "AAA"
+                self.b = "BBB"
+                self.c = ["C1", "C2"]
+            end
+
+            config = Config()
+
+            files::TextFile(
+                path="/a",
+                content=files::jinja("template:///unconditional.j2", config=config),
+                host=host,
+            )
+            """,
+            no_dedent=False,
+        )
+    finally:
+        jinja2.Template.render = original_render
+        files_plugin.collect_or_raise = original_collect
+
+    file = project.get_instances("files::TextFile").pop()
+    assert file.content == "AAA-BBB-C1-C2"
+
+    # No discovery render was needed, the template is only rendered once all
+    # its values are set.
+    assert collected == []
+    assert render_count == 1
+
+
+def test_loop_body_is_conditional(project: Project) -> None:
+    """
+    The body of a loop doesn't run when the collection is empty, the values it
+    reads are not read by every render of the template.
+    """
+    from inmanta_plugins.files.analysis import ITEMS, analyze
+
+    analysis = analyze(
+        jinja2.Environment().parse(
+            "{% for c in config.c %}{{ c }}-{{ config.a }}{% endfor %}"
+        )
+    )
+    config = analysis.roots["config"]
+    assert config.required
+    # The items are always iterated, the other values are only read when there
+    # is any
+    assert config.children["c"].children[ITEMS].required
+    assert not config.children["a"].required
+
+
+def test_block_body_is_conditional(project: Project) -> None:
+    """
+    The body of a block doesn't run when the template extends a parent template
+    which doesn't render it, the values it reads are not read by every render.
+    """
+    from inmanta_plugins.files.analysis import analyze
+
+    analysis = analyze(
+        jinja2.Environment().parse(
+            "{{ config.a }}{% block content %}{{ config.b }}{% endblock %}"
+        )
+    )
+    config = analysis.roots["config"]
+    assert config.children["a"].required
+    assert not config.children["b"].required
+
+
+def test_learned_unset_values(project: Project, tmp_path: pathlib.Path) -> None:
+    """
+    The values a discovery render of a template had to wait for are checked
+    before rendering the same template for other inputs, so that only the
+    first render of the template is a discovery render.
+    """
+    import inmanta_plugins.files as files_plugin
+
+    template_dir = pathlib.Path(project._test_project_dir, "templates")
+    template_dir.mkdir(parents=True, exist_ok=True)
+    (template_dir / "learned.j2").write_text(
+        "{% if config is defined %}{{ config.a }}-{{ config.b }}{% endif %}"
+    )
+
+    render_count = 0
+    original_render = jinja2.Template.render
+
+    def counting_render(self: jinja2.Template, *args: object, **kwargs: object) -> str:
+        nonlocal render_count
+        render_count += 1
+        return original_render(self, *args, **kwargs)
+
+    collected: list[object] = []
+    original_collect = files_plugin.collect_or_raise
+
+    def spy_collect(exc: object) -> object:
+        collected.append(exc)
+        return original_collect(exc)
+
+    jinja2.Template.render = counting_render
+    files_plugin.collect_or_raise = spy_collect
+    try:
+        project.compile(
+            """
+            import files
+            import files::host
+            import mitogen
+            import std
+
+            host = std::Host(
+                name="localhost",
+                os=std::linux,
+                via=mitogen::Local(),
+            )
+
+            entity Config:
+                string name
+                string a
+                string b
+            end
+            implement Config using compute
+
+            implementation compute for Config:
+                self.a = name
+                self.b = name
+            end
+
+            for name in ["x", "y", "z"]:
+                files::TextFile(
+                    path="/{{ name }}",
+                    content=files::jinja(
+                        "template:///learned.j2",
+                        config=Config(name=name),
+                    ),
+                    host=host,
+                )
+            end
+            """,
+            no_dedent=False,
+        )
+    finally:
+        jinja2.Template.render = original_render
+        files_plugin.collect_or_raise = original_collect
+
+    contents = {f.path: f.content for f in project.get_instances("files::TextFile")}
+    assert contents == {"/x": "x-x", "/y": "y-y", "/z": "z-z"}
+
+    # A single discovery render, then one clean render per file
+    assert len(collected) == 2
+    assert render_count == 4
+
+
+def test_patches_only_active_in_render(project: Project) -> None:
+    """
+    The monkeypatches installed by the jinja plugin are only active while a
+    jinja render is running in the current context.
+    """
+    from inmanta_plugins.files import TextReference
+    from inmanta_plugins.files.monkeypatch import (
+        JINJA_RENDER_HOOKS,
+        RenderHooks,
+        get_original,
+    )
+
+    ref = TextReference("a", None)
+    assert str(ref) == get_original(Reference.__str__)(ref)
+
+    registered: list[Reference] = []
+
+    def register(value: Reference) -> str:
+        registered.append(value)
+        return "registered"
+
+    token = JINJA_RENDER_HOOKS.set(
+        RenderHooks(register_reference=register, collect_or_raise=lambda e: None)
+    )
+    try:
+        assert str(ref) == "registered"
+    finally:
+        JINJA_RENDER_HOOKS.reset(token)
+
+    assert registered == [ref]
+    assert str(ref) == get_original(Reference.__str__)(ref)
+
+
+def test_stream_output(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    With stream_output, the output of a template which emits a reference is
+    written directly into the snapshot uploaded to the server.  The result is
+    the same as without streaming.
+    """
+    from inmanta_plugins.std import EnvironmentReference
+
+    import inmanta_plugins.files.upload
+    from inmanta_plugins.files import SplicedJinjaReference, TextReference
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text(
+        """{% for i in range(3) %}{{ i }}\n{% endfor %}"""
+        """ENV={{ "TEST" | std.create_environment_reference() }}"""
+    )
+    other_template_path = tmp_path / "test_2.j2"
+    other_template_path.write_text("Hello {{ name }}!")
+
+    project.compile(
+        f"""
+        import std
+        import files
+        import files::host
+        import mitogen
+
+        host = std::Host(
+            name="localhost",
+            os=std::linux,
+            via=mitogen::Local(),
+        )
+
+        files::TextFile(
+            path="/a",
+            content=files::jinja("file://{template_path}", stream_output=true),
+            host=host,
+        )
+
+        files::TextFile(
+            path="/b",
+            content=files::jinja(
+                "file://{other_template_path}",
+                stream_output=true,
+                name="world",
+            ),
+            host=host,
+        )
+        """,
+        no_dedent=False,
+    )
+
+    files = {f.path: f for f in project.get_instances("files::TextFile")}
+
+    # No reference, the output is returned as is
+    assert files["/b"].content == "Hello world!"
+
+    file = inmanta.plugins.allow_reference_values(files["/a"])
+    assert isinstance(file.content, SplicedJinjaReference)
+    assert isinstance(file.content.template, TextReference)
+    assert file.content.offsets == [19]
+
+    # The snapshot is collected during the render, the reference only holds
+    # its hash
+    assert file.content.template.text is None
+    snapshot = inmanta_plugins.files.upload.get_snapshot(file.content.template.hash)
+    assert snapshot == (
+        b"{% raw %}0\n1\n2\nENV={% endraw %}"
+        b'{{ references["3ad25aea-bd44-30d8-8da3-f4c5e58e3d1e"] }}'
+        b"{% raw %}{% endraw %}"
+    )
+    assert file.content.references == {
+        "3ad25aea-bd44-30d8-8da3-f4c5e58e3d1e": EnvironmentReference("TEST")
+    }
+
+    with monkeypatch.context() as ctx:
+        ctx.setenv("TEST", "b")
+        assert file.content.resolve(PythonLogger(LOGGER)) == "0\n1\n2\nENV=b"
+
+
+def test_skeleton(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    With skeleton, the template of the reference returned by the plugin only
+    holds the static text of the template, it is the same for all the renders.
+    The values are passed along with the references.
+    """
+    from inmanta_plugins.std import EnvironmentReference
+
+    from inmanta_plugins.files import JinjaReference
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text(
+        "name={{ name }}\nsecret={{ secret | std.create_environment_reference() }}\n"
+    )
+
+    project.compile(
+        f"""
+        import std
+        import files
+        import files::host
+        import mitogen
+
+        host = std::Host(
+            name="localhost",
+            os=std::linux,
+            via=mitogen::Local(),
+        )
+
+        for name in ["a", "b"]:
+            files::TextFile(
+                path="/{{{{ name }}}}",
+                content=files::jinja(
+                    "file://{template_path}",
+                    skeleton=true,
+                    name=name,
+                    secret=std::upper(name),
+                ),
+                host=host,
+            )
+        end
+
+        files::TextFile(
+            path="/c",
+            content=files::jinja_inline(
+                r"Hello {{{{ name }}}}!",
+                skeleton=true,
+                name="c",
+            ),
+            host=host,
+        )
+        """,
+        no_dedent=False,
+    )
+
+    files = {
+        f.path: inmanta.plugins.allow_reference_values(f)
+        for f in project.get_instances("files::TextFile")
+    }
+
+    # No reference, the values are written in the output
+    assert files["/c"].content == "Hello c!"
+
+    a, b = files["/a"].content, files["/b"].content
+    assert isinstance(a, JinjaReference) and isinstance(b, JinjaReference)
+    assert a.template == b.template
+    assert a.template.text == (
+        "{% raw %}name={% endraw %}"
+        '{{ references["parameter_0"] }}'
+        "{% raw %}\nsecret={% endraw %}"
+        '{{ references["parameter_1"] }}'
+        "{% raw %}{% endraw %}"
+    )
+    assert a.references == {
+        "parameter_0": "a",
+        "parameter_1": EnvironmentReference("A"),
+    }
+
+    with monkeypatch.context() as ctx:
+        ctx.setenv("B", "secret")
+        # The trailing newline of the template is dropped by jinja
+        assert b.resolve(PythonLogger(LOGGER)) == "name=b\nsecret=secret"
+
+
+def test_snapshot_inputs(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    With snapshot, the template is rendered with plain copies of the values it
+    reads from its inputs, and the output is the same as when rendering it
+    with the dynamic proxies.
+    """
+    import inmanta_plugins.files.analysis
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text(
+        "[{{ config.name }}]\n"
+        "{% for option in config.options %}"
+        "{% if option.value is not none %}{{ option.name }}={{ option.value }}\n"
+        "{% endif %}"
+        "{% endfor %}"
+        "{% for k, v in config.extra.items() %}{{ k }}={{ v }}\n{% endfor %}"
+        "{% if config.parent is defined %}parent={{ config.parent.name }}{% endif %}"
+    )
+
+    snapshots: list[object] = []
+    original_snapshot = inmanta_plugins.files.analysis.snapshot
+
+    def spy_snapshot(*args: object) -> object:
+        result = original_snapshot(*args)
+        snapshots.append(result)
+        return result
+
+    monkeypatch.setattr(inmanta_plugins.files.analysis, "snapshot", spy_snapshot)
+
+    project.compile(
+        f"""
+        import std
+        import files
+        import files::host
+        import mitogen
+
+        entity Config:
+            string name
+            dict extra = {{}}
+        end
+        Config.options [0:] -- Option
+        Config.parent [0:1] -- Config
+        implement Config using std::none
+
+        entity Option:
+            string name
+            int? value = null
+        end
+        implement Option using std::none
+
+        host = std::Host(
+            name="localhost",
+            os=std::linux,
+            via=mitogen::Local(),
+        )
+
+        for name in ["a", "b"]:
+            config = Config(
+                name=name,
+                extra={{"k": name}},
+                options=[Option(name="x", value=1), Option(name="y")],
+                parent=Config(name="parent"),
+            )
+
+            files::TextFile(
+                path="/{{{{ name }}}}",
+                content=files::jinja(
+                    "file://{template_path}",
+                    snapshot=name == "b",
+                    config=config,
+                ),
+                host=host,
+            )
+        end
+        """,
+        no_dedent=False,
+    )
+
+    files = {f.path: f.content for f in project.get_instances("files::TextFile")}
+    assert files["/a"] == "[a]\nx=1\nk=a\nparent=parent"
+    assert files["/b"] == "[b]\nx=1\nk=b\nparent=parent"
+
+    # The snapshot was used for the final render
+    assert snapshots and snapshots[-1] is not None
+
+
+def test_parallel_render(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    With parallel, templates which only use the builtins of jinja are rendered
+    in a worker process, and the plugin returns a reference to their output.
+    Other templates are rendered by the compiler.
+    """
+    from inmanta_plugins.files import RenderedTextReference
+    from inmanta_plugins.files.workers import RENDER_WORKERS_ENV
+
+    monkeypatch.setenv(RENDER_WORKERS_ENV, "2")
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text(
+        "[{{ config.name | upper }}]\n"
+        "{% for alias in config.aliases %}{{ alias }}\n{% endfor %}"
+    )
+    other_template_path = tmp_path / "test_2.j2"
+    other_template_path.write_text("{{ config.name | files.path_join('b') }}")
+
+    project.compile(
+        f"""
+        import std
+        import files
+        import files::host
+        import mitogen
+
+        entity Config:
+            string name
+            string[] aliases = []
+        end
+        implement Config using std::none
+
+        host = std::Host(
+            name="localhost",
+            os=std::linux,
+            via=mitogen::Local(),
+        )
+
+        config = Config(name="a", aliases=["x", "y"])
+
+        files::TextFile(
+            path="/a",
+            content=files::jinja(
+                "file://{template_path}",
+                parallel=true,
+                config=config,
+            ),
+            host=host,
+        )
+
+        files::TextFile(
+            path="/b",
+            content=files::jinja(
+                "file://{other_template_path}",
+                parallel=true,
+                config=config,
+            ),
+            host=host,
+        )
+        """,
+        no_dedent=False,
+    )
+
+    files = {
+        f.path: inmanta.plugins.allow_reference_values(f).content
+        for f in project.get_instances("files::TextFile")
+    }
+    assert files["/b"] == "a/b"
+    assert isinstance(files["/a"], RenderedTextReference)
+    assert files["/a"].text == "[A]\nx\ny\n"
+
+
+def test_parallel_render_failure(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    A template failing to render in a worker process fails the compile, at the
+    location of the plugin call which rendered it.
+    """
+    from inmanta_plugins.files.workers import RENDER_WORKERS_ENV
+
+    monkeypatch.setenv(RENDER_WORKERS_ENV, "1")
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text("{{ name | int // 0 }}")
+
+    with pytest.raises(inmanta.ast.CompilerException) as exc_info:
+        project.compile(
+            f"""
+            import std
+            import files
+            import files::host
+            import mitogen
+
+            host = std::Host(
+                name="localhost",
+                os=std::linux,
+                via=mitogen::Local(),
+            )
+
+            files::TextFile(
+                path="/a",
+                content=files::jinja(
+                    "file://{template_path}", parallel=true, name="1"
+                ),
+                host=host,
+            )
+            """,
+            no_dedent=False,
+        )
+
+    assert f"Failed to render template {template_path}" in str(exc_info.value)
+    assert "main.cf:14" in str(exc_info.value)
+
+
+def test_direct_filter_calls(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Plugins without Context argument and with primitive arguments are called
+    directly by the jinja filters, without going through the compiler.
+    Deterministic plugins are memoized.
+    """
+    import inmanta_plugins.files
+    import inmanta_plugins.files.filters
+    import inmanta_plugins.files.systemd_unit
+
+    # The filters used by this test are wrapped in the jinja environment reused
+    # across compiles, start from a new one and drop it afterwards
+    monkeypatch.setattr(inmanta_plugins.files, "JINJA_REUSABLE_ENV", None)
+
+    calls: list[str] = []
+    original_call_in_context = inmanta.plugins.Plugin.call_in_context
+
+    def counting_call_in_context(self: inmanta.plugins.Plugin, *args, **kwargs):
+        calls.append(self.get_full_name())
+        return original_call_in_context(self, *args, **kwargs)
+
+    monkeypatch.setattr(
+        inmanta.plugins.Plugin, "call_in_context", counting_call_in_context
+    )
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text(
+        "{% for i in range(3) %}"
+        "{{ '/etc' | files.path_join('a', 'b') }} "
+        "{{ 'say \"hi\"' | files.systemd_unit.quote }}\n"
+        "{% endfor %}"
+        "{{ 'x' | std.replace('x', 'y') }}"
+    )
+
+    project.compile(
+        f"""
+        import std
+        import files
+        import files::host
+        import files::systemd_unit
+        import mitogen
+
+        host = std::Host(
+            name="localhost",
+            os=std::linux,
+            via=mitogen::Local(),
+        )
+
+        files::TextFile(
+            path="/a",
+            content=files::jinja("file://{template_path}"),
+            host=host,
+        )
+        """,
+        no_dedent=False,
+    )
+
+    file = project.get_instances("files::TextFile").pop()
+    assert file.content == '/etc/a/b "say \\"hi\\""\n' * 3 + "y"
+
+    # Only the jinja plugin itself went through the compiler
+    assert "files::path_join" not in calls
+    assert "files::systemd_unit::quote" not in calls
+
+    # The deterministic plugins are memoized
+    direct_call = inmanta_plugins.files.filters._direct_calls[
+        inmanta_plugins.files.systemd_unit.quote
+    ]
+    assert direct_call is not None
+    assert direct_call.function.cache_info().hits >= 2
+
+
+def test_direct_filter_call_errors(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    The errors raised by a plugin called directly by a jinja filter, and the
+    values it returns which don't match its return type, are reported with the
+    plugin and the template calling it.
+    """
+    import dataclasses
+
+    import inmanta_plugins.files.filters
+    from inmanta_plugins.files import path_join
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text("{{ '/etc' | files.path_join('a') }}")
+
+    model = f"""
+        import std
+        import files
+        import files::host
+        import mitogen
+
+        host = std::Host(
+            name="localhost",
+            os=std::linux,
+            via=mitogen::Local(),
+        )
+
+        files::TextFile(
+            path="/a",
+            content=files::jinja("file://{template_path}"),
+            host=host,
+        )
+    """
+
+    def fail(*args: object) -> str:
+        raise ValueError("Invalid path")
+
+    direct_call = inmanta_plugins.files.filters._build_direct_call(path_join)
+    assert direct_call is not None
+    for function, message in [
+        (fail, "Exception in plugin files::path_join"),
+        (lambda *args: 1, "Return value 1 of plugin files::path_join"),
+    ]:
+        monkeypatch.setitem(
+            inmanta_plugins.files.filters._direct_calls,
+            path_join,
+            dataclasses.replace(direct_call, function=function),
+        )
+        with pytest.raises(inmanta.ast.ExplicitPluginException) as exc_info:
+            project.compile(model, no_dedent=False)
+
+        cause = exc_info.value.__cause__
+        assert isinstance(cause, inmanta.plugins.PluginException)
+        assert cause.message.startswith(message)
+        assert str(template_path) in cause.message
+
+
+def test_template_loader(project: Project, tmp_path: pathlib.Path) -> None:
+    """
+    Templates can import, include and extend other templates, resolved like
+    the paths given to the jinja plugin.  Shared templates are only compiled
+    once.
+    """
+    template_dir = pathlib.Path(project._test_project_dir, "templates")
+    template_dir.mkdir(parents=True, exist_ok=True)
+    (template_dir / "macros.j2").write_text(
+        "{% macro option(name, value) %}{{ name }}={{ value }}{% endmacro %}"
+    )
+    # The trailing newline of a template is dropped, keep it in the including one
+    (template_dir / "header.j2").write_text("# {{ title }}")
+    (template_dir / "a.j2").write_text(
+        '{% import "/macros.j2" as m %}'
+        '{% include "template:///header.j2" %}\n'
+        "{{ m.option('a', value) }}"
+    )
+    (template_dir / "b.j2").write_text(
+        '{% from "/macros.j2" import option %}{{ option("b", value) }}'
+    )
+
+    compiled: list[str] = []
+    original_compile = jinja2.Environment.compile
+
+    def counting_compile(self: jinja2.Environment, source: str, *args, **kwargs):
+        compiled.append(source)
+        return original_compile(self, source, *args, **kwargs)
+
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        # Disable the on-disk cache, to count all the compiled templates
+        monkeypatch.setenv("INMANTA_FILES_JINJA_CACHE_SIZE", "0")
+        monkeypatch.setattr(jinja2.Environment, "compile", counting_compile)
+
+        project.compile(
+            """
+            import std
+            import files
+            import files::host
+            import mitogen
+
+            host = std::Host(
+                name="localhost",
+                os=std::linux,
+                via=mitogen::Local(),
+            )
+
+            files::TextFile(
+                path="/a",
+                content=files::jinja("template:///a.j2", title="A", value="1"),
+                host=host,
+            )
+
+            files::TextFile(
+                path="/b",
+                content=files::jinja("template:///b.j2", value="2"),
+                host=host,
+            )
+            """,
+            no_dedent=False,
+        )
+
+    files = {f.path: f.content for f in project.get_instances("files::TextFile")}
+    assert files == {"/a": "# A\na=1", "/b": "b=2"}
+
+    # The macros are compiled once, and shared by both templates
+    assert compiled.count((template_dir / "macros.j2").read_text()) <= 1
+
+
+def test_jinja_inline(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    Templates can be given as a string to the jinja_inline plugin, which
+    renders them like the jinja plugin.  Each snippet is only compiled once.
+    Raw strings are used in the model, so that the compiler doesn't format
+    the templates itself.
+    """
+    from inmanta_plugins.std import EnvironmentReference
+
+    from inmanta_plugins.files import JinjaReference
+
+    compiled: list[str] = []
+    original_compile = jinja2.Environment.compile
+
+    def counting_compile(self: jinja2.Environment, source: str, *args, **kwargs):
+        compiled.append(source)
+        return original_compile(self, source, *args, **kwargs)
+
+    monkeypatch.setenv("INMANTA_FILES_JINJA_CACHE_SIZE", "0")
+    monkeypatch.setattr(jinja2.Environment, "compile", counting_compile)
+
+    project.compile(
+        """
+        import std
+        import files
+        import files::host
+        import mitogen
+
+        host = std::Host(
+            name="localhost",
+            os=std::linux,
+            via=mitogen::Local(),
+        )
+
+        for name in ["a", "b", "c"]:
+            files::TextFile(
+                path="/{{ name }}",
+                content=files::jinja_inline(r"inline-{{ name }}", name=name),
+                host=host,
+            )
+        end
+
+        files::TextFile(
+            path="/env",
+            content=files::jinja_inline(
+                r"ENV={{ 'TEST' | std.create_environment_reference() }}"
+            ),
+            host=host,
+        )
+        """,
+        no_dedent=False,
+    )
+
+    files = {f.path: f for f in project.get_instances("files::TextFile")}
+    assert {path: files[path].content for path in ["/a", "/b", "/c"]} == {
+        "/a": "inline-a",
+        "/b": "inline-b",
+        "/c": "inline-c",
+    }
+    assert compiled.count("inline-{{ name }}") <= 1
+
+    file = inmanta.plugins.allow_reference_values(files["/env"])
+    assert isinstance(file.content, JinjaReference)
+    assert file.content.references == {
+        "3ad25aea-bd44-30d8-8da3-f4c5e58e3d1e": EnvironmentReference("TEST")
+    }
+
+
+def test_reference_id_memoization(project: Project, tmp_path: pathlib.Path) -> None:
+    """
+    A reference printed several times in a template is only serialized once
+    to compute its id.
+    """
+    import inmanta_plugins.files
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text(
+        "{% set ref = 'TEST' | std.create_environment_reference() %}"
+        "{% for i in range(3) %}{{ ref }}\n{% endfor %}"
+    )
+
+    project.compile(
+        f"""
+        import std
+        import files
+        import files::host
+        import mitogen
+
+        host = std::Host(
+            name="localhost",
+            os=std::linux,
+            via=mitogen::Local(),
+        )
+
+        files::TextFile(
+            path="/a",
+            content=files::jinja("file://{template_path}"),
+            host=host,
+        )
+        """,
+        no_dedent=False,
+    )
+
+    file = project.get_instances("files::TextFile").pop()
+    file = inmanta.plugins.allow_reference_values(file)
+    assert list(file.content.references) == ["3ad25aea-bd44-30d8-8da3-f4c5e58e3d1e"]
+
+    stats = inmanta_plugins.files.REFERENCE_ID_STATS
+    assert stats.misses == 1
+    assert stats.hits == 2
+
+
+def test_spliced_reference(project: Project, monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    A SplicedJinjaReference resolves to the same value as a JinjaReference with
+    the same template, without rendering it.
+    """
+    from inmanta_plugins.std import EnvironmentReference
+
+    from inmanta_plugins.files import (
+        JinjaReference,
+        SplicedJinjaReference,
+        find_placeholders,
+    )
+
+    template = (
+        "{% raw %}A={% endraw %}"
+        '{{ references["a"] }}'
+        "{% raw %}\n{{ b }}={% endraw %}"
+        '{{ references["b"] }}'
+        "{% raw %}\n{% endraw %}"
+    )
+    references = {"a": EnvironmentReference("A"), "b": "x"}
+    offsets = [offset for offset, _ in find_placeholders(template)]
+    assert offsets == [11, 62]
+
+    monkeypatch.setenv("A", "a")
+    expected = "A=a\n{{ b }}=x\n"
+    legacy = JinjaReference(template=template, references=references)
+    assert legacy.resolve(PythonLogger(LOGGER)) == expected
+    spliced = SplicedJinjaReference(
+        template=template, references=references, offsets=offsets
+    )
+    assert spliced.resolve(PythonLogger(LOGGER)) == expected
+
+    # The offsets must match the placeholders
+    invalid = SplicedJinjaReference(
+        template=template, references=references, offsets=[12]
+    )
+    with pytest.raises(ValueError):
+        invalid.resolve(PythonLogger(LOGGER))
+
+
+def test_concurrent_resolution(
+    project: Project, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    The references of a JinjaReference are resolved concurrently when more
+    than one resolution thread is configured, and serially by default.
+    """
+    import threading
+
+    from inmanta_plugins.std import EnvironmentReference
+
+    from inmanta_plugins.files import JinjaReference
+    from inmanta_plugins.files.resolution import RESOLUTION_THREADS_ENV
+
+    threads: set[str] = set()
+    original_resolve = EnvironmentReference.resolve
+    barrier = threading.Barrier(2, timeout=5)
+
+    def resolve(self: EnvironmentReference, logger: object) -> str:
+        threads.add(threading.current_thread().name)
+        if threading.current_thread() is not threading.main_thread():
+            # Only returns once both references are being resolved
+            barrier.wait()
+        return original_resolve(self, logger)
+
+    monkeypatch.setattr(EnvironmentReference, "resolve", resolve)
+    monkeypatch.setenv("A", "a")
+    monkeypatch.setenv("B", "b")
+    monkeypatch.setenv(RESOLUTION_THREADS_ENV, "2")
+
+    def reference() -> JinjaReference:
+        return JinjaReference(
+            template="{{ references.a }}{{ references.b }}",
+            references={
+                "a": EnvironmentReference("A"),
+                "b": EnvironmentReference("B"),
+            },
+        )
+
+    assert reference().resolve(PythonLogger(LOGGER)) == "ab"
+    assert len(threads) == 2
+    assert threading.main_thread().name not in threads
+
+    threads.clear()
+    monkeypatch.delenv(RESOLUTION_THREADS_ENV)
+    assert reference().resolve(PythonLogger(LOGGER)) == "ab"
+    assert threads == {threading.main_thread().name}
@@ -0,0 +1,233 @@
+"""
+Copyright 2026 Guillaume Everarts de Velp
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Contact: edvgui@gmail.com
+"""
+
+import dataclasses
+import os
+import pathlib
+import time
+import tracemalloc
+
+import jinja2
+import pytest
+from pytest_inmanta.plugin import Project
+
+import inmanta.ast
+
+# The benchmarks compile large models, they only run when this environment
+# variable is set, e.g.
+#   INMANTA_FILES_BENCHMARK=1 pytest tests/test_jinja_benchmark.py
+BENCHMARK_ENV = "INMANTA_FILES_BENCHMARK"
+
+pytestmark = pytest.mark.skipif(
+    not os.environ.get(BENCHMARK_ENV),
+    reason=f"Benchmarks only run when {BENCHMARK_ENV} is set",
+)
+
+
+@dataclasses.dataclass(kw_only=True)
+class BenchmarkResult:
+    """
+    The measurements of a single compile of a benchmark model.
+
+    :attr wall_time: The duration of the compile, in seconds.
+    :attr render_time: The time spent in the jinja plugins rendering the
+        templates, render hooks and discovery included, in seconds.
+    :attr plugin_calls: The number of calls to the jinja plugins, including the
+        calls the compiler reschedules.
+    :attr renders: The number of times a template was actually rendered.
+    :attr unset_batches: The number of calls which waited for unset values,
+        after a discovery render or without rendering at all.
+    :attr peak_memory: The peak of the memory allocated during the compile,
+        in bytes.
+    """
+
+    wall_time: float = 0.0
+    render_time: float = 0.0
+    plugin_calls: int = 0
+    renders: int = 0
+    unset_batches: int = 0
+    peak_memory: int = 0
+
+
+def build_model(hosts: int, templates: int, unset_values: int) -> str:
+    """
+    Build a model rendering the given number of templates for each of the
+    given number of hosts.  Each template reads the given number of values
+    which are only set by an implementation, embeds a reference and calls
+    another template and a plugin through filters.
+    """
+    attributes = "".join(f"    string v{k}\n" for k in range(unset_values))
+    assignments = "".join(
+        f'    self.v{k} = "{{{{ self.name }}}}-{k}"\n' for k in range(unset_values)
+    )
+    files = "".join(f"""
+    files::TextFile(
+        path="/{{{{ name }}}}/{t}",
+        content=files::jinja("template:///benchmark_{t}.j2", settings=settings),
+        host=host,
+    )
+""" for t in range(templates))
+    return f"""
+import std
+import files
+import files::host
+import mitogen
+
+entity Settings:
+    string name
+{attributes}end
+implement Settings using compute
+
+implementation compute for Settings:
+{assignments}end
+
+for i in std::sequence({hosts}):
+    name = "host-{{{{ i }}}}"
+    host = std::Host(
+        name=name,
+        os=std::linux,
+        via=mitogen::Local(),
+    )
+    settings = Settings(name=name)
+{files}end
+"""
+
+
+def write_templates(
+    template_dir: pathlib.Path, templates: int, unset_values: int
+) -> None:
+    """
+    Write the templates rendered by the model built by build_model.
+    """
+    template_dir.mkdir(parents=True, exist_ok=True)
+    (template_dir / "benchmark_nested.j2").write_text(
+        "{% if settings is defined %}{{ settings.name | upper }}{% endif %}"
+    )
+    reads = "".join(f"v{k}={{{{ settings.v{k} }}}}\n" for k in range(unset_values))
+    for t in range(templates):
+        (template_dir / f"benchmark_{t}.j2").write_text(
+            f"# template {t}\n"
+            # The values are read conditionally, they are discovered by a render
+            "{% if settings is defined %}\n"
+            f"{reads}"
+            "{% endif %}\n"
+            "secret={{ 'SECRET' | std.create_environment_reference() }}\n"
+            "nested={{ 'template:///benchmark_nested.j2'"
+            " | files.jinja(settings=settings) }}\n"
+            "path={{ '/etc' | files.path_join(settings.name) }}\n"
+        )
+
+
+def run_benchmark(
+    project: Project,
+    monkeypatch: pytest.MonkeyPatch,
+    hosts: int,
+    templates: int,
+    unset_values: int,
+) -> BenchmarkResult:
+    """
+    Compile a benchmark model and measure the work done by the jinja plugins.
+    """
+    import inmanta_plugins.files as files_plugin
+
+    write_templates(
+        pathlib.Path(project._test_project_dir, "templates"), templates, unset_values
+    )
+    model = build_model(hosts, templates, unset_values)
+    result = BenchmarkResult()
+
+    original_render = jinja2.Template.render
+    original_generate = jinja2.Template.generate
+    original_render_template = files_plugin.render_template
+
+    def counting_render(self: jinja2.Template, *args: object, **kwargs: object) -> str:
+        result.renders += 1
+        return original_render(self, *args, **kwargs)
+
+    def counting_generate(self: jinja2.Template, *args: object, **kwargs: object):
+        result.renders += 1
+        return original_generate(self, *args, **kwargs)
+
+    def timed_render_template(*args: object, **kwargs: object) -> object:
+        result.plugin_calls += 1
+        start = time.perf_counter()
+        try:
+            return original_render_template(*args, **kwargs)
+        except (inmanta.ast.UnsetException, inmanta.ast.MultiUnsetException):
+            result.unset_batches += 1
+            raise
+        finally:
+            result.render_time += time.perf_counter() - start
+
+    monkeypatch.setattr(jinja2.Template, "render", counting_render)
+    monkeypatch.setattr(jinja2.Template, "generate", counting_generate)
+    monkeypatch.setattr(files_plugin, "render_template", timed_render_template)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        project.compile(model, no_dedent=False)
+    finally:
+        result.wall_time = time.perf_counter() - start
+        result.peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    # Sanity check, the output doesn't depend on the optimizations
+    file = project.get_instances("files::TextFile")[0]
+    assert file.path.startswith("/host-")
+
+    return result
+
+
+@pytest.mark.parametrize(
+    ("hosts", "templates", "unset_values"),
+    [(1, 1, 1), (10, 5, 5), (100, 10, 10)],
+)
+def test_jinja_benchmark(
+    project: Project,
+    monkeypatch: pytest.MonkeyPatch,
+    capsys: pytest.CaptureFixture[str],
+    record_property,
+    hosts: int,
+    templates: int,
+    unset_values: int,
+) -> None:
+    """
+    Measure the wall time, the renders and the peak memory of a compile
+    rendering hosts x templates templates, each waiting for unset_values
+    late-bound values.
+    """
+    result = run_benchmark(project, monkeypatch, hosts, templates, unset_values)
+    for key, value in dataclasses.asdict(result).items():
+        record_property(key, value)
+
+    with capsys.disabled():
+        print(
+            f"\njinja benchmark {hosts} hosts x {templates} templates x "
+            f"{unset_values} unset values: "
+            f"wall time {result.wall_time:.2f}s, "
+            f"render time {result.render_time:.2f}s, "
+            f"{result.plugin_calls} plugin calls, "
+            f"{result.renders} renders, "
+            f"{result.unset_batches} unset batches, "
+            f"peak memory {result.peak_memory / 1024 / 1024:.1f}MiB"
+        )
+
+    # Every file is rendered by a call of the plugin
+    assert result.renders >= 1
+    assert result.plugin_calls >= hosts * templates
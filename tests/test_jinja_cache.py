@@ -0,0 +1,445 @@
+"""
+Copyright 2026 Guillaume Everarts de Velp
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+
+Contact: edvgui@gmail.com
+"""
+
+import collections
+import pathlib
+
+import jinja2
+import pytest
+from pytest_inmanta.plugin import Project
+
+
+def build_model(template_path: pathlib.Path, **kwargs: str) -> str:
+    """
+    Build a model rendering the given template into a text file.
+
+    :param template_path: The path to the template to render.
+    :param kwargs: The inputs of the template, as strings.
+    """
+    inputs = "".join(f", {k}={v!r}" for k, v in kwargs.items())
+    return f"""
+        import std
+        import files
+        import mitogen
+
+        host = std::Host(
+            name="localhost",
+            os=std::linux,
+            via=mitogen::Local(),
+        )
+
+        files::TextFile(
+            path="/a",
+            content=files::jinja("file://{template_path}"{inputs}),
+            host=host,
+        )
+    """
+
+
+def test_bytecode_cache(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    A template compiled during a compile is persisted on disk, the next compile
+    loads it as bytecode instead of compiling it again.
+    """
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("INMANTA_FILES_JINJA_CACHE_DIR", str(cache_dir))
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text("Hello {{ name }}!")
+
+    project.compile(build_model(template_path, name="world"), no_dedent=False)
+    assert project.get_instances("files::TextFile")[0].content == "Hello world!"
+    assert len(list(cache_dir.glob("__inmanta_files_*.cache"))) == 1
+
+    # Count the templates compiled from source in the next compile
+    compiled: list[str] = []
+    original_compile = jinja2.Environment.compile
+
+    def counting_compile(self: jinja2.Environment, source: str, *args, **kwargs):
+        compiled.append(source)
+        return original_compile(self, source, *args, **kwargs)
+
+    monkeypatch.setattr(jinja2.Environment, "compile", counting_compile)
+
+    project.compile(build_model(template_path, name="cache"), no_dedent=False)
+    assert project.get_instances("files::TextFile")[0].content == "Hello cache!"
+    assert compiled == []
+
+    # A template which changed is compiled again
+    template_path.write_text("Bye {{ name }}!")
+    project.compile(build_model(template_path, name="cache"), no_dedent=False)
+    assert project.get_instances("files::TextFile")[0].content == "Bye cache!"
+    assert compiled == ["Bye {{ name }}!"]
+
+
+def test_bytecode_cache_eviction(project: Project, tmp_path: pathlib.Path) -> None:
+    """
+    The bytecode cache never grows beyond its size limit, the least recently
+    used entries are evicted first.
+    """
+    from inmanta_plugins.files.cache import TemplateBytecodeCache
+
+    env = jinja2.Environment()
+    bcc = TemplateBytecodeCache(str(tmp_path), max_size=0)
+
+    # Measure the size of a single entry
+    code, bucket = bcc.get_code(env, "{{ a }}")
+    assert code is None
+    bucket.code = env.compile("{{ a }}")
+    bcc.max_size = 1024 * 1024
+    bcc.set_bucket(bucket)
+    (entry,) = tmp_path.glob("__inmanta_files_*.cache")
+    entry_size = entry.stat().st_size
+
+    # Only allow two entries, the third one evicts the first one
+    bcc.max_size = 2 * entry_size + entry_size // 2
+    for source in ["{{ b }}", "{{ c }}"]:
+        code, bucket = bcc.get_code(env, source)
+        bucket.code = env.compile(source)
+        bcc.set_bucket(bucket)
+
+    assert len(list(tmp_path.glob("__inmanta_files_*.cache"))) == 2
+    assert bcc.get_code(env, "{{ a }}")[0] is None
+    assert bcc.get_code(env, "{{ c }}")[0] is not None
+
+
+def test_environment_fingerprint() -> None:
+    """
+    The options of an environment which change the compiled code of its
+    templates change its fingerprint, and so the cache entries it uses.
+    """
+    from inmanta_plugins.files.cache import environment_fingerprint
+
+    fingerprints = {
+        environment_fingerprint(env)
+        for env in [
+            jinja2.Environment(),
+            jinja2.Environment(trim_blocks=True),
+            jinja2.Environment(keep_trailing_newline=True),
+            jinja2.Environment(variable_start_string="[[", variable_end_string="]]"),
+            jinja2.Environment(autoescape=True),
+            jinja2.Environment(extensions=["jinja2.ext.loopcontrols"]),
+        ]
+    }
+    assert len(fingerprints) == 6
+
+    # The same options give the same fingerprint
+    assert environment_fingerprint(jinja2.Environment()) in fingerprints
+
+
+def test_compiled_template_reuse(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    The code of a template compiled by a compile is reused by the next compiles
+    running in the same process, as long as the template file and the set of
+    plugins don't change.
+    """
+    # Disable the on-disk cache, to only exercise the in-process one
+    monkeypatch.setenv("INMANTA_FILES_JINJA_CACHE_SIZE", "0")
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text("Hello {{ name }}!")
+
+    compiled: list[str] = []
+    original_compile = jinja2.Environment.compile
+
+    def counting_compile(self: jinja2.Environment, source: str, *args, **kwargs):
+        compiled.append(source)
+        return original_compile(self, source, *args, **kwargs)
+
+    monkeypatch.setattr(jinja2.Environment, "compile", counting_compile)
+
+    for name in ["a", "b"]:
+        project.compile(build_model(template_path, name=name), no_dedent=False)
+        assert project.get_instances("files::TextFile")[0].content == f"Hello {name}!"
+
+    assert compiled == ["Hello {{ name }}!"]
+
+    # Changing the file on disk invalidates the compiled code
+    template_path.write_text("Bye {{ name }}!")
+    project.compile(build_model(template_path, name="c"), no_dedent=False)
+    assert project.get_instances("files::TextFile")[0].content == "Bye c!"
+    assert compiled == ["Hello {{ name }}!", "Bye {{ name }}!"]
+
+    # A different set of filters invalidates the compiled code as well
+    from inmanta_plugins.files.cache import load_template
+
+    env = jinja2.Environment()
+    env.filters["files.extra"] = str
+    template, _ = load_template(env, str(template_path))
+    assert template.render(name="d") == "Bye d!"
+    assert compiled[-1] == "Bye {{ name }}!"
+    assert len(compiled) == 3
+
+
+def test_compiled_template_cache_size(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    The in-process cache of compiled templates is bounded, the least recently
+    used templates are dropped first.
+    """
+    import inmanta_plugins.files.cache
+
+    monkeypatch.setattr(inmanta_plugins.files.cache, "COMPILED_TEMPLATE_CACHE_SIZE", 2)
+    monkeypatch.setattr(
+        inmanta_plugins.files.cache, "_compiled_templates", collections.OrderedDict()
+    )
+
+    env = jinja2.Environment()
+    paths = []
+    for name in ["a", "b", "c"]:
+        paths.append(str(tmp_path / f"{name}.j2"))
+        pathlib.Path(paths[-1]).write_text(f"{name}={{{{ value }}}}")
+
+    inmanta_plugins.files.cache.load_template(env, paths[0])
+    inmanta_plugins.files.cache.load_template(env, paths[1])
+    # Reading a template marks it as recently used
+    inmanta_plugins.files.cache.load_template(env, paths[0])
+    inmanta_plugins.files.cache.load_template(env, paths[2])
+
+    assert [path for path, _ in inmanta_plugins.files.cache._compiled_templates] == [
+        paths[0],
+        paths[2],
+    ]
+
+
+def test_render_cache(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    A template rendered several times with inputs that hold the same values
+    is only rendered once per compile.
+    """
+    import inmanta_plugins.files.cache
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text(
+        "{% if config.port is not none %}{{ config.name }}:{{ config.port }}{% endif %}"
+        "{% for alias in config.aliases %} {{ alias }}{% endfor %}"
+    )
+
+    render_count = 0
+    original_render = jinja2.Template.render
+
+    def counting_render(self: jinja2.Template, *args: object, **kwargs: object) -> str:
+        nonlocal render_count
+        render_count += 1
+        return original_render(self, *args, **kwargs)
+
+    monkeypatch.setattr(jinja2.Template, "render", counting_render)
+
+    project.compile(
+        f"""
+        import std
+        import files
+        import mitogen
+
+        entity Config:
+            string name
+            int? port
+            string[] aliases = []
+        end
+        implement Config using std::none
+
+        host = std::Host(
+            name="localhost",
+            os=std::linux,
+            via=mitogen::Local(),
+        )
+
+        files::TextFile(
+            path="/a",
+            content=files::jinja(
+                "file://{template_path}",
+                config=Config(name="x", port=80, aliases=["a", "b"]),
+            ),
+            host=host,
+        )
+
+        files::TextFile(
+            path="/b",
+            content=files::jinja(
+                "file://{template_path}",
+                config=Config(name="x", port=80, aliases=["a", "b"]),
+            ),
+            host=host,
+        )
+
+        files::TextFile(
+            path="/c",
+            content=files::jinja(
+                "file://{template_path}",
+                config=Config(name="y", port=80, aliases=["a", "b"]),
+            ),
+            host=host,
+        )
+        """,
+        no_dedent=False,
+    )
+
+    contents = {f.path: f.content for f in project.get_instances("files::TextFile")}
+    assert contents == {"/a": "x:80 a b", "/b": "x:80 a b", "/c": "y:80 a b"}
+
+    # Only the distinct inputs are rendered, the unset values are waited for
+    # before any render
+    stats = inmanta_plugins.files.cache.RENDER_CACHE_STATS
+    assert stats.hits == 1
+    assert stats.misses == 2
+    assert stats.bypassed == 0
+    assert render_count == 2
+
+
+def test_render_cache_branches(project: Project, tmp_path: pathlib.Path) -> None:
+    """
+    A variable set differently by the branches of an if statement is resolved
+    to the values of the branch that is taken when looking up the render cache.
+    """
+    template_path = tmp_path / "test.j2"
+    template_path.write_text(
+        "{% if c.flag %}{% set x = c.a %}{% else %}{% set x = c.b %}{% endif %}"
+        "{{ x.name }}"
+    )
+
+    project.compile(
+        f"""
+        import std
+        import files
+        import mitogen
+
+        entity Item:
+            string name
+        end
+        implement Item using std::none
+
+        entity Config:
+            bool flag
+        end
+        Config.a [1] -- Item
+        Config.b [1] -- Item
+        implement Config using std::none
+
+        host = std::Host(
+            name="localhost",
+            os=std::linux,
+            via=mitogen::Local(),
+        )
+
+        b = Item(name="other")
+
+        files::TextFile(
+            path="/a",
+            content=files::jinja(
+                "file://{template_path}",
+                c=Config(flag=true, a=Item(name="one"), b=b),
+            ),
+            host=host,
+        )
+
+        files::TextFile(
+            path="/b",
+            content=files::jinja(
+                "file://{template_path}",
+                c=Config(flag=true, a=Item(name="two"), b=b),
+            ),
+            host=host,
+        )
+        """,
+        no_dedent=False,
+    )
+
+    contents = {f.path: f.content for f in project.get_instances("files::TextFile")}
+    assert contents == {"/a": "one", "/b": "two"}
+
+
+def test_jinja_env_reuse(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    The jinja environment, with all the plugins as filters, is reused by the
+    next compiles as long as the set of plugins doesn't change.
+    """
+    import inmanta_plugins.files
+
+    # Start from a new environment, the previous tests may have used more filters
+    monkeypatch.setattr(inmanta_plugins.files, "JINJA_REUSABLE_ENV", None)
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text("{{ name | files.path_join('b') }}")
+
+    envs: list[jinja2.Environment] = []
+    for name in ["/a", "/c"]:
+        project.compile(build_model(template_path, name=name), no_dedent=False)
+        assert project.get_instances("files::TextFile")[0].content == f"{name}/b"
+        envs.append(inmanta_plugins.files.JINJA_REUSABLE_ENV[1])
+
+    assert envs[0] is envs[1]
+
+    # All the plugins are available as filters, but only the used ones have
+    # been wrapped
+    filters = envs[0].filters
+    assert "files.path_join" in filters and "std.replace" in filters
+    assert "files.path_join" in filters._filters
+    assert "std.replace" not in filters._filters
+
+
+def test_persistent_render_cache(
+    project: Project, tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    When the on-disk render cache is enabled, the output of a render is reused
+    by the next compiles rendering the same template with the same inputs.
+    """
+    import inmanta_plugins.files.cache
+
+    cache_dir = tmp_path / "renders"
+    monkeypatch.setenv("INMANTA_FILES_RENDER_CACHE_DIR", str(cache_dir))
+
+    template_path = tmp_path / "test.j2"
+    template_path.write_text("Hello {{ name | upper }}!")
+
+    render_count = 0
+    original_render = jinja2.Template.render
+
+    def counting_render(self: jinja2.Template, *args: object, **kwargs: object) -> str:
+        nonlocal render_count
+        render_count += 1
+        return original_render(self, *args, **kwargs)
+
+    monkeypatch.setattr(jinja2.Template, "render", counting_render)
+
+    for expected_count in [1, 1]:
+        project.compile(build_model(template_path, name="world"), no_dedent=False)
+        assert project.get_instances("files::TextFile")[0].content == "Hello WORLD!"
+        assert render_count == expected_count
+
+    assert len(list(cache_dir.glob("__inmanta_files_render_*.txt"))) == 1
+
+    # Other inputs are rendered again
+    project.compile(build_model(template_path, name="cache"), no_dedent=False)
+    assert project.get_instances("files::TextFile")[0].content == "Hello CACHE!"
+    assert render_count == 2
+
+    # Once the cache is cleared, all the templates are rendered again
+    inmanta_plugins.files.cache.clear_persistent_render_cache()
+    assert list(cache_dir.glob("__inmanta_files_render_*.txt")) == []
+    project.compile(build_model(template_path, name="world"), no_dedent=False)
+    assert render_count == 3
@@ -16,12 +16,19 @@ limitations under the License.
 Contact: edvgui@gmail.com
 """
 
+import pytest
 import pytest_inmanta.plugin
 
 import inmanta.references
+import inmanta_plugins.files.json
+from inmanta.ast import MultiUnsetException
+from inmanta.execute.util import NoneValue
 from inmanta_plugins.files.json import (
     Operation,
     SerializedEntity,
+    compiler_json_value,
+    get_schema,
+    partition,
     serialize,
     serialize_for_resource,
 )
@@ -172,6 +179,69 @@ a = Test(
         },
     )
 
+    # Each instance is only serialized once per compile, the value of the
+    # children is shared with the value of their parent
+    stats = inmanta_plugins.files.json.SERIALIZE_CACHE_STATS
+    hits = stats.hits
+    required = serialize(instance.required)
+    assert serialize(instance).value["required"] is required.value
+    assert serialize(instance.required) is required
+    assert stats.hits >= hits + 2
+
+
+def test_schema(
+    project: pytest_inmanta.plugin.Project,
+) -> None:
+    """
+    The serialization schema of each entity type is only built once per
+    compile, and covers the attributes inherited from the parent types.
+    """
+    model = """
+a = Test(
+    name="test",
+    required=RequiredEmbeddedTest(name="required"),
+    many=[ManyEmbeddedTest(name="a"), ManyEmbeddedTest(name="b")],
+    path=".",
+    operation=files::replace,
+    resource=files::json::JsonResource(),
+)
+"""
+
+    project.compile(TYPE_DEFINITION + model)
+
+    instance = project.get_instances("__config__::Test")[0]
+    schema = get_schema(instance._type())
+    assert schema.relation_from_parent is None
+    assert schema.index_attributes is None
+    assert schema.attributes == [
+        ("name", False),
+        ("count", False),
+        ("flag", False),
+        ("attr", False),
+    ]
+    assert schema.children == [
+        ("optional", False, False),
+        ("required", False, False),
+        ("many", False, True),
+    ]
+
+    many = project.get_instances("__config__::ManyEmbeddedTest")
+    schema = get_schema(many[0]._type())
+    assert get_schema(many[1]._type()) is schema
+    assert schema.relation_from_parent == "many"
+    assert schema.index_attributes == ["name"]
+    assert schema.children == [("recursive", False, True)]
+
+
+def test_compiler_json_value() -> None:
+    """
+    Values read straight from the compiler instances are converted into the
+    same json-like values as the ones read through the proxies.
+    """
+    assert compiler_json_value(
+        {"a": (1, NoneValue()), "b": [{"c": "d"}], "e": NoneValue()},
+    ) == {"a": [1, None], "b": [{"c": "d"}], "e": None}
+
 
 def test_reference_scalar_attribute(
     project: pytest_inmanta.plugin.Project,
@@ -352,6 +422,11 @@ a = Test(
         ),
     ]
 
+    # The tree is only walked once, for all the resources attached to it
+    partitioned = partition(instance)
+    assert partition(instance) is partitioned
+    assert set(partitioned) == {res_a, res_b}
+
 
 def test_remove(project: pytest_inmanta.plugin.Project) -> None:
     model = """
@@ -475,3 +550,62 @@ a = Test(
             value=None,
         ),
     ]
+
+
+def test_batched_unset_values(
+    project: pytest_inmanta.plugin.Project, monkeypatch: pytest.MonkeyPatch
+) -> None:
+    """
+    The serialization plugins walk the whole tree before waiting for the
+    values which are not set yet, and wait for all of them at once.
+    """
+    model = """
+entity Late extends files::json::SerializableEntity:
+    string name
+    string? value
+end
+Test.late [0:] -- Late.parent [1]
+
+index Late(parent, name)
+
+implementation compute_late for Late:
+    self.value = self.name
+end
+
+implement Late using parents, compute_late
+
+a = Test(
+    name="test",
+    required=RequiredEmbeddedTest(name="required"),
+    late=[Late(name="a"), Late(name="b"), Late(name="c")],
+    path=".",
+    operation=files::replace,
+    resource=files::json::JsonResource(),
+)
+"""
+
+    raised: list[Exception] = []
+    original_batch_unset = inmanta_plugins.files.json.batch_unset
+
+    def spy_batch_unset(*args: object) -> object:
+        try:
+            return original_batch_unset(*args)
+        except Exception as e:
+            raised.append(e)
+            raise
+
+    monkeypatch.setattr(inmanta_plugins.files.json, "batch_unset", spy_batch_unset)
+
+    project.compile(TYPE_DEFINITION + model)
+
+    resource = project.get_instances("files::json::JsonResource")[0]
+    (serialized,) = resource.serialized
+    assert inmanta_plugins.files.json.json_value(serialized.value["late"]) == [
+        {"name": "a", "value": "a"},
+        {"name": "b", "value": "b"},
+        {"name": "c", "value": "c"},
+    ]
+
+    # The plugin only gave up on batches of unset values, the compiler never
+    # had to re-invoke it for each unset value individually
+    assert all(isinstance(e, MultiUnsetException) for e in raised)